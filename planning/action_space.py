@@ -0,0 +1,211 @@
+'''
+Per-waypoint best action for a DeepRacer action space.
+
+An action space is the list of steering angle and speed pairs of a model,
+in the model_metadata.json layout ({"action_space": [{"steering_angle": ...,
+"speed": ...}, ...]}); the spaces used in the qualifier and the finals are
+in this directory. For every waypoint the steering angle needed to follow
+the local curvature (kinematic bicycle model) and the target speed from
+speed_profile.py are compared with every action at once. An action is
+feasible when its steering is within STEERING_TOLERANCE of the steering
+needed and its speed is no more than SPEED_TOLERANCE over the target, and
+the best action is the feasible one closest to both.
+
+The result is a compact integer table per track: the best action index and
+a bit mask of the feasible actions (bit k set when action k is feasible),
+cached with the track. --table prints both with the action space as Python
+lists, so a reward can check the action taken in O(1):
+
+    action = ACTION_INDEX[(steering_angle, speed)]
+    feasible = FEASIBLE_ACTIONS[closest_waypoints[1]] >> action & 1
+
+Example:
+    python action_space.py --track Spain --action-space finals --table
+'''
+import argparse
+import json
+import os
+
+import numpy as np
+
+from plotting import new_figure, plot_indexed, save_figures, show
+from speed_profile import LINES, line_geometry, speed_profile
+from tracks import TRACK_DIR, load_track, waypoint_table
+
+TRACK_FILE = "Spain_track.npy"
+ACTION_SPACE = 'finals'
+
+# Car model
+WHEELBASE = 0.16            # metres
+
+# Feasibility and how differences are weighted when choosing the best action
+STEERING_TOLERANCE = 10     # degrees
+SPEED_TOLERANCE = 0.2       # m/s over the target speed
+SPEED_SCALE = 0.5           # m/s, as costly as STEERING_TOLERANCE
+
+
+def action_space_path(name):
+
+    # Accept a path or the name of a space in this directory, e.g. "finals"
+    # for finals_action_space.json
+    for candidate in (name,
+                      os.path.join(TRACK_DIR, name + '_action_space.json')):
+        if os.path.isfile(candidate):
+            return candidate
+
+    raise FileNotFoundError("No action space found for %r" % name)
+
+
+def load_action_space(name):
+    '''
+    Load an action space by name or path. Returns an (A, 2) array of the
+    steering angle (degrees) and speed (m/s) of each action, in index order.
+    '''
+    with open(action_space_path(name)) as f:
+        definition = json.load(f)
+
+    # Either model_metadata.json or just its list of actions
+    actions = definition.get('action_space', definition) \
+        if isinstance(definition, dict) else definition
+    actions = sorted(actions, key=lambda a: a.get('index', 0))
+
+    return np.array([[a['steering_angle'], a['speed']] for a in actions],
+                    dtype=float)
+
+
+def required_steering(curvature, wheelbase=WHEELBASE):
+
+    # Steering angle (degrees, positive left) that holds the curvature
+    return np.degrees(np.arctan(wheelbase * np.asarray(curvature)))
+
+
+def action_table_of(actions, curvature, target_speed):
+    '''
+    Best action index and feasible action mask at each point of a line,
+    from its curvature and target speed, for an (A, 2) action space.
+    Returns an (N, 2) integer array.
+    '''
+    steering = required_steering(curvature)[:, np.newaxis]
+    target_speed = np.asarray(target_speed)[:, np.newaxis]
+
+    # Compare every waypoint with every action
+    steering_error = np.abs(actions[:, 0] - steering)
+    speed_error = actions[:, 1] - target_speed
+    feasible = ((steering_error <= STEERING_TOLERANCE)
+                & (speed_error <= SPEED_TOLERANCE))
+    cost = ((steering_error / STEERING_TOLERANCE)**2
+            + (speed_error / SPEED_SCALE)**2)
+
+    # The closest feasible action, or the closest of all if none are
+    best = np.argmin(np.where(feasible, cost, np.inf), axis=1)
+    best = np.where(feasible.any(axis=1), best, np.argmin(cost, axis=1))
+    mask = feasible.astype(np.int64) @ (1 << np.arange(len(actions),
+                                                       dtype=np.int64))
+
+    return np.column_stack([best, mask])
+
+
+def action_table(track, action_space=ACTION_SPACE, line='centre'):
+    '''
+    Cached (N, 2) table of the best action index and the feasible action
+    mask at every waypoint of a track from the registry.
+    '''
+    actions = load_action_space(action_space)
+    if len(actions) > 63:
+        raise ValueError("At most 63 actions fit in the feasible mask")
+
+    # Key the cache on the actions themselves, not the file name
+    key = 'action_table_%s_%s' % (line, '_'.join(
+        '%g,%g' % tuple(action) for action in actions))
+
+    def build(track):
+        curvature, _ = line_geometry(track, line)
+        return action_table_of(actions, curvature,
+                               speed_profile(track, line=line))
+
+    return track.cached_array(key, build)
+
+
+def feasible_actions(table, waypoint, action):
+    '''
+    Whether action is feasible at waypoint, for single values or arrays.
+    '''
+    table = np.asarray(table)
+    return (table[waypoint, 1] >> np.asarray(action)) & 1 == 1
+
+
+def format_tables(actions, table):
+
+    # The action space and tables as Python, to paste into a reward function
+    index = ', '.join('(%g, %g): %d' % (steering, speed, i)
+                      for i, (steering, speed) in enumerate(actions))
+
+    return '\n'.join([
+        'ACTION_INDEX = {%s}' % index,
+        waypoint_table(table[:, 0], 'BEST_ACTION', '%d'),
+        waypoint_table(table[:, 1], 'FEASIBLE_ACTIONS', '%d'),
+    ])
+
+
+def action_labels(actions):
+
+    return ['%d: %g\N{DEGREE SIGN}, %g m/s' % (i, steering, speed)
+            for i, (steering, speed) in enumerate(actions)]
+
+
+def plot(waypoints, actions, table, headless=False):
+
+    # Colour the waypoints by their best action
+    fig, ax = new_figure(headless)
+    plot_indexed(ax, waypoints, table[:, 0], action_labels(actions),
+                 loc='center left', bbox_to_anchor=(1, 0.5))
+
+    return {'actions': fig}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--track', default=TRACK_FILE)
+    parser.add_argument('--action-space', default=ACTION_SPACE,
+                        help="name or path of an action space "
+                             "(default finals)")
+    parser.add_argument('--line', choices=LINES, default='centre')
+    parser.add_argument('--table', action='store_true',
+                        help="print the tables as Python")
+    parser.add_argument('--output-dir',
+                        help="save the map as a PNG file in this directory "
+                             "instead of showing it")
+    parser.add_argument('--no-plot', action='store_true')
+    args = parser.parse_args()
+
+    track = load_track(args.track)
+    actions = load_action_space(args.action_space)
+    table = np.asarray(action_table(track, args.action_space, args.line))
+
+    # How often each action is best
+    counts = np.bincount(table[:, 0], minlength=len(actions))
+    for label, count in zip(action_labels(actions), counts):
+        print("%-24s %4d waypoints" % (label, count))
+    infeasible = np.sum(table[:, 1] == 0)
+    if infeasible:
+        print("%d waypoints have no feasible action" % infeasible)
+
+    if args.table:
+        print(format_tables(actions, table))
+
+    if args.no_plot:
+        return
+
+    headless = args.output_dir is not None
+    figures = plot(track.inner, actions, table, headless)
+
+    if headless:
+        for path in save_figures(figures, args.output_dir, track.name):
+            print(path)
+    else:
+        show()
+
+
+if __name__ == '__main__':
+    main()
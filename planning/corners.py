@@ -0,0 +1,79 @@
+'''
+Corner identification over a whole track at once.
+
+identify_corners() is the array version of the identify_corner() function
+used by the reward functions, built on the NumPy backend of the geometry
+kernel (geometry_numpy.py): for every waypoint (and as many look-ahead steps
+as needed) it finds the difference between the current heading of the track
+and the heading to a further waypoint, and the distance to that further
+waypoint, in a single broadcasted pass. identify_corners_ahead() does the
+same with the look-ahead given in metres along the track.
+'''
+import numpy as np
+
+import geometry_numpy
+from geometry import lookahead_steps
+from tracks import derive_geometry
+
+
+def identify_corners(waypoints, future_steps, closest_waypoints=None):
+    '''
+    waypoints is an (N, 2) array of track points. By default every index i
+    is evaluated as closest_waypoints = [i-1, i], which is how the planners
+    simulate the car's position; an (M, 2) array of closest_waypoints pairs
+    can be given instead.
+
+    future_steps is either a single look-ahead, giving (N,) arrays, or a
+    sequence of look-aheads, giving (len(future_steps), N) arrays with one
+    row per look-ahead.
+
+    Returns (diff_heading, dist_future).
+    '''
+    waypoints = np.asarray(waypoints, dtype=float)[:, :2]
+    num_waypoints = len(waypoints)
+
+    if closest_waypoints is None:
+        next_index = np.arange(num_waypoints)
+        prev_index = next_index - 1
+    else:
+        closest_waypoints = np.asarray(closest_waypoints, dtype=int)
+        prev_index = closest_waypoints[:, 0]
+        next_index = closest_waypoints[:, 1]
+
+    # Identify the further waypoint for every look-ahead
+    steps = np.asarray(future_steps, dtype=int)[..., np.newaxis]
+
+    return corners_between(waypoints, prev_index, next_index, steps)
+
+
+def identify_corners_ahead(waypoints, distances, arc_length=None):
+    '''
+    As identify_corners() for every waypoint, but looking a distance in
+    metres ahead along the track rather than a number of waypoints, so the
+    result doesn't depend on how densely the track is sampled. distances may
+    be a single distance or a sequence of them.
+
+    arc_length defaults to the cumulative distance along waypoints; pass the
+    track registry's arc_length to reuse its cached copy.
+    '''
+    waypoints = np.asarray(waypoints, dtype=float)[:, :2]
+    if arc_length is None:
+        arc_length = derive_geometry(waypoints)['arc_length']
+    arc_length = np.asarray(arc_length, dtype=float).tolist()
+
+    # The kernel's look-ahead for each distance, one row per distance
+    distances = np.asarray(distances, dtype=float)
+    steps = np.array([lookahead_steps(arc_length, distance)
+                      for distance in distances.ravel()])
+    steps = steps.reshape(distances.shape + (len(waypoints),))
+
+    next_index = np.arange(len(waypoints))
+
+    return corners_between(waypoints, next_index - 1, next_index, steps)
+
+
+def corners_between(waypoints, prev_index, next_index, steps):
+
+    # The kernel's corner test for every pair of closest waypoints
+    closest_waypoints = np.stack([prev_index, next_index], axis=1)
+    return geometry_numpy.identify_corner(waypoints, closest_waypoints, steps)
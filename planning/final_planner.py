@@ -1,7 +1,14 @@
-import math
-import matplotlib.pyplot as plt
+import argparse
+import os
+
 import numpy as np
 
+import action_space
+import speed_profile
+from corners import identify_corners
+from plotting import new_figure, plot_classes, save_figures, show
+from tracks import load_track
+
 TRACK_FILE = "Spain_track.npy"
 
 # Parameters for Speed Incentive
@@ -12,141 +19,136 @@ TURN_THRESHOLD_SPEED = 6        # degrees
 FUTURE_STEP_STRAIGHT = 8
 TURN_THRESHOLD_STRAIGHT = 25    # degrees
 
+# Parameters that can be overridden, e.g. by render.py and sweep.py
+PARAMETERS = {
+    'FUTURE_STEP_SPEED': FUTURE_STEP_SPEED,
+    'TURN_THRESHOLD_SPEED': TURN_THRESHOLD_SPEED,
+    'FUTURE_STEP_STRAIGHT': FUTURE_STEP_STRAIGHT,
+    'TURN_THRESHOLD_STRAIGHT': TURN_THRESHOLD_STRAIGHT,
+}
+
 # Colour macros
 FAST = 0
 SLOW = 1
 STRAIGHT = 0
 CURVE = 1
 
+speed_color_dict = {0:'#ff7f0e', 1:'#1f77b4'}
+speed_label_dict = {0:'Fast Incentive', 1:'Slow Incentive'}
 
-def identify_corner(waypoints, closest_waypoints, future_step):
+straight_color_dict = {0:'#ff7f0e', 1:'#1f77b4'}
+straight_label_dict = {0:'Straight Incentive', 1:'No Incentive'}
 
-    # Identify next waypoint and a further waypoint
-    point_prev = waypoints[closest_waypoints[0]]
-    point_next = waypoints[closest_waypoints[1]]
-    point_future = waypoints[min(len(waypoints) - 1, 
-                                 closest_waypoints[1] + future_step)]
 
-    # Calculate headings to waypoints
-    heading_current = math.degrees(math.atan2(point_prev[1]-point_next[1], 
-                                              point_prev[0] - point_next[0]))
-    heading_future = math.degrees(math.atan2(point_prev[1]-point_future[1], 
-                                             point_prev[0]-point_future[0]))
+def select_speed(diff_heading, turn_threshold=TURN_THRESHOLD_SPEED):
 
-    # Calculate the difference between the headings
-    diff_heading = abs(heading_current - heading_future)
+    # If there's no corner encourage going faster, otherwise slowing down
+    return np.where(diff_heading < turn_threshold, FAST, SLOW)
 
-    # Check we didn't choose the reflex angle
-    if diff_heading > 180:
-        diff_heading = 360 - diff_heading
 
-    # Calculate distance to further waypoint
-    dist_future = np.linalg.norm([point_next[0] - point_future[0], 
-                                  point_next[1] - point_future[1]])  
+def select_straight(diff_heading, turn_threshold=TURN_THRESHOLD_STRAIGHT):
 
-    return diff_heading, dist_future
+    # If there's no corner encourage going straighter
+    return np.where(diff_heading < turn_threshold, STRAIGHT, CURVE)
 
 
-def select_speed(waypoints, closest_waypoints, future_step):
+def classify(waypoints, params=None):
 
-    # Identify if a corner is in the future
-    diff_heading, dist_future = identify_corner(waypoints, closest_waypoints, 
-                                                future_step)
+    params = dict(PARAMETERS, **(params or {}))
 
-    if diff_heading < TURN_THRESHOLD_SPEED:
-        # If there's no corner encourage going faster
-        go_fast = True
-    else:
-        # If there is a corner encourage slowing down
-        go_fast = False
+    # Identify corners for every waypoint at both look-aheads in one pass,
+    # with each waypoint simulating closest_waypoints = [i-1, i]
+    diff_heading, dist_future = identify_corners(
+        waypoints, [params['FUTURE_STEP_SPEED'],
+                    params['FUTURE_STEP_STRAIGHT']])
 
-    return go_fast
+    speed_colours = select_speed(diff_heading[0],
+                                 params['TURN_THRESHOLD_SPEED'])
+    straight_colours = select_straight(diff_heading[1],
+                                       params['TURN_THRESHOLD_STRAIGHT'])
 
+    return speed_colours, straight_colours
 
-def select_straight(waypoints, closest_waypoints, future_step):
 
-    # Identify if a corner is in the future
-    diff_heading, dist_future = identify_corner(waypoints, closest_waypoints, 
-                                                future_step)
+def plot(waypoints, speed_colours, straight_colours, headless=False):
 
-    if diff_heading < TURN_THRESHOLD_STRAIGHT:
-        # If there's no corner encourage going straighter
-        go_straight = True
-    else:
-        # If there is a corner don't encourage going straighter
-        go_straight = False
+    # Plot the points for the speed graph
+    fig_speed, ax_speed = new_figure(headless)
+    plot_classes(ax_speed, waypoints, speed_colours, speed_color_dict,
+                 speed_label_dict, loc='lower center',
+                 bbox_to_anchor=(0.5,-0.3), ncol=2)
 
-    return go_straight
+    # Plot the points for the straight graph
+    fig_straight, ax_straight = new_figure(headless)
+    plot_classes(ax_straight, waypoints, straight_colours,
+                 straight_color_dict, straight_label_dict, loc='lower center',
+                 bbox_to_anchor=(0.5,-0.3), ncol=2)
 
+    return {'speed': fig_speed, 'straight': fig_straight}
 
-# Get waypoints from numpy file
-waypoints = np.load(TRACK_FILE)
 
-print("--------- Parameters ---------")
-print("      FUTURE_STEP_SPEED: %d" % (FUTURE_STEP_SPEED))
-print("   TURN_THRESHOLD_SPEED: %d" % (TURN_THRESHOLD_SPEED))
-print("   FUTURE_STEP_STRAIGHT: %d" % (FUTURE_STEP_STRAIGHT))
-print("TURN_THRESHOLD_STRAIGHT: %d" % (TURN_THRESHOLD_STRAIGHT))
-print("------------------------------")
+def render(waypoints, params=None, headless=False):
 
-# Extract the x and y columns from the waypoints
-waypoints = waypoints[:,2:4]
+    return plot(waypoints, *classify(waypoints, params), headless=headless)
 
-speed_color_dict = {0:'#ff7f0e', 1:'#1f77b4'}
-speed_label_dict = {0:'Fast Incentive', 1:'Slow Incentive'}
 
-straight_color_dict = {0:'#ff7f0e', 1:'#1f77b4'}
-straight_label_dict = {0:'Straight Incentive', 1:'No Incentive'}
+def load_waypoints(track_file):
 
-speed_colours = []
-straight_colours = []
+    # Get the waypoints from the track registry, which memory maps the file
+    # and accepts either a path or a track name
+    track = load_track(track_file)
 
-for i in range(len(waypoints)):
-    # Simulate input parameter
-    closest_waypoints = [i-1, i]
+    # The planners plot the inner border columns (2:4) of the track
+    return track.inner
 
-    go_fast = select_speed(waypoints, closest_waypoints, FUTURE_STEP_SPEED)
-    if go_fast:
-        color = FAST
-        speed_colours.append(color)
-    else:
-        color = SLOW
-        speed_colours.append(color)
-
-    go_straight = select_straight(waypoints, closest_waypoints, 
-                                  FUTURE_STEP_STRAIGHT)
-    if go_straight:
-        color = STRAIGHT
-        straight_colours.append(color)
-    else:
-        color = CURVE
-        straight_colours.append(color)
 
+def main():
 
-# Plot the points for the speed graph
-fig_speed, ax_speed = plt.subplots()
+    parser = argparse.ArgumentParser(
+        description="Show where reward_final.py incentivises speed and "
+                    "straightness around a track")
+    parser.add_argument('--track', default=TRACK_FILE)
+    parser.add_argument('--output-dir',
+                        help="save the maps as PNG files in this directory "
+                             "instead of showing them")
+    parser.add_argument('--speed-profile', choices=speed_profile.LINES,
+                        help="colour the speed map by the target speed "
+                             "profile along this line instead")
+    parser.add_argument('--action-space', nargs='?', const='finals',
+                        help="also map the best action of an action space "
+                             "(default finals) at each waypoint")
+    args = parser.parse_args()
 
-for g in np.unique(speed_colours):
-    ix = np.where(speed_colours==g)
-    ax_speed.scatter(waypoints[ix,0], waypoints[ix,1], c=speed_color_dict[g], 
-                     label=speed_label_dict[g])
+    waypoints = load_waypoints(args.track)
 
-ax_speed.legend(loc='lower center', bbox_to_anchor=(0.5,-0.3), ncol=2, 
-                fancybox=True, shadow=True)
-ax_speed.set_aspect('equal')
-plt.axis('off')
+    print("--------- Parameters ---------")
+    print("      FUTURE_STEP_SPEED: %d" % (FUTURE_STEP_SPEED))
+    print("   TURN_THRESHOLD_SPEED: %d" % (TURN_THRESHOLD_SPEED))
+    print("   FUTURE_STEP_STRAIGHT: %d" % (FUTURE_STEP_STRAIGHT))
+    print("TURN_THRESHOLD_STRAIGHT: %d" % (TURN_THRESHOLD_STRAIGHT))
+    print("------------------------------")
 
-# Set the points for the straight graph
-fig_straight, ax_straight = plt.subplots()
+    headless = args.output_dir is not None
+    figures = render(waypoints, headless=headless)
+    if args.speed_profile:
+        profile = speed_profile.speed_profile(load_track(args.track),
+                                              line=args.speed_profile)
+        figures.update(speed=speed_profile.plot(waypoints, profile,
+                                                headless)['speed_profile'])
+    if args.action_space:
+        actions = action_space.load_action_space(args.action_space)
+        table = np.asarray(action_space.action_table(load_track(args.track),
+                                                     args.action_space))
+        figures.update(action_space.plot(waypoints, actions, table,
+                                         headless))
 
-for g in np.unique(straight_colours):
-    ix = np.where(straight_colours==g)
-    ax_straight.scatter(waypoints[ix,0], waypoints[ix,1], 
-                        c=straight_color_dict[g], label=straight_label_dict[g])
+    if headless:
+        prefix = os.path.splitext(os.path.basename(args.track))[0]
+        for path in save_figures(figures, args.output_dir, prefix):
+            print(path)
+    else:
+        show()
 
-ax_straight.legend(loc='lower center', bbox_to_anchor=(0.5,-0.3), ncol=2, 
-                   fancybox=True, shadow=True)
-ax_straight.set_aspect('equal')
-plt.axis('off')
 
-plt.show()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+'''
+Geometry kernel shared by the rewards and the planners: scalar backend.
+
+Headings, the difference between two headings, distances, look-ahead
+waypoints and the corner test the rewards are built on, and the per-track
+look-ahead and pace tables they build from them. This backend works on
+single values with nothing but math, which is what a reward pays for on
+every step; geometry_numpy.py has the per-step functions for NumPy arrays,
+for whole tracks and batches of steps, and agrees with it to within
+rounding.
+
+The reward files can't import anything outside the standard library and
+NumPy once pasted into the DeepRacer console, so they carry a copy of the
+functions below, between "# BEGIN geometry.py" and "# END geometry.py"
+lines, which tools/bundle_rewards.py keeps up to date. Change them here and
+re-run the bundler.
+'''
+import bisect
+import math
+
+
+def heading_between(x0, y0, x1, y1):
+
+    # Direction from (x0, y0) to (x1, y1) in degrees, from -180 to 180
+    return math.degrees(math.atan2(y1 - y0, x1 - x0))
+
+
+def angle_difference(heading_a, heading_b):
+
+    # Difference between two headings, avoiding the reflex angle
+    diff = abs(heading_a - heading_b)
+    if diff > 180:
+        diff = 360 - diff
+
+    return diff
+
+
+def distance(x0, y0, x1, y1):
+
+    dx = x1 - x0
+    dy = y1 - y0
+    return math.sqrt(dx*dx + dy*dy)
+
+
+def future_index(num_waypoints, next_index, steps):
+
+    # The waypoint steps after the next one, stopping at the last waypoint
+    return min(num_waypoints - 1, next_index + steps)
+
+
+def identify_corner(waypoints, closest_waypoints, future_step):
+
+    # Identify next waypoint and a further waypoint
+    point_prev = waypoints[closest_waypoints[0]]
+    point_next = waypoints[closest_waypoints[1]]
+    point_future = waypoints[min(len(waypoints) - 1,
+                                 closest_waypoints[1] + future_step)]
+
+    # Headings back to the previous waypoint from the next one and from the
+    # further one, and the angle between them. This runs on every step, so
+    # heading_between(), angle_difference() and distance() are written out
+    heading_current = math.degrees(math.atan2(point_prev[1] - point_next[1],
+                                              point_prev[0] - point_next[0]))
+    heading_future = math.degrees(math.atan2(point_prev[1] - point_future[1],
+                                             point_prev[0] - point_future[0]))
+    diff_heading = abs(heading_current - heading_future)
+    if diff_heading > 180:
+        diff_heading = 360 - diff_heading
+
+    # Distance to further waypoint
+    dx = point_future[0] - point_next[0]
+    dy = point_future[1] - point_next[1]
+    dist_future = math.sqrt(dx*dx + dy*dy)
+
+    return diff_heading, dist_future
+
+
+def arc_lengths(waypoints):
+
+    # Cumulative distance along the track to each waypoint
+    arc_length = [0.0]
+    for i in range(1, len(waypoints)):
+        arc_length.append(arc_length[-1] + distance(
+            waypoints[i - 1][0], waypoints[i - 1][1],
+            waypoints[i][0], waypoints[i][1]))
+
+    return arc_length
+
+
+def lookahead_steps(arc_length, future_dist):
+
+    # For each waypoint, how many waypoints ahead the first one at least
+    # future_dist metres further along the cumulative arc_length is. The
+    # corner test stops at the last waypoint, so the search does too
+    last = len(arc_length) - 1
+    return [min(last, bisect.bisect_left(arc_length, arc_length[i]
+                                         + future_dist)) - i
+            for i in range(len(arc_length))]
+
+
+def pace_rows(waypoints, pace):
+
+    # The progress (%) at each waypoint of a lap started at the first one,
+    # with the pace (reference steps) there and the steps per % of progress
+    # to the next waypoint, as the rewards look them up by
+    # closest_waypoints[0]
+    arc_length = arc_lengths(waypoints)
+    progress = [100 * a / arc_length[-1] for a in arc_length]
+
+    rows = []
+    for i in range(len(waypoints) - 1):
+        span = progress[i + 1] - progress[i]
+        rate = (pace[i + 1] - pace[i]) / span if span > 0 else 0.0
+        rows.append((progress[i], pace[i], rate))
+
+    # The last waypoint is the first one again, at the start of the lap
+    rows.append(rows[0])
+
+    return rows
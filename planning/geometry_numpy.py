@@ -0,0 +1,80 @@
+'''
+Geometry kernel shared by the rewards and the planners: NumPy backend.
+
+The functions of geometry.py for arrays, broadcasting their arguments, for
+whole tracks and batches of steps. The operations are the same as the
+scalar backend's, in the same order, so the two agree to within rounding:
+np.arctan2 is vectorised with SIMD and can differ from math.atan2 in the
+last bit, which only matters for a heading exactly on a threshold.
+
+The rewards carry a copy of these functions for their
+reward_function_batch, with _batch added to the names (see
+tools/bundle_rewards.py), so calls between them that span lines use a
+hanging indent, which the longer names don't misalign.
+'''
+import numpy as np
+
+
+def heading_between(x0, y0, x1, y1):
+
+    # Direction from (x0, y0) to (x1, y1) in degrees, from -180 to 180
+    return np.degrees(np.arctan2(np.subtract(y1, y0), np.subtract(x1, x0)))
+
+
+def angle_difference(heading_a, heading_b):
+
+    # Difference between two headings, avoiding the reflex angle
+    diff = np.abs(np.subtract(heading_a, heading_b))
+    return np.where(diff > 180, 360 - diff, diff)
+
+
+def distance(x0, y0, x1, y1):
+
+    dx = np.subtract(x1, x0)
+    dy = np.subtract(y1, y0)
+    return np.sqrt(dx*dx + dy*dy)
+
+
+def future_index(num_waypoints, next_index, steps):
+
+    # The waypoint steps after the next one, stopping at the last waypoint
+    return np.minimum(num_waypoints - 1, np.add(next_index, steps))
+
+
+def identify_corner(waypoints, closest_waypoints, future_step):
+    '''
+    identify_corner() of geometry.py for an (M, 2) array of
+    closest_waypoints pairs. future_step may be a single look-ahead, giving
+    (M,) arrays, or an array that broadcasts against the pairs, e.g. one
+    look-ahead per row of shape (S, 1), giving (S, M) arrays.
+    '''
+    waypoints = np.asarray(waypoints, dtype=float)
+    closest_waypoints = np.asarray(closest_waypoints, dtype=int)
+    point_prev = waypoints[closest_waypoints[:, 0]]
+    point_next = waypoints[closest_waypoints[:, 1]]
+    point_future = waypoints[future_index(
+        len(waypoints), closest_waypoints[:, 1], future_step)]
+
+    diff_heading = angle_difference(
+        heading_between(
+            point_next[:, 0], point_next[:, 1],
+            point_prev[:, 0], point_prev[:, 1]),
+        heading_between(
+            point_future[..., 0], point_future[..., 1],
+            point_prev[:, 0], point_prev[:, 1]))
+    dist_future = distance(
+        point_next[:, 0], point_next[:, 1],
+        point_future[..., 0], point_future[..., 1])
+
+    return diff_heading, dist_future
+
+
+def arc_lengths(waypoints):
+
+    # Cumulative distance along the track to each waypoint, summed in order
+    waypoints = np.asarray(waypoints, dtype=float)
+    lengths = distance(waypoints[:-1, 0], waypoints[:-1, 1],
+                       waypoints[1:, 0], waypoints[1:, 1])
+
+    return np.concatenate([[0.0], np.cumsum(lengths)])
+
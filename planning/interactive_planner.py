@@ -0,0 +1,277 @@
+'''
+Interactive planner maps with a slider for each threshold.
+
+Shows the maps of final_planner.py (speed and straightness) or
+qualifier_planner.py (speed) with a slider for each of the planner's
+PARAMETERS that is set (the qualifier's FUTURE_DIST only with
+--future-dist, which replaces its FUTURE_STEP, MID_STEP and DIST_THRESHOLD
+sliders). The heading differences and distances for every look-ahead a
+slider can reach are computed once when the window opens, so moving a slider
+only picks rows of those tables and reclassifies the waypoints, and the
+scatter plots already drawn are recoloured in place rather than plotted
+again. Look-aheads in metres are kept as they are first reached. The values the sliders are left at are printed when the window is
+closed, ready to paste into the planner and the reward function.
+
+Example:
+    python interactive_planner.py final --track Spain
+    python interactive_planner.py qualifier --max-step 30
+    python interactive_planner.py qualifier --future-dist 1.5
+'''
+import argparse
+
+import numpy as np
+
+import final_planner
+import qualifier_planner
+from corners import corners_between, identify_corners
+from geometry import lookahead_steps
+from tracks import derive_geometry
+
+PLANNERS = {
+    'final': final_planner,
+    'qualifier': qualifier_planner,
+}
+
+# Largest look-ahead the step sliders reach
+MAX_STEP = 20
+
+# Slider ranges and steps for the other parameters
+SLIDER_RANGES = {
+    'TURN_THRESHOLD': (0, 90, 0.5),     # degrees
+    'DIST_THRESHOLD': (0, 3, 0.05),     # metres
+    'FUTURE_DIST': (0.5, 10, 0.1),      # metres
+}
+
+# Parameters a look-ahead in metres leaves unused
+FUTURE_DIST_UNUSED = ('FUTURE_STEP', 'MID_STEP', 'DIST_THRESHOLD')
+
+
+class Classifier:
+    '''
+    A planner's classification of a track for any parameters, from the
+    corners at every look-ahead up to max_step computed once.
+    '''
+
+    def __init__(self, mode, waypoints, max_step=MAX_STEP):
+        self.mode = mode
+        self.waypoints = waypoints
+        self.steps = np.arange(1, max_step + 1)
+        self.diff_heading, self.dist_future = identify_corners(waypoints,
+                                                               self.steps)
+        self.arc_length = derive_geometry(
+            np.asarray(waypoints, dtype=float))['arc_length'].tolist()
+        self.ahead = {}
+
+    def rows(self, *steps):
+        return np.searchsorted(self.steps, np.array(steps, dtype=int))
+
+    def corners_ahead(self, distance):
+        '''
+        Heading differences looking distance metres ahead of every waypoint,
+        as qualifier_planner.select_speed_ahead() finds them. Kept for each
+        distance once found.
+        '''
+        if distance not in self.ahead:
+            next_index = np.arange(len(self.waypoints))
+            steps = np.array(lookahead_steps(self.arc_length, distance))
+            self.ahead[distance] = corners_between(
+                self.waypoints, next_index - 1, next_index, steps)[0]
+
+        return self.ahead[distance]
+
+    def classify(self, params):
+        '''
+        Classes of every waypoint for each of the planner's maps.
+        '''
+        params = dict(PLANNERS[self.mode].PARAMETERS, **params)
+
+        if self.mode == 'final':
+            speed, straight = self.rows(params['FUTURE_STEP_SPEED'],
+                                        params['FUTURE_STEP_STRAIGHT'])
+            return {
+                'speed': final_planner.select_speed(
+                    self.diff_heading[speed], params['TURN_THRESHOLD_SPEED']),
+                'straight': final_planner.select_straight(
+                    self.diff_heading[straight],
+                    params['TURN_THRESHOLD_STRAIGHT']),
+            }
+
+        if params['FUTURE_DIST'] is not None:
+            diff_heading = self.corners_ahead(params['FUTURE_DIST'])
+            return {
+                'speed': np.where(diff_heading < params['TURN_THRESHOLD'],
+                                  qualifier_planner.FAST,
+                                  qualifier_planner.SLOW),
+            }
+
+        rows = self.rows(params['FUTURE_STEP'], params['MID_STEP'])
+        return {
+            'speed': qualifier_planner.speed_classes(
+                self.diff_heading[rows], self.dist_future[rows],
+                params['TURN_THRESHOLD'], params['DIST_THRESHOLD']),
+        }
+
+
+def class_styles(mode):
+
+    # Colours and labels of the classes on each map
+    if mode == 'final':
+        return {
+            'speed': (final_planner.speed_color_dict,
+                      final_planner.speed_label_dict),
+            'straight': (final_planner.straight_color_dict,
+                         final_planner.straight_label_dict),
+        }
+
+    return {'speed': (qualifier_planner.color_dict,
+                      qualifier_planner.label_dict)}
+
+
+def slider_range(name, max_step=MAX_STEP):
+
+    # Match names like TURN_THRESHOLD_SPEED by their prefix
+    if 'STEP' in name:
+        return 1, max_step, 1
+    for prefix, slider in SLIDER_RANGES.items():
+        if name.startswith(prefix):
+            return slider
+
+    raise KeyError("No slider range for %s" % name)
+
+
+def format_parameters(params):
+
+    return '\n'.join('%s = %s' % (name, value if value is None
+                                   else '%g' % value)
+                     for name, value in params.items())
+
+
+def interactive(mode, waypoints, params=None, max_step=MAX_STEP):
+    '''
+    Build the figure with its sliders. Returns the figure, the sliders keyed
+    by parameter and the current parameters, which the sliders update.
+    Raises ValueError if a look-ahead is beyond max_step.
+    '''
+    import matplotlib.pyplot as plt
+    from matplotlib.widgets import Slider
+
+    planner = PLANNERS[mode]
+    params = dict(planner.PARAMETERS, **(params or {}))
+    for name, value in params.items():
+        if 'STEP' in name and not 1 <= value <= max_step:
+            raise ValueError("%s = %d is outside the step sliders' range of "
+                             "1 to %d" % (name, value, max_step))
+    classifier = Classifier(mode, waypoints, max_step)
+    classes = classifier.classify(params)
+    styles = class_styles(mode)
+    waypoints = np.asarray(waypoints)
+
+    fig, axes = plt.subplots(1, len(styles), squeeze=False,
+                             figsize=(6 * len(styles), 6))
+    adjustable = [name for name, value in params.items() if value is not None
+                  and not (params.get('FUTURE_DIST') is not None
+                           and name in FUTURE_DIST_UNUSED)]
+    fig.subplots_adjust(bottom=0.1 + 0.05 * len(adjustable))
+
+    # One scatter per class as in plot_classes(), which Agg draws far faster
+    # than a single scatter of mixed colours. Changes move the points
+    # between them.
+    scatters = {}
+    for ax, (name, (colours, labels)) in zip(axes[0], styles.items()):
+        scatters[name] = {}
+        for k in sorted(colours):
+            ix = classes[name] == k
+            scatters[name][k] = ax.scatter(waypoints[ix, 0],
+                                           waypoints[ix, 1], c=colours[k],
+                                           label=labels[k], animated=True)
+        ax.update_datalim(waypoints)
+        ax.autoscale_view()
+        ax.legend(fancybox=True, shadow=True, loc='lower center',
+                  bbox_to_anchor=(0.5, -0.2), ncol=2)
+        ax.set_aspect('equal')
+        ax.axis('off')
+
+    sliders = {}
+    for i, name in enumerate(reversed(adjustable)):
+        low, high, step = slider_range(name, max_step)
+        slider_ax = fig.add_axes([0.3, 0.05 + 0.05 * i, 0.45, 0.03],
+                                 animated=True)
+        sliders[name] = Slider(slider_ax, name, low, high,
+                               valinit=params[name], valstep=step)
+        sliders[name].drawon = False
+
+    # Everything that changes is animated, so a full draw (on opening or
+    # resizing) leaves a background to restore, and a slider move only
+    # draws the points and the sliders over it
+    background = []
+
+    def draw_animated():
+        for by_class in scatters.values():
+            for scatter in by_class.values():
+                fig.draw_artist(scatter)
+        for slider in sliders.values():
+            fig.draw_artist(slider.ax)
+
+    def on_draw(event):
+        background[:] = [fig.canvas.copy_from_bbox(fig.bbox)]
+        draw_animated()
+
+    def update(name, value):
+        params[name] = int(value) if 'STEP' in name else float(value)
+        for key, values in classifier.classify(params).items():
+            for k, scatter in scatters[key].items():
+                scatter.set_offsets(waypoints[values == k])
+
+        if not background:
+            fig.canvas.draw_idle()
+            return
+        fig.canvas.restore_region(background[0])
+        draw_animated()
+        fig.canvas.blit(fig.bbox)
+
+    fig.canvas.mpl_connect('draw_event', on_draw)
+    for name, slider in sliders.items():
+        slider.on_changed(lambda value, name=name: update(name, value))
+
+    return fig, sliders, params
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('mode', choices=sorted(PLANNERS))
+    parser.add_argument('--track', help="track name or .npy file")
+    parser.add_argument('--max-step', type=int, default=MAX_STEP,
+                        help="largest look-ahead on the sliders "
+                             "(default %d)" % MAX_STEP)
+    parser.add_argument('--future-dist', type=float,
+                        help="qualifier look-ahead in metres, replacing the "
+                             "two-stage corner check")
+    args = parser.parse_args()
+
+    params = {}
+    if args.future_dist is not None:
+        if args.mode != 'qualifier':
+            parser.error("--future-dist is only for the qualifier")
+        params['FUTURE_DIST'] = args.future_dist
+
+    import matplotlib.pyplot as plt
+
+    planner = PLANNERS[args.mode]
+    waypoints = planner.load_waypoints(args.track or planner.TRACK_FILE)
+    # Keep the sliders referenced while the window is open, or they stop
+    # responding
+    try:
+        fig, sliders, params = interactive(args.mode, waypoints, params,
+                                           max_step=args.max_step)
+    except ValueError as e:
+        parser.error(str(e))
+    plt.show()
+
+    print("--------- Parameters ---------")
+    print(format_parameters(params))
+    print("------------------------------")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+'''
+Plotting helpers shared by the planners.
+
+matplotlib is only imported once a figure is actually requested. Headless
+figures are built directly on matplotlib's Figure class rather than through
+pyplot, so they never load an interactive backend and can be rendered to
+files without a display.
+'''
+import os
+
+import numpy as np
+
+
+def new_figure(headless=False):
+
+    if headless:
+        from matplotlib.figure import Figure
+        fig = Figure()
+        ax = fig.subplots()
+    else:
+        import matplotlib.pyplot as plt
+        fig, ax = plt.subplots()
+
+    return fig, ax
+
+
+def plot_classes(ax, points, classes, color_dict, label_dict,
+                 **legend_kwargs):
+
+    # Plot the points of each class in its own colour
+    classes = np.asarray(classes)
+    for g in np.unique(classes):
+        ix = classes == g
+        ax.scatter(points[ix, 0], points[ix, 1], c=color_dict[g],
+                   label=label_dict[g])
+
+    ax.legend(fancybox=True, shadow=True, **legend_kwargs)
+    ax.set_aspect('equal')
+    ax.axis('off')
+
+
+def plot_indexed(ax, points, index, labels, **legend_kwargs):
+
+    # Plot all the points in one call, coloured by their index into labels,
+    # with a legend entry for each index that appears
+    from matplotlib import colormaps
+    from matplotlib.lines import Line2D
+
+    points = np.asarray(points)
+    index = np.asarray(index)
+    colours = colormaps['tab20'](np.arange(len(labels)) % 20)
+    ax.scatter(points[:, 0], points[:, 1], c=colours[index])
+
+    handles = [Line2D([], [], marker='o', linestyle='', color=colours[i],
+                      label=labels[i]) for i in np.unique(index)]
+    ax.legend(handles=handles, fancybox=True, shadow=True, **legend_kwargs)
+    ax.set_aspect('equal')
+    ax.axis('off')
+
+
+def plot_values(ax, points, values, label, cmap='viridis'):
+
+    # Plot the points coloured by a value, with a colour bar
+    points = np.asarray(points)
+    scatter = ax.scatter(points[:, 0], points[:, 1], c=np.asarray(values),
+                         cmap=cmap)
+    ax.figure.colorbar(scatter, ax=ax, label=label, shrink=0.8)
+    ax.set_aspect('equal')
+    ax.axis('off')
+
+
+def plot_heatmap(ax, values, x, y, xlabel, ylabel, label, cmap='viridis'):
+
+    # Show a (len(y), len(x)) grid of values against the x and y axis values,
+    # with a colour bar
+    values = np.asarray(values)
+    image = ax.imshow(values, origin='lower', aspect='auto', cmap=cmap,
+                      extent=(x[0], x[-1], y[0], y[-1]),
+                      interpolation='nearest')
+    ax.figure.colorbar(image, ax=ax, label=label)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+
+
+def save_figures(figures, output_dir, prefix):
+
+    # Save each named figure as <prefix>_<name>.png
+    os.makedirs(output_dir, exist_ok=True)
+
+    paths = []
+    for name, fig in figures.items():
+        path = os.path.join(output_dir, '%s_%s.png' % (prefix, name))
+        fig.savefig(path, bbox_inches='tight')
+        paths.append(path)
+
+    return paths
+
+
+def show():
+
+    import matplotlib.pyplot as plt
+    plt.show()
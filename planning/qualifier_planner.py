@@ -1,7 +1,14 @@
-import math
-import matplotlib.pyplot as plt
+import argparse
+import os
+
 import numpy as np
 
+import action_space
+import speed_profile
+from corners import identify_corners, identify_corners_ahead
+from plotting import new_figure, plot_classes, save_figures, show
+from tracks import load_track
+
 TRACK_FILE = "ChampionshipCup2019_track.npy"
 
 # Parameters
@@ -10,109 +17,158 @@ MID_STEP = 4
 TURN_THRESHOLD = 10   # degrees
 DIST_THRESHOLD = 1.2  # metres
 
+# Look-ahead in metres along the track. When set, corners are checked once
+# at this distance instead of with FUTURE_STEP, MID_STEP and DIST_THRESHOLD
+FUTURE_DIST = None    # metres
+
+# Parameters that can be overridden, e.g. by render.py and sweep.py
+PARAMETERS = {
+    'FUTURE_STEP': FUTURE_STEP,
+    'MID_STEP': MID_STEP,
+    'TURN_THRESHOLD': TURN_THRESHOLD,
+    'DIST_THRESHOLD': DIST_THRESHOLD,
+    'FUTURE_DIST': FUTURE_DIST,
+}
+
 # Colour macros
 FAST = 0
 SLOW = 1
 BONUS_FAST =  2
 
+color_dict = {0:'#ff7f0e', 1:'#1f77b4', 2:'#ff460e'}
+label_dict = {0:'Fast Incentive', 1:'Slow Incentive', 2:'Bonus Fast Incentive'}
 
-def identify_corner(waypoints, closest_waypoints, future_step):
-
-    # Identify next waypoint and a further waypoint
-    point_prev = waypoints[closest_waypoints[0]]
-    point_next = waypoints[closest_waypoints[1]]
-    point_future = waypoints[min(len(waypoints) - 1, 
-                                 closest_waypoints[1] + future_step)]
-
-    # Calculate headings to waypoints
-    heading_current = math.degrees(math.atan2(point_prev[1]-point_next[1], 
-                                              point_prev[0] - point_next[0]))
-    heading_future = math.degrees(math.atan2(point_prev[1]-point_future[1], 
-                                             point_prev[0]-point_future[0]))
-
-    # Calculate the difference between the headings
-    diff_heading = abs(heading_current - heading_future)
-
-    # Check we didn't choose the reflex angle
-    if diff_heading > 180:
-        diff_heading = 360 - diff_heading
 
-    # Calculate distance to further waypoint
-    dist_future = np.linalg.norm([point_next[0] - point_future[0], 
-                                  point_next[1] - point_future[1]])  
+# This is a modified version of the actual select_speed function used in
+# reward_qualifier.py so that there is a 3rd possible return value to allow
+# visualisation of the "bonus fast" points
+def select_speed(waypoints, future_step, mid_step,
+                 turn_threshold=TURN_THRESHOLD,
+                 dist_threshold=DIST_THRESHOLD):
 
-    return diff_heading, dist_future
+    # Identify if a corner is in the future, and at closer points, for every
+    # waypoint simulating closest_waypoints = [i-1, i]
+    diff_heading, dist_future = identify_corners(waypoints,
+                                                 [future_step, mid_step])
 
+    return speed_classes(diff_heading, dist_future, turn_threshold,
+                         dist_threshold)
 
-# This is a modified version of the actual select_speed function used in 
-# reward_qualifier.py so that there is a 3rd possible return value to allow 
-# visualisation of the "bonus fast" points 
-def select_speed(waypoints, closest_waypoints, future_step, mid_step):
 
-    # Identify if a corner is in the future
-    diff_heading, dist_future = identify_corner(waypoints, closest_waypoints,
-                                                future_step)
+def speed_classes(diff_heading, dist_future, turn_threshold=TURN_THRESHOLD,
+                  dist_threshold=DIST_THRESHOLD):
 
-    if diff_heading < TURN_THRESHOLD:
-        # If there's no corner encourage going faster
-        speed_colour = FAST
-    else:
-        if dist_future < DIST_THRESHOLD:
-            # If there is a corner and it's close encourage going slower
-            speed_colour = SLOW
-        else:
-            # If the corner is far away, re-assess closer points
-            diff_heading_mid, dist_mid = identify_corner(waypoints, 
-                                                         closest_waypoints, 
-                                                         mid_step)
-
-            if diff_heading_mid < TURN_THRESHOLD:
-                # If there's no corner encourage going faster
-                speed_colour = BONUS_FAST
-            else:
-                # If there is a corner and it's close encourage going slower
-                speed_colour = SLOW
+    # Classify from the corners at the future and mid look-aheads, one row
+    # each
+    speed_colour = np.select(
+        [diff_heading[0] < turn_threshold,  # No corner, go faster
+         dist_future[0] < dist_threshold,   # Corner is close, go slower
+         diff_heading[1] < turn_threshold], # Corner is far away, go faster
+        [FAST, SLOW, BONUS_FAST],
+        SLOW)                               # Corner at closer points too
 
     return speed_colour
 
 
-# Get waypoints from numpy file
-waypoints = np.load(TRACK_FILE)
+def select_speed_ahead(waypoints, future_dist,
+                       turn_threshold=TURN_THRESHOLD):
 
-print("----- Parameters -----")
-print("   FUTURE_STEP: %d" % (FUTURE_STEP))
-print("      MID_STEP: %d" % (MID_STEP))
-print("TURN_THRESHOLD: %d" % (TURN_THRESHOLD))
-print("DIST_THRESHOLD: %.1f" % (DIST_THRESHOLD))
-print("----------------------")
+    # Identify if a corner is within future_dist metres along the track
+    diff_heading, dist_future = identify_corners_ahead(waypoints, future_dist)
 
-# Extract the x and y columns from the waypoints
-waypoints = waypoints[:,2:4]
+    return np.where(diff_heading < turn_threshold, FAST, SLOW)
 
-color_dict = {0:'#ff7f0e', 1:'#1f77b4', 2:'#ff460e'}
-label_dict = {0:'Fast Incentive', 1:'Slow Incentive', 2:'Bonus Fast Incentive'}
 
-colours = []
+def classify(waypoints, params=None):
 
-for i in range(len(waypoints)):
-    # Simulate input parameter
-    closest_waypoints = [i-1, i]
+    params = dict(PARAMETERS, **(params or {}))
 
     # Determine what speed will be rewarded
-    speed_colour = select_speed(waypoints, closest_waypoints, FUTURE_STEP, 
-                                MID_STEP)
-    colours.append(speed_colour)
-
-# Plot points
-fig, ax = plt.subplots()
-
-for g in np.unique(colours):
-    ix = np.where(colours==g)
-    ax.scatter(waypoints[ix,0], waypoints[ix,1], c=color_dict[g], 
-               label=label_dict[g])
+    if params['FUTURE_DIST'] is not None:
+        return select_speed_ahead(waypoints, params['FUTURE_DIST'],
+                                  params['TURN_THRESHOLD'])
+
+    return select_speed(waypoints, params['FUTURE_STEP'], params['MID_STEP'],
+                        params['TURN_THRESHOLD'], params['DIST_THRESHOLD'])
+
+
+def plot(waypoints, colours, headless=False):
+
+    # Plot points
+    fig, ax = new_figure(headless)
+    plot_classes(ax, waypoints, colours, color_dict, label_dict)
+
+    return {'speed': fig}
+
+
+def render(waypoints, params=None, headless=False):
+
+    return plot(waypoints, classify(waypoints, params), headless=headless)
+
+
+def load_waypoints(track_file):
+
+    # Get the waypoints from the track registry, which memory maps the file
+    # and accepts either a path or a track name
+    track = load_track(track_file)
+
+    # The planners plot the inner border columns (2:4) of the track
+    return track.inner
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Show where reward_qualifier.py incentivises going faster "
+                    "or slower around a track")
+    parser.add_argument('--track', default=TRACK_FILE)
+    parser.add_argument('--output-dir',
+                        help="save the map as a PNG file in this directory "
+                             "instead of showing it")
+    parser.add_argument('--future-dist', type=float, default=FUTURE_DIST,
+                        help="look-ahead in metres, replacing the two-stage "
+                             "corner check")
+    parser.add_argument('--speed-profile', choices=speed_profile.LINES,
+                        help="colour the speed map by the target speed "
+                             "profile along this line instead")
+    parser.add_argument('--action-space', nargs='?', const='qualifier',
+                        help="also map the best action of an action space "
+                             "(default qualifier) at each waypoint")
+    args = parser.parse_args()
+
+    waypoints = load_waypoints(args.track)
+
+    print("----- Parameters -----")
+    print("   FUTURE_STEP: %d" % (FUTURE_STEP))
+    print("      MID_STEP: %d" % (MID_STEP))
+    print("TURN_THRESHOLD: %d" % (TURN_THRESHOLD))
+    print("DIST_THRESHOLD: %.1f" % (DIST_THRESHOLD))
+    if args.future_dist is not None:
+        print("   FUTURE_DIST: %.1f" % (args.future_dist))
+    print("----------------------")
+
+    headless = args.output_dir is not None
+    figures = render(waypoints, {'FUTURE_DIST': args.future_dist},
+                     headless=headless)
+    if args.speed_profile:
+        profile = speed_profile.speed_profile(load_track(args.track),
+                                              line=args.speed_profile)
+        figures.update(speed=speed_profile.plot(waypoints, profile,
+                                                headless)['speed_profile'])
+    if args.action_space:
+        actions = action_space.load_action_space(args.action_space)
+        table = np.asarray(action_space.action_table(load_track(args.track),
+                                                     args.action_space))
+        figures.update(action_space.plot(waypoints, actions, table,
+                                         headless))
+
+    if headless:
+        prefix = os.path.splitext(os.path.basename(args.track))[0]
+        for path in save_figures(figures, args.output_dir, prefix):
+            print(path)
+    else:
+        show()
 
-ax.legend(fancybox=True, shadow=True)
-ax.set_aspect('equal')
-plt.axis('off')
 
-plt.show()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
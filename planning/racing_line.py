@@ -0,0 +1,397 @@
+'''
+Minimum-curvature racing line between the track borders.
+
+Each waypoint of the line is placed on the straight between the two border
+points of the track file (columns 2:4 and 4:6), at a fraction s of the way
+across. The line's curvature is approximated by its second differences, so
+the squared curvature summed round the loop is a quadratic in s, which is
+minimised subject to staying MARGIN metres inside both borders. The bounds
+are handled by an interior point method. Each of its iterations is one
+solve of a cyclic pentadiagonal system, which takes time and memory linear
+in the number of waypoints.
+
+The result is stored per track in the registry cache as the lateral offset
+of the line from the centreline at every waypoint, positive to the left, so
+a reward can compare the car's own offset (distance_from_center signed by
+is_left_of_center) with a table lookup.
+
+Example:
+    python racing_line.py --track Spain --table
+'''
+import argparse
+
+import numpy as np
+
+from plotting import new_figure, save_figures, show
+from tracks import load_track, waypoint_table
+
+TRACK_FILE = "Spain_track.npy"
+
+# Distance kept between the racing line and either border
+MARGIN = 0.15           # metres
+
+# Interior point iterations: the limit, the fraction of the distance to the
+# bounds each step may go, how far towards the central path it aims and
+# the tolerance on stationarity (relative) and complementarity
+MAX_ITERATIONS = 100
+BOUNDARY_FRACTION = 0.99
+CENTRING = 0.3
+TOLERANCE = 1e-10
+
+
+def ring_index(points):
+
+    # Index of each waypoint into the distinct points of the loop, dropping
+    # repeated waypoints and the repeated start point
+    lengths = np.hypot(*np.diff(points, axis=0).T)
+    distinct = np.concatenate([[True], lengths > 0])
+    index = np.cumsum(distinct) - 1
+    num_ring = index[-1] + 1
+    if np.allclose(points[0], points[-1]):
+        num_ring -= 1
+        index[index == num_ring] = 0
+
+    return distinct, index, num_ring
+
+
+def curvature_system(centre, first, across):
+    '''
+    Quadratic form of the squared curvature integrated round the closed line
+    first + s*across, as (H, g) with the cost 1/2 s'Hs + g's plus a
+    constant. Curvature at each point is the three-point estimate across the
+    centreline (normal to it), using the centreline's uneven spacing. H is
+    cyclic pentadiagonal, so it is given by its diagonals H[i, i], H[i, i+1]
+    and H[i, i+2], with the indices taken round the loop.
+    '''
+    after = np.roll(centre, -1, axis=0) - centre
+    before = centre - np.roll(centre, 1, axis=0)
+    length_after = np.hypot(*after.T)
+    length_before = np.hypot(*before.T)
+    span = length_before + length_after
+
+    # Curvature = C r . normal, with C weighting the neighbours of each
+    # point by their distance
+    weight_before = 2 / (length_before * span)
+    weight_after = 2 / (length_after * span)
+    weight_centre = -(weight_before + weight_after)
+    tangent = before / length_before[:, np.newaxis] \
+        + after / length_after[:, np.newaxis]
+    normal = np.stack([-tangent[:, 1], tangent[:, 0]], axis=1)
+    normal /= np.hypot(*normal.T)[:, np.newaxis]
+
+    # Curvature is linear in s: K s + k, with K cyclic tridiagonal, its
+    # diagonals being K[i, i-1], K[i, i] and K[i, i+1]
+    k_before = weight_before * np.sum(normal * np.roll(across, 1, axis=0),
+                                      axis=1)
+    k_centre = weight_centre * np.sum(normal * across, axis=1)
+    k_after = weight_after * np.sum(normal * np.roll(across, -1, axis=0),
+                                    axis=1)
+    constant = np.sum(normal * (
+        weight_before[:, np.newaxis] * np.roll(first, 1, axis=0)
+        + weight_centre[:, np.newaxis] * first
+        + weight_after[:, np.newaxis] * np.roll(first, -1, axis=0)), axis=1)
+
+    # Integrate over the length around each point: H = 2 K'LK, g = 2 K'Lk,
+    # where row i of K reaches the points i-1, i and i+1
+    length = span / 2
+    diagonal = 2 * (np.roll(length * k_after**2, 1)
+                    + length * k_centre**2
+                    + np.roll(length * k_before**2, -1))
+    first_off = 2 * (length * k_centre * k_after
+                     + np.roll(length * k_before * k_centre, -1))
+    second_off = 2 * np.roll(length * k_before * k_after, -1)
+    gradient = 2 * (np.roll(length * k_after * constant, 1)
+                    + length * k_centre * constant
+                    + np.roll(length * k_before * constant, -1))
+
+    return (diagonal, first_off, second_off), gradient
+
+
+def cyclic_product(hessian, values):
+
+    # H @ values for H given by its cyclic diagonals
+    diagonal, first_off, second_off = hessian
+    return (diagonal * values
+            + first_off * np.roll(values, -1)
+            + np.roll(first_off * values, 1)
+            + second_off * np.roll(values, -2)
+            + np.roll(second_off * values, 2))
+
+
+def cyclic_entries(hessian, rows, columns):
+
+    # H[rows, columns] for H given by its cyclic diagonals
+    diagonal, first_off, second_off = hessian
+    num_points = len(diagonal)
+    step = (columns - rows) % num_points
+    return np.select(
+        [step == 0, step == 1, step == num_points - 1,
+         step == 2, step == num_points - 2],
+        [diagonal[rows], first_off[rows], first_off[columns],
+         second_off[rows], second_off[columns]])
+
+
+def banded_solve(diagonal, first_off, second_off, rhs):
+
+    # Solve a symmetric pentadiagonal system for each column of rhs by an
+    # LDL' factorisation, in O(N) time and memory
+    d0 = diagonal.tolist()
+    d1 = first_off.tolist() + [0.0]
+    d2 = second_off.tolist() + [0.0, 0.0]
+    num_points = len(d0)
+    pivot = [0.0] * (num_points + 2)
+    l1 = [0.0] * (num_points + 2)
+    l2 = [0.0] * (num_points + 2)
+    for i in range(num_points):
+        p = (d0[i] - l1[i - 1] * l1[i - 1] * pivot[i - 1]
+             - l2[i - 2] * l2[i - 2] * pivot[i - 2])
+        l1[i] = (d1[i] - l2[i - 1] * pivot[i - 1] * l1[i - 1]) / p
+        l2[i] = d2[i] / p
+        pivot[i] = p
+
+    solution = np.empty_like(rhs)
+    for column in range(rhs.shape[1]):
+        x = rhs[:, column].tolist() + [0.0, 0.0]
+        for i in range(num_points):
+            x[i] -= l1[i - 1] * x[i - 1] + l2[i - 2] * x[i - 2]
+        for i in range(num_points):
+            x[i] /= pivot[i]
+        for i in range(num_points - 1, -1, -1):
+            x[i] -= l1[i] * x[i + 1] + l2[i] * x[i + 2]
+        solution[:, column] = x[:num_points]
+
+    return solution
+
+
+def solve_free(hessian, free, rhs):
+    '''
+    Solve H[free, free] x = rhs for a cyclic pentadiagonal H given by its
+    diagonals. The free points keep their order round the loop, so the
+    system is banded but for a few entries coupling its two ends, which are
+    added to the banded solve by the Sherman-Morrison-Woodbury formula.
+    '''
+    index = np.flatnonzero(free)
+    num_free = len(index)
+    if num_free <= 4:
+        return np.linalg.solve(cyclic_entries(hessian, index[:, np.newaxis],
+                                              index), rhs)
+
+    # The band, and the corners as M on the first and last two points
+    band = (cyclic_entries(hessian, index, index),
+            cyclic_entries(hessian, index[:-1], index[1:]),
+            cyclic_entries(hessian, index[:-2], index[2:]))
+    ends = np.array([0, 1, num_free - 2, num_free - 1])
+    corners = cyclic_entries(hessian, index[ends, np.newaxis], index[ends])
+    corners[np.abs(ends[:, np.newaxis] - ends) <= 2] = 0
+
+    # x = y - Z (I + M Z[ends])^-1 M y[ends], with y and Z solved by the
+    # band alone for rhs and the unit vectors of the ends
+    columns = np.zeros((num_free, 5))
+    columns[:, 0] = rhs
+    columns[ends, np.arange(1, 5)] = 1
+    solved = banded_solve(*band, columns)
+    y, z = solved[:, 0], solved[:, 1:]
+    correction = np.linalg.solve(np.eye(4) + corners @ z[ends],
+                                 corners @ y[ends])
+
+    return y - z @ correction
+
+
+def solve_bounded(hessian, gradient, lower, upper):
+    '''
+    Minimise 1/2 s'Hs + g's with lower <= s <= upper by a primal-dual
+    interior point method, for a cyclic pentadiagonal H given by its
+    diagonals. Returns s and the number of iterations used. Raises
+    RuntimeError if it has not converged after MAX_ITERATIONS.
+    '''
+    diagonal, first_off, second_off = hessian
+
+    # Points with no room between their bounds stay on them, and the rest
+    # start midway with unit multipliers for both bounds
+    free = upper - lower > 0
+    s = np.where(free, (lower + upper) / 2, lower)
+    z_lower = np.ones(free.sum())
+    z_upper = np.ones(free.sum())
+    scale = max(1.0, np.abs(gradient).max())
+    if not free.any():
+        return s, 0
+
+    for iteration in range(1, MAX_ITERATIONS + 1):
+
+        # Stationarity, and the mean complementarity of the bounds
+        gap_lower = (s - lower)[free]
+        gap_upper = (upper - s)[free]
+        residual = ((cyclic_product(hessian, s) + gradient)[free]
+                    - z_lower + z_upper)
+        complementarity = (gap_lower @ z_lower
+                           + gap_upper @ z_upper) / (2 * len(gap_lower))
+        if (np.abs(residual).max() <= TOLERANCE * scale
+                and complementarity <= TOLERANCE):
+            return s, iteration
+
+        # Newton step towards the central path: one banded solve of H plus
+        # the curvature of the barrier of the bounds
+        target = CENTRING * complementarity
+        augmented = diagonal.copy()
+        augmented[free] += z_lower / gap_lower + z_upper / gap_upper
+        step = solve_free((augmented, first_off, second_off), free,
+                          target / gap_lower - z_lower
+                          - target / gap_upper + z_upper - residual)
+        step_lower = (target - z_lower * step) / gap_lower - z_lower
+        step_upper = (target + z_upper * step) / gap_upper - z_upper
+
+        # As far along it as keeps the gaps and multipliers positive
+        fraction = 1.0
+        for values, change in ((gap_lower, step), (gap_upper, -step),
+                               (z_lower, step_lower), (z_upper, step_upper)):
+            falling = change < 0
+            if falling.any():
+                fraction = min(fraction, BOUNDARY_FRACTION * np.min(
+                    -values[falling] / change[falling]))
+
+        s[free] += fraction * step
+        z_lower += fraction * step_lower
+        z_upper += fraction * step_upper
+
+    raise RuntimeError("The racing line did not converge in %d iterations"
+                       % MAX_ITERATIONS)
+
+
+def solve(data, margin=MARGIN):
+    '''
+    Racing line of an (N, 6) track array. Returns the (N, 2) line and its
+    signed lateral offset from the centreline at every waypoint.
+    '''
+    data = np.asarray(data, dtype=float)
+    centre = data[:, 0:2]
+    first = data[:, 2:4]
+    across = data[:, 4:6] - first
+
+    distinct, index, num_ring = ring_index(centre)
+    ring = np.flatnonzero(distinct)[:num_ring]
+
+    # Keep the line margin metres inside both borders
+    width = np.hypot(*across[ring].T)
+    lower = np.minimum(margin / width, 0.5)
+    upper = 1 - lower
+
+    hessian, gradient = curvature_system(centre[ring], first[ring],
+                                         across[ring])
+    s, _ = solve_bounded(hessian, gradient, lower, upper)
+
+    line = first + s[index, np.newaxis] * across
+
+    # Offset along the left normal of the centreline
+    tangent = np.roll(centre[ring], -1, axis=0) - centre[ring]
+    tangent = tangent[index]
+    normal = np.stack([-tangent[:, 1], tangent[:, 0]], axis=1)
+    normal /= np.hypot(*normal.T)[:, np.newaxis]
+    offset = np.sum((line - centre) * normal, axis=1)
+
+    return line, offset
+
+
+def cached_solution(track, margin=MARGIN):
+
+    # The line and its offsets as one (N, 3) array in the track's cache
+    def build(track):
+        line, offset = solve(track.data, margin)
+        return np.column_stack([line, offset])
+
+    return track.cached_array('racing_line_%g' % margin, build)
+
+
+def racing_line(track, margin=MARGIN):
+    '''
+    Cached (N, 2) racing line of a track from the registry.
+    '''
+    return cached_solution(track, margin)[:, 0:2]
+
+
+def racing_line_offsets(track, margin=MARGIN):
+    '''
+    Cached racing line offsets of a track from the registry, one per
+    waypoint.
+    '''
+    return cached_solution(track, margin)[:, 2]
+
+
+def distance_from_line(offsets, waypoints, closest_waypoints, x, y,
+                       distance_from_center, is_left_of_center):
+    '''
+    Distance of the car from the racing line across the track, from the
+    reward params. The line's offset is interpolated between the closest
+    waypoints. Works on single values and on NumPy columns alike.
+    '''
+    offsets = np.asarray(offsets)
+    waypoints = np.asarray(waypoints)
+    closest_waypoints = np.asarray(closest_waypoints)
+    prev_point = waypoints[closest_waypoints[..., 0]]
+    next_point = waypoints[closest_waypoints[..., 1]]
+
+    # Position of the car between the closest waypoints
+    segment = next_point - prev_point
+    length2 = np.sum(segment * segment, axis=-1)
+    along = np.sum((np.stack([x, y], axis=-1) - prev_point) * segment,
+                   axis=-1)
+    t = np.clip(along / np.where(length2 > 0, length2, 1), 0, 1)
+
+    line_offset = ((1 - t) * offsets[closest_waypoints[..., 0]]
+                   + t * offsets[closest_waypoints[..., 1]])
+    car_offset = np.where(is_left_of_center, distance_from_center,
+                          -np.asarray(distance_from_center))
+
+    return np.abs(car_offset - line_offset)
+
+
+def plot(track, line, headless=False):
+
+    fig, ax = new_figure(headless)
+    for border in (track.inner, track.outer):
+        ax.plot(border[:, 0], border[:, 1], color='#7f7f7f', linewidth=1)
+    ax.plot(track.centre[:, 0], track.centre[:, 1], color='#1f77b4',
+            linestyle='--', linewidth=1, label='Centreline')
+    ax.plot(line[:, 0], line[:, 1], color='#ff7f0e', label='Racing Line')
+    ax.set_aspect('equal')
+    ax.legend(loc='lower center', bbox_to_anchor=(0.5, -0.3), ncol=2)
+
+    return {'racing_line': fig}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--track', default=TRACK_FILE)
+    parser.add_argument('--margin', type=float, default=MARGIN,
+                        help="distance kept from the borders in metres")
+    parser.add_argument('--table', action='store_true',
+                        help="print the offsets as a Python list")
+    parser.add_argument('--output-dir',
+                        help="save the map as a PNG file in this directory "
+                             "instead of showing it")
+    parser.add_argument('--no-plot', action='store_true')
+    args = parser.parse_args()
+
+    track = load_track(args.track)
+    offsets = np.asarray(racing_line_offsets(track, args.margin))
+    print("%s: racing line offsets from %.3f to %.3f m"
+          % (track.name, offsets.min(), offsets.max()))
+
+    if args.table:
+        print(waypoint_table(offsets, 'RACING_LINE'))
+
+    if args.no_plot:
+        return
+
+    headless = args.output_dir is not None
+    figures = plot(track, racing_line(track, args.margin), headless)
+
+    if headless:
+        for path in save_figures(figures, args.output_dir, track.name):
+            print(path)
+    else:
+        show()
+
+
+if __name__ == '__main__':
+    main()
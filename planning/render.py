@@ -0,0 +1,108 @@
+'''
+Headless batch rendering of the planner maps.
+
+Renders the speed/straight maps of final_planner.py and the speed map of
+qualifier_planner.py for any number of tracks and parameter sets straight to
+PNG files, spread across a process pool. No display or interactive
+matplotlib backend is needed.
+
+Example:
+    python render.py --tracks Spain_track.npy ChampionshipCup2019_track.npy \\
+        --set TURN_THRESHOLD_SPEED=4,6,8 --set DIST_THRESHOLD=1:1.4:0.2 \\
+        --output-dir maps
+'''
+import argparse
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import final_planner
+import qualifier_planner
+from plotting import save_figures
+from sweep import check_steps, parse_values
+
+PLANNERS = {
+    'final': final_planner,
+    'qualifier': qualifier_planner,
+}
+
+
+def make_jobs(tracks, planners, settings, output_dir):
+
+    # One job per track, planner and combination of that planner's settings
+    jobs = []
+    for track_file, name in itertools.product(tracks, planners):
+        planner = PLANNERS[name]
+        swept = [(key, values) for key, values in settings.items()
+                 if key in planner.PARAMETERS]
+        for combination in itertools.product(*[v for k, v in swept]):
+            params = {k: value for (k, v), value in zip(swept, combination)}
+            jobs.append((name, track_file, params, output_dir))
+
+    return jobs
+
+
+def render_job(job):
+
+    name, track_file, params, output_dir = job
+    planner = PLANNERS[name]
+
+    waypoints = planner.load_waypoints(track_file)
+    figures = planner.render(waypoints, params, headless=True)
+
+    # Name the files after the track, planner and any swept settings
+    prefix = [os.path.splitext(os.path.basename(track_file))[0], name]
+    prefix += ['%s-%g' % (k.lower(), v) for k, v in sorted(params.items())]
+
+    return save_figures(figures, output_dir, '_'.join(prefix))
+
+
+def render_all(jobs, workers=None):
+
+    if len(jobs) == 1 or workers == 1:
+        return [path for job in jobs for path in render_job(job)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return [path for paths in executor.map(render_job, jobs)
+                for path in paths]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tracks', nargs='+',
+                        default=[final_planner.TRACK_FILE,
+                                 qualifier_planner.TRACK_FILE])
+    parser.add_argument('--planners', nargs='+', choices=sorted(PLANNERS),
+                        default=sorted(PLANNERS))
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='NAME=VALUES',
+                        help="planner parameter values, as a single value, "
+                             "a comma separated list or start:stop[:step]")
+    parser.add_argument('--output-dir', default='maps')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    settings = {}
+    try:
+        for setting in args.set:
+            key, values = setting.split('=', 1)
+            settings[key.upper()] = parse_values(values).tolist()
+            check_steps(key.upper(), settings[key.upper()])
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Each setting has to be a parameter of at least one of the planners
+    known = set().union(*[PLANNERS[name].PARAMETERS for name in args.planners])
+    unknown = sorted(set(settings) - known)
+    if unknown:
+        parser.error("not a parameter of %s: %s"
+                     % (' or '.join(args.planners), ', '.join(unknown)))
+
+    jobs = make_jobs(args.tracks, args.planners, settings, args.output_dir)
+    paths = render_all(jobs, workers=args.workers)
+    print("Rendered %d maps to %s" % (len(paths), args.output_dir))
+
+
+if __name__ == '__main__':
+    main()
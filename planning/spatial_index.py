@@ -0,0 +1,203 @@
+'''
+Spatial index over the segments of a track's centreline.
+
+Rebuilding params from logged or simulated positions needs the nearest
+centreline segment of every position. SpatialIndex lays a uniform grid over
+the track and stores, for each cell, the few segments that can be nearest
+to a point inside it, so a batch of positions is answered by one gather and
+a projection onto a handful of segments each, instead of a scan of every
+waypoint. The grid is built by rasterising each segment's bounding box,
+widened by the margin, into the cells it covers, so only the cells near a
+segment are compared with it. Positions outside the grid, or in a cell
+further than the margin from the line (such as the middle of the
+infield), fall back to the full scan.
+'''
+import numpy as np
+
+# Grid cell size and margin around the track covered by the grid
+CELL_SIZE = 0.25    # metres
+GRID_MARGIN = 2.0   # metres
+
+# Positions queried at once, bounding the temporary arrays
+CHUNK_SIZE = 2**13
+
+
+def project(x, y, start_x, start_y, delta_x, delta_y, inverse_length2):
+
+    # Project points (x and y of shape (M, 1)) onto candidate segments
+    # (M, K) and return the position along each segment (0 to 1), the
+    # offset from the projection and the squared distance to it
+    px = x - start_x
+    py = y - start_y
+    t = np.clip((px*delta_x + py*delta_y) * inverse_length2, 0, 1)
+    ex = px - t*delta_x
+    ey = py - t*delta_y
+
+    return t, ex, ey, ex*ex + ey*ey
+
+
+class SpatialIndex:
+    '''
+    Uniform grid over the segments of an (N, 2) line, from each point to
+    the next. Repeated points give empty segments, which are never returned.
+    '''
+
+    def __init__(self, points, cell_size=CELL_SIZE, margin=GRID_MARGIN):
+        points = np.asarray(points, dtype=float)
+        self.start = points[:-1]
+        self.delta = points[1:] - points[:-1]
+        self.segment_lengths = np.hypot(self.delta[:, 0], self.delta[:, 1])
+
+        # Components are kept in separate arrays, which gather faster
+        self.start_x, self.start_y = self.start.T.copy()
+        self.delta_x, self.delta_y = self.delta.T.copy()
+        with np.errstate(divide='ignore'):
+            self.inverse_length2 = np.where(self.segment_lengths > 0,
+                                            1 / self.segment_lengths**2, 0.0)
+        self.valid = np.flatnonzero(self.segment_lengths > 0)
+
+        # Grid covering the line and a margin around it
+        self.cell_size = cell_size
+        self.origin = points.min(axis=0) - margin
+        extent = points.max(axis=0) + margin - self.origin
+        self.shape = np.maximum(1, np.ceil(extent / cell_size)).astype(int)
+        num_cells = int(self.shape.prod())
+
+        # Pair every segment with the cells its bounding box, widened by the
+        # margin and a cell diagonal, overlaps
+        diagonal = cell_size*np.sqrt(2)
+        reach = margin + diagonal
+        valid = self.valid
+        low = np.minimum(points[:-1], points[1:])[valid] - reach
+        high = np.maximum(points[:-1], points[1:])[valid] + reach
+        first = np.clip(np.floor((low - self.origin) / cell_size).astype(int),
+                        0, self.shape - 1)
+        size = np.clip(np.floor((high - self.origin) / cell_size).astype(int),
+                       0, self.shape - 1) - first + 1
+        count = size[:, 0]*size[:, 1]
+        owner = np.repeat(np.arange(len(valid)), count)
+        k = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        cell_x = first[owner, 0] + k // size[owner, 1]
+        cell_y = first[owner, 1] + k % size[owner, 1]
+        cell = cell_x*self.shape[1] + cell_y
+        segment = valid[owner]
+
+        # Distance from each cell's centre to each of its segments
+        _, _, _, distance2 = project(
+            self.origin[0] + (cell_x + 0.5)*cell_size,
+            self.origin[1] + (cell_y + 0.5)*cell_size, self.start_x[segment],
+            self.start_y[segment], self.delta_x[segment],
+            self.delta_y[segment], self.inverse_length2[segment])
+        distance = np.sqrt(distance2)
+        nearest_distance = np.full(num_cells, np.inf)
+        np.minimum.at(nearest_distance, cell, distance)
+
+        # A point is at most half a diagonal from its cell centre, so the
+        # nearest segment to any point in a cell is within a diagonal of the
+        # segment nearest the centre. Every such segment was paired with the
+        # cell if that is within the reach; other cells aren't covered
+        self.covered = nearest_distance + diagonal <= reach
+        near = (distance <= nearest_distance[cell] + diagonal + 1e-9) & (
+            self.covered[cell])
+        cell = cell[near]
+        segment = segment[near]
+
+        # Lay each cell's candidates out in segment order in a row, padded to
+        # the same length by repeating its first one. Queries only read the
+        # first width[cell] of them, the count rounded up to a power of two
+        order = np.lexsort((segment, cell))
+        cell = cell[order]
+        segment = segment[order]
+        counts = np.bincount(cell, minlength=num_cells)
+        starts = np.cumsum(counts) - counts
+        self.width = np.where(self.covered, 2**np.ceil(
+            np.log2(np.maximum(counts, 1))).astype(int), 0)
+        padding = segment[np.minimum(starts, len(segment) - 1)]
+        self.candidates = np.repeat(padding[:, np.newaxis], counts.max(),
+                                    axis=1)
+        self.candidates[cell, np.arange(len(cell)) - starts[cell]] = segment
+
+    def cells(self, points):
+
+        # Flat cell index of each point, -1 outside the grid or in a cell it
+        # doesn't cover
+        cell = np.floor((points - self.origin) / self.cell_size).astype(int)
+        inside = np.all((cell >= 0) & (cell < self.shape), axis=1)
+        cell = np.where(inside, cell[:, 0]*self.shape[1] + cell[:, 1], -1)
+
+        return np.where(inside & self.covered[cell], cell, -1)
+
+    def query(self, points):
+        '''
+        Nearest segment of each of the (M, 2) points. Returns the segment
+        index, the position of the nearest point along the segment (0 at its
+        start, 1 at its end) and the signed distance to it, positive to the
+        left of the line.
+        '''
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        segment = np.empty(len(points), dtype=int)
+        t = np.empty(len(points))
+        offset = np.empty(len(points))
+
+        for first in range(0, len(points), CHUNK_SIZE):
+            chunk = slice(first, first + CHUNK_SIZE)
+            segment[chunk], t[chunk], offset[chunk] = self.query_chunk(
+                points[chunk])
+
+        return segment, t, offset
+
+    def query_chunk(self, points):
+
+        cell = self.cells(points)
+        inside = cell >= 0
+        segment = np.empty(len(points), dtype=int)
+        t = np.empty(len(points))
+        offset = np.empty(len(points))
+
+        # Points in cells with the same number of candidates are handled
+        # together, so few segments are compared away from tight corners
+        width = np.where(inside, self.width[cell], 0)
+        for group_width in np.unique(width[inside]):
+            group = width == group_width
+            segment[group], t[group], offset[group] = self.nearest(
+                points[group], self.candidates[cell[group], :group_width])
+
+        # Points off the grid are compared with every segment
+        outside = ~inside
+        if outside.any():
+            segment[outside], t[outside], offset[outside] = self.nearest(
+                points[outside], np.broadcast_to(
+                    self.valid, (outside.sum(), len(self.valid))))
+
+        return segment, t, offset
+
+    def nearest(self, points, candidates):
+
+        delta_x = self.delta_x[candidates]
+        delta_y = self.delta_y[candidates]
+        t, ex, ey, distance2 = project(
+            points[:, 0:1], points[:, 1:2], self.start_x[candidates],
+            self.start_y[candidates], delta_x, delta_y,
+            self.inverse_length2[candidates])
+
+        best = np.argmin(distance2, axis=1)[:, np.newaxis]
+
+        def pick(values):
+            return np.take_along_axis(values, best, axis=1)[:, 0]
+
+        # Distance to the nearest point, signed by the side of the segment
+        cross = pick(delta_x)*pick(ey) - pick(delta_y)*pick(ex)
+        offset = np.sqrt(pick(distance2))
+
+        return (pick(candidates), pick(t),
+                np.where(cross < 0, -offset, offset))
+
+    def query_brute_force(self, points):
+        '''
+        Same as query() by comparing every point with every segment, for
+        checking the index.
+        '''
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+
+        return self.nearest(points, np.broadcast_to(
+            self.valid, (len(points), len(self.valid))))
@@ -0,0 +1,176 @@
+'''
+Per-waypoint target speed profile.
+
+The fastest speed at each waypoint is limited by the lateral acceleration
+the car can hold through the curvature there, then by how fast it can
+accelerate out of slower waypoints behind it and brake for slower waypoints
+ahead of it. With the squared speed u, accelerating over a distance ds
+allows u to grow by at most 2*a*ds, so the forward pass is a running
+minimum of u - 2*a*s along the arc length s (and the backward pass the same
+in reverse). Both passes are single NumPy accumulations over three laps
+unrolled, of which the middle one is kept so the limits carry round the
+start line.
+
+Profiles are cached per track and parameters. A reward can score the speed
+with a lookup of the table at closest_waypoints[1] (see SPEED_PROFILE in
+reward_final.py, which --table prints a value for).
+
+Example:
+    python speed_profile.py --track Spain --line racing --table
+'''
+import argparse
+
+import numpy as np
+
+from plotting import new_figure, plot_values, save_figures, show
+from racing_line import racing_line
+from tracks import derive_geometry, load_track, waypoint_table
+
+TRACK_FILE = "Spain_track.npy"
+
+# Limits of the car
+MAX_LATERAL_ACCEL = 4.0     # m/s^2
+MAX_ACCEL = 2.0             # m/s^2
+MAX_BRAKE = 3.0             # m/s^2
+MIN_SPEED = 1.0             # m/s
+MAX_SPEED = 4.0             # m/s
+
+# Parameters that can be overridden
+PARAMETERS = {
+    'MAX_LATERAL_ACCEL': MAX_LATERAL_ACCEL,
+    'MAX_ACCEL': MAX_ACCEL,
+    'MAX_BRAKE': MAX_BRAKE,
+    'MIN_SPEED': MIN_SPEED,
+    'MAX_SPEED': MAX_SPEED,
+}
+
+# Lines the profile can follow
+LINES = ('centre', 'racing')
+
+
+def speed_profile_of(curvature, segment_lengths, params=None, closed=True):
+    '''
+    Target speed at each point of a line, from its curvature (1/m) and the
+    length of the segment leaving each point.
+    '''
+    params = dict(PARAMETERS, **(params or {}))
+    curvature = np.abs(np.asarray(curvature, dtype=float))
+    segment_lengths = np.asarray(segment_lengths, dtype=float)
+    num_points = len(curvature)
+
+    # Cornering limit
+    with np.errstate(divide='ignore'):
+        speed = np.sqrt(params['MAX_LATERAL_ACCEL'] / curvature)
+    limit = np.clip(speed, params['MIN_SPEED'], params['MAX_SPEED'])**2
+
+    # Unroll a loop into three laps, dropping the repeated start point
+    laps = 3 if closed else 1
+    points = num_points - 1 if closed else num_points
+    limit = np.tile(limit[:points], laps)
+    lengths = np.tile(segment_lengths[:points], laps)
+    s = np.concatenate([[0], np.cumsum(lengths[:-1])])
+
+    # Accelerating from the points behind, and braking for the points ahead
+    accel = 2 * params['MAX_ACCEL']
+    brake = 2 * params['MAX_BRAKE']
+    forward = np.minimum.accumulate(limit - accel*s) + accel*s
+    backward = (np.minimum.accumulate((forward + brake*s)[::-1])[::-1]
+                - brake*s)
+    speed = np.sqrt(backward)
+
+    if closed:
+        speed = np.append(speed[points:2*points], speed[points])
+
+    return speed
+
+
+def line_geometry(track, line):
+
+    # Curvature and segment lengths of the line the car follows
+    if line == 'centre':
+        return track.curvature, track.segment_lengths
+
+    geometry = derive_geometry(racing_line(track))
+    return geometry['curvature'], geometry['segment_lengths']
+
+
+def speed_profile(track, params=None, line='centre'):
+    '''
+    Cached target speed (m/s) at every waypoint of a track from the
+    registry, along the centreline or the racing line.
+    '''
+    params = dict(PARAMETERS, **(params or {}))
+    key = 'speed_profile_%s_%s' % (line, '_'.join(
+        '%g' % params[name] for name in sorted(PARAMETERS)))
+
+    def build(track):
+        curvature, segment_lengths = line_geometry(track, line)
+        return speed_profile_of(curvature, segment_lengths, params,
+                                track.closed)
+
+    return track.cached_array(key, build)
+
+
+def lap_time(speed, segment_lengths):
+
+    # Time to cover each segment at the mean of its end speeds
+    speed = np.asarray(speed)
+    mean_speed = (speed[:-1] + speed[1:]) / 2
+
+    return float(np.sum(np.asarray(segment_lengths)[:-1] / mean_speed))
+
+
+def plot(waypoints, speed, headless=False):
+
+    fig, ax = new_figure(headless)
+    plot_values(ax, waypoints, speed, 'Target Speed (m/s)', cmap='plasma')
+
+    return {'speed_profile': fig}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--track', default=TRACK_FILE)
+    parser.add_argument('--line', choices=LINES, default='centre')
+    for name, value in PARAMETERS.items():
+        parser.add_argument('--' + name.lower().replace('_', '-'),
+                            type=float, default=value, dest=name)
+    parser.add_argument('--table', action='store_true',
+                        help="print the profile as a Python list")
+    parser.add_argument('--output-dir',
+                        help="save the map as a PNG file in this directory "
+                             "instead of showing it")
+    parser.add_argument('--no-plot', action='store_true')
+    args = parser.parse_args()
+
+    track = load_track(args.track)
+    params = {name: getattr(args, name) for name in PARAMETERS}
+    speed = np.asarray(speed_profile(track, params, args.line))
+    _, segment_lengths = line_geometry(track, args.line)
+    seconds = lap_time(speed, segment_lengths)
+
+    print("%s: target speeds from %.2f to %.2f m/s" % (track.name,
+                                                       speed.min(),
+                                                       speed.max()))
+    print("Estimated lap time %.2f s (%d steps at 15 Hz)"
+          % (seconds, round(seconds * 15)))
+
+    if args.table:
+        print(waypoint_table(speed, 'SPEED_PROFILE', '%.2f'))
+
+    if args.no_plot:
+        return
+
+    headless = args.output_dir is not None
+    figures = plot(track.inner, speed, headless)
+
+    if headless:
+        for path in save_figures(figures, args.output_dir, track.name):
+            print(path)
+    else:
+        show()
+
+
+if __name__ == '__main__':
+    main()
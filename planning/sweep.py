@@ -0,0 +1,237 @@
+'''
+Parameter sweep for the planner thresholds.
+
+Evaluates every combination of a grid of planner parameters against a track
+and prints a compact table of per-configuration summaries, so that thousands
+of configurations can be compared without re-running the planners one at a
+time. The heading differences for every look-ahead in the grid are computed
+once, and each block of configurations is then classified in a single
+broadcasted comparison. Large grids are split across a process pool.
+
+Example:
+    python sweep.py final --future-step-speed 4:10 --turn-threshold-speed 2:12
+    python sweep.py qualifier --dist-threshold 0.8:1.6:0.1 --sort switches
+'''
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import final_planner
+import qualifier_planner
+from corners import identify_corners, identify_corners_ahead
+
+# Swept parameters for each planner, with the values used in the planners
+PARAMETERS = {
+    'final': tuple(final_planner.PARAMETERS.items()),
+    'qualifier': tuple(qualifier_planner.PARAMETERS.items()),
+}
+
+PLANNERS = {
+    'final': final_planner,
+    'qualifier': qualifier_planner,
+}
+
+# Number of configuration/waypoint pairs classified at once
+CHUNK_ELEMENTS = 2**22
+
+
+def parse_values(text):
+
+    # Accept a single value, a comma separated list or an inclusive
+    # start:stop[:step] range. Raises ValueError if that gives no values
+    if ':' in text:
+        parts = [float(p) for p in text.split(':')]
+        start, stop = parts[0], parts[1]
+        step = parts[2] if len(parts) > 2 else 1
+        if step <= 0:
+            raise ValueError("the step of %s isn't positive" % text)
+        values = np.arange(start, stop + step/2, step)
+    else:
+        values = np.array([float(p) for p in text.split(',')])
+
+    if not len(values):
+        raise ValueError("%s gives no values" % text)
+
+    return np.round(values, 6)
+
+
+def check_steps(name, values):
+
+    # Look-aheads in steps count waypoints, so have to be whole numbers from
+    # 1 rather than be truncated by the planners. Raises ValueError if not
+    values = np.asarray(values, dtype=float)
+    if 'STEP' in name and not np.all((values >= 1)
+                                     & (values == np.round(values))):
+        raise ValueError("%s takes whole numbers of waypoints from 1, not "
+                         "%s" % (name, ', '.join('%g' % v for v in values)))
+
+
+def circular_longest_run(mask):
+
+    # Longest run of True in each row, where rows wrap around the track
+    num_waypoints = mask.shape[1]
+    doubled = np.concatenate([mask, mask], axis=1)
+    count = np.cumsum(doubled, axis=1)
+    last_reset = np.maximum.accumulate(np.where(doubled, 0, count), axis=1)
+
+    return np.minimum((count - last_reset).max(axis=1), num_waypoints)
+
+
+def summarise(mode, configs, steps, diff_heading, dist_future,
+              distances=(), diff_ahead=None):
+    '''
+    Classify the track for each row of configs (one column per parameter in
+    PARAMETERS[mode]) and summarise the result. diff_heading and dist_future
+    hold one row per look-ahead in steps, and diff_ahead one row per
+    look-ahead in metres in distances, for the qualifier's FUTURE_DIST
+    (NaN in configs when it isn't set).
+    '''
+    def row(column):
+        return np.searchsorted(steps, configs[:, column].astype(int))
+
+    summary = {}
+
+    if mode == 'final':
+        fast = diff_heading[row(0)] < configs[:, 1, np.newaxis]
+        straight = diff_heading[row(2)] < configs[:, 3, np.newaxis]
+        summary['straight'] = straight.mean(axis=1)
+    else:
+        no_corner = diff_heading[row(0)] < configs[:, 2, np.newaxis]
+        corner_far = dist_future[row(0)] >= configs[:, 3, np.newaxis]
+        no_corner_mid = diff_heading[row(1)] < configs[:, 2, np.newaxis]
+        bonus = ~no_corner & corner_far & no_corner_mid
+        fast = no_corner | bonus
+
+        # With FUTURE_DIST, a single check at that distance instead
+        ahead = ~np.isnan(configs[:, 4])
+        if ahead.any():
+            rows = np.searchsorted(distances, configs[ahead, 4])
+            fast[ahead] = diff_ahead[rows] < configs[ahead, 2, np.newaxis]
+            bonus[ahead] = False
+        summary['bonus_fast'] = bonus.mean(axis=1)
+
+    summary['fast'] = fast.mean(axis=1)
+    summary['slow'] = 1 - summary['fast']
+    summary['switches'] = np.count_nonzero(fast != np.roll(fast, 1, axis=1),
+                                           axis=1)
+    summary['longest_fast'] = circular_longest_run(fast)
+
+    return summary
+
+
+def sweep(mode, waypoints, grid, workers=None):
+    '''
+    Evaluate every combination of the values in grid, a dict mapping each
+    parameter name of PARAMETERS[mode] to a sequence of values.
+
+    Returns a dict of columns: one per parameter followed by the summaries.
+    Raises ValueError if a look-ahead in steps isn't a positive whole
+    number.
+    '''
+    names = [name for name, default in PARAMETERS[mode]]
+    for name in names:
+        check_steps(name, grid[name])
+    configs = np.array(list(itertools.product(*[grid[n] for n in names])),
+                       dtype=float)
+
+    # Corners for every look-ahead in the grid, calculated once
+    step_names = [n for n in names if 'STEP' in n]
+    steps = np.unique(np.concatenate([grid[n] for n in step_names])
+                      .astype(int))
+    diff_heading, dist_future = identify_corners(waypoints, steps)
+
+    # And for every look-ahead distance, if any
+    distances = np.unique(grid.get('FUTURE_DIST', np.array([np.nan])))
+    distances = distances[~np.isnan(distances)]
+    diff_ahead = None
+    if len(distances):
+        diff_ahead, _ = identify_corners_ahead(waypoints, distances)
+
+    chunk = max(1, CHUNK_ELEMENTS // len(waypoints))
+    chunks = [configs[i:i + chunk] for i in range(0, len(configs), chunk)]
+    args = (steps, diff_heading, dist_future, distances, diff_ahead)
+
+    if len(chunks) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(summarise, mode, c, *args)
+                       for c in chunks]
+            parts = [f.result() for f in futures]
+    else:
+        parts = [summarise(mode, c, *args) for c in chunks]
+
+    results = {name: configs[:, i] for i, name in enumerate(names)}
+    for key in parts[0]:
+        results[key] = np.concatenate([p[key] for p in parts])
+
+    return results
+
+
+def format_table(results, sort=None, limit=None):
+
+    columns = list(results)
+    order = np.arange(len(results[columns[0]]))
+    if sort is not None:
+        order = np.argsort(-results[sort], kind='stable')
+    if limit is not None:
+        order = order[:limit]
+
+    widths = [max(len(c), 8) for c in columns]
+    lines = [' '.join(c.rjust(w) for c, w in zip(columns, widths))]
+    for i in order:
+        cells = []
+        for c, w in zip(columns, widths):
+            value = results[c][i]
+            if float(value).is_integer():
+                cells.append(('%d' % value).rjust(w))
+            else:
+                cells.append(('%.3f' % value).rjust(w))
+        lines.append(' '.join(cells))
+
+    return '\n'.join(lines)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('mode', choices=sorted(PARAMETERS))
+    parser.add_argument('--track', help="track .npy file")
+    for mode in PARAMETERS:
+        for name, default in PARAMETERS[mode]:
+            parser.add_argument('--' + name.lower().replace('_', '-'),
+                                dest=name, default=None,
+                                help="%s values (default %s)" % (mode,
+                                                                 default))
+    parser.add_argument('--sort', help="sort by this column, descending")
+    parser.add_argument('--limit', type=int, default=50,
+                        help="rows to print (default 50)")
+    parser.add_argument('--csv', help="also write every row to this file")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="worker processes for large grids")
+    args = parser.parse_args()
+
+    planner = PLANNERS[args.mode]
+    waypoints = planner.load_waypoints(args.track or planner.TRACK_FILE)
+
+    try:
+        grid = {}
+        for name, default in PARAMETERS[args.mode]:
+            value = getattr(args, name)
+            grid[name] = (parse_values(value) if value is not None
+                          else np.array([default], dtype=float))
+        results = sweep(args.mode, waypoints, grid, workers=args.workers)
+    except ValueError as e:
+        parser.error(str(e))
+    print(format_table(results, sort=args.sort, limit=args.limit))
+    print("%d configurations" % len(results['fast']))
+
+    if args.csv:
+        columns = list(results)
+        np.savetxt(args.csv, np.column_stack([results[c] for c in columns]),
+                   delimiter=',', header=','.join(columns), comments='',
+                   fmt='%.6g')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+'''
+Track registry.
+
+Tracks are the (N, 6) arrays in this directory, holding the centreline
+followed by the inner and outer borders of each waypoint (the layout used by
+the waypoint-visualization repository they came from). load_track() memory
+maps the .npy file and pairs it with a sidecar cache of derived geometry for
+the centreline, so every tool reads the same zero-copy views instead of
+loading and recomputing them.
+
+The cache lives in a .track_cache directory next to the track file and is
+keyed by a hash of the file contents. It is only rebuilt when the file
+changes.
+'''
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from geometry import lookahead_steps
+from spatial_index import SpatialIndex
+
+TRACK_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = '.track_cache'
+
+# Derived geometry stored in the cache, one value per waypoint
+GEOMETRY = ('headings', 'segment_lengths', 'arc_length', 'curvature',
+            'width')
+
+# Tracks already opened by this process, keyed by path, size and mtime
+LOADED_TRACKS = {}
+
+
+class Track:
+    '''
+    A memory mapped track and its cached geometry.
+
+    centre, inner and outer are (N, 2) views of the track file. headings
+    (degrees), segment_lengths (from each waypoint to the next), arc_length
+    (from the first waypoint), curvature (signed, 1/m, positive when turning
+    left) and width are per-waypoint arrays for the centreline. Note the
+    planners have always plotted the inner border, columns 2:4.
+    '''
+
+    def __init__(self, name, path, digest, data, geometry):
+        self.name = name
+        self.path = path
+        self.digest = digest
+        self.data = data
+        self.centre = data[:, 0:2]
+        self.inner = data[:, 2:4]
+        self.outer = data[:, 4:6]
+        for key in GEOMETRY:
+            setattr(self, key, geometry[key])
+
+        # Tracks are loops that repeat their first waypoint at the end
+        self.closed = bool(np.allclose(self.centre[0], self.centre[-1]))
+        self.length = float(self.arc_length[-1])
+        self.lookahead_tables = {}
+        self.index = None
+
+    def lookahead_steps(self, distance):
+        '''
+        Per-waypoint table of how many waypoints ahead the first waypoint at
+        least distance metres along the centreline is, stopping at the last
+        waypoint as the corner test does. Tables are built on first use and
+        kept for the life of the track.
+        '''
+        if distance not in self.lookahead_tables:
+            self.lookahead_tables[distance] = np.array(
+                lookahead_steps(self.arc_length.tolist(), distance))
+
+        return self.lookahead_tables[distance]
+
+    def spatial_index(self):
+        '''
+        Spatial index over the centreline segments, built on first use.
+        '''
+        if self.index is None:
+            self.index = SpatialIndex(self.centre)
+
+        return self.index
+
+    def cached_array(self, key, build):
+        '''
+        An array derived from the track, kept in its cache directory under
+        key (which should include any parameters it depends on) and memory
+        mapped from there. build(track) is only called when the cache has
+        no such array.
+        '''
+        path = os.path.join(cache_directory(self.path, self.digest),
+                            key + '.npy')
+        if not os.path.exists(path):
+            write_array(path, build(self))
+
+        return np.load(path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return "Track(%r, %d waypoints, %.2f m)" % (self.name, len(self),
+                                                    self.length)
+
+
+def track_path(name):
+
+    # Accept a path, a file name in this directory or just the track name,
+    # e.g. "Spain" for Spain_track.npy
+    for candidate in (name, os.path.join(TRACK_DIR, name),
+                      os.path.join(TRACK_DIR, name + '.npy'),
+                      os.path.join(TRACK_DIR, name + '_track.npy')):
+        if os.path.isfile(candidate):
+            return os.path.abspath(candidate)
+
+    raise FileNotFoundError("No track file found for %r" % name)
+
+
+def available_tracks(directory=TRACK_DIR):
+
+    return sorted(os.path.splitext(f)[0] for f in os.listdir(directory)
+                  if f.endswith('.npy'))
+
+
+def file_digest(path):
+
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def derive_geometry(points):
+    '''
+    Headings, segment lengths, arc length and curvature of an (N, 2) line.
+    Repeated consecutive points share the geometry of the point they repeat,
+    and a line whose last point repeats its first is treated as a loop.
+    '''
+    points = np.asarray(points, dtype=float)
+    num_points = len(points)
+
+    # Arc length along the points as given
+    lengths = np.hypot(*np.diff(points, axis=0).T)
+    arc_length = np.concatenate([[0], np.cumsum(lengths)])
+    closed = num_points > 2 and np.allclose(points[0], points[-1])
+    segment_lengths = np.append(lengths, lengths[0] if closed else 0)
+
+    # Headings and curvature come from the distinct points, then are mapped
+    # back to every index
+    distinct = np.concatenate([[True], lengths > 0])
+    unique_index = np.cumsum(distinct) - 1
+    ring = points[distinct]
+    if closed:
+        ring = ring[:-1]
+        unique_index[unique_index == len(ring)] = 0
+
+    if closed:
+        point_prev = np.roll(ring, 1, axis=0)
+        point_next = np.roll(ring, -1, axis=0)
+    else:
+        point_prev = np.concatenate([ring[:1], ring[:-1]])
+        point_next = np.concatenate([ring[1:], ring[-1:]])
+
+    # Heading of the segment leaving each point (entering it at the end of
+    # an open line)
+    delta = point_next - ring
+    if not closed:
+        delta[-1] = ring[-1] - point_prev[-1]
+    headings = np.degrees(np.arctan2(delta[:, 1], delta[:, 0]))
+
+    # Signed curvature of the circle through each point and its neighbours
+    a = ring - point_prev
+    b = point_next - ring
+    cross = a[:, 0]*b[:, 1] - a[:, 1]*b[:, 0]
+    denominator = (np.hypot(*a.T) * np.hypot(*b.T)
+                   * np.hypot(*(point_next - point_prev).T))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        curvature = np.where(denominator > 0, 2*cross/denominator, 0.0)
+
+    return {
+        'headings': headings[unique_index],
+        'segment_lengths': segment_lengths,
+        'arc_length': arc_length,
+        'curvature': curvature[unique_index],
+    }
+
+
+def build_geometry(data):
+
+    geometry = derive_geometry(data[:, 0:2])
+    geometry['width'] = np.hypot(*(data[:, 2:4] - data[:, 4:6]).T)
+
+    return geometry
+
+
+def cache_directory(path, digest):
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(os.path.dirname(path), CACHE_DIR,
+                        '%s-%s' % (stem, digest[:16]))
+
+
+def write_cache(directory, arrays):
+
+    # Write into a temporary directory then move it into place, so other
+    # processes never see a partial cache
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=parent)
+    for key, value in arrays.items():
+        np.save(os.path.join(staging, key + '.npy'), value)
+
+    try:
+        os.rename(staging, directory)
+    except OSError:
+        # Another process got there first
+        shutil.rmtree(staging)
+
+
+def write_array(path, array):
+
+    # Save next to the destination then move it into place, so other
+    # processes never see a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle, staging = tempfile.mkstemp(dir=os.path.dirname(path),
+                                       suffix='.npy')
+    with os.fdopen(handle, 'wb') as f:
+        np.save(f, array)
+    os.replace(staging, path)
+
+
+def remove_stale_caches(directory):
+
+    # Drop caches left behind by earlier versions of the same track file
+    parent, current = os.path.split(directory)
+    stem = current.rsplit('-', 1)[0]
+    for entry in os.listdir(parent):
+        if entry != current and entry.rsplit('-', 1)[0] == stem:
+            shutil.rmtree(os.path.join(parent, entry), ignore_errors=True)
+
+
+def load_cached(directory, keys):
+
+    return {key: np.load(os.path.join(directory, key + '.npy'),
+                         mmap_mode='r')
+            for key in keys}
+
+
+def load_track(name):
+    '''
+    Load a track by name or path, building its geometry cache if the file
+    is new or has changed.
+    '''
+    path = track_path(name)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key in LOADED_TRACKS:
+        return LOADED_TRACKS[key]
+
+    digest = file_digest(path)
+    data = np.load(path, mmap_mode='r')
+
+    directory = cache_directory(path, digest)
+    if not all(os.path.exists(os.path.join(directory, k + '.npy'))
+               for k in GEOMETRY):
+        shutil.rmtree(directory, ignore_errors=True)
+        write_cache(directory, build_geometry(data))
+        remove_stale_caches(directory)
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    track = Track(stem, path, digest, data, load_cached(directory, GEOMETRY))
+    LOADED_TRACKS[key] = track
+
+    return track
+
+
+def waypoint_table(values, name, fmt='%.3f'):
+    '''
+    Python literal assigning a per-waypoint table to name, for pasting into
+    a reward function, which cannot read the track files.
+    '''
+    values = [fmt % value for value in values]
+    lines = ['%s = [' % name]
+    for first in range(0, len(values), 10):
+        lines.append('    ' + ', '.join(values[first:first + 10]) + ',')
+    lines.append(']')
+
+    return '\n'.join(lines)
@@ -1,3 +1,110 @@
+import math
+import numpy as np
+
+# Steering penality threshold, based on action space
+ABS_STEERING_THRESHOLD = 15
+
+# Incentivising target heading using waypoint method
+FUTURE_STEP = 5
+
+
+# BEGIN geometry.py
+# Copied from planning/geometry.py by tools/bundle_rewards.py: edit it
+# there and re-run the bundler.
+
+
+def identify_corner(waypoints, closest_waypoints, future_step):
+
+    # Identify next waypoint and a further waypoint
+    point_prev = waypoints[closest_waypoints[0]]
+    point_next = waypoints[closest_waypoints[1]]
+    point_future = waypoints[min(len(waypoints) - 1,
+                                 closest_waypoints[1] + future_step)]
+
+    # Headings back to the previous waypoint from the next one and from the
+    # further one, and the angle between them. This runs on every step, so
+    # heading_between(), angle_difference() and distance() are written out
+    heading_current = math.degrees(math.atan2(point_prev[1] - point_next[1],
+                                              point_prev[0] - point_next[0]))
+    heading_future = math.degrees(math.atan2(point_prev[1] - point_future[1],
+                                             point_prev[0] - point_future[0]))
+    diff_heading = abs(heading_current - heading_future)
+    if diff_heading > 180:
+        diff_heading = 360 - diff_heading
+
+    # Distance to further waypoint
+    dx = point_future[0] - point_next[0]
+    dy = point_future[1] - point_next[1]
+    dist_future = math.sqrt(dx*dx + dy*dy)
+
+    return diff_heading, dist_future
+
+
+# END geometry.py
+
+
+# BEGIN geometry_numpy.py
+# Copied from planning/geometry_numpy.py by tools/bundle_rewards.py,
+# with _batch added to the names: edit it there and re-run the bundler.
+
+
+def heading_between_batch(x0, y0, x1, y1):
+
+    # Direction from (x0, y0) to (x1, y1) in degrees, from -180 to 180
+    return np.degrees(np.arctan2(np.subtract(y1, y0), np.subtract(x1, x0)))
+
+
+def angle_difference_batch(heading_a, heading_b):
+
+    # Difference between two headings, avoiding the reflex angle
+    diff = np.abs(np.subtract(heading_a, heading_b))
+    return np.where(diff > 180, 360 - diff, diff)
+
+
+def distance_batch(x0, y0, x1, y1):
+
+    dx = np.subtract(x1, x0)
+    dy = np.subtract(y1, y0)
+    return np.sqrt(dx*dx + dy*dy)
+
+
+def future_index_batch(num_waypoints, next_index, steps):
+
+    # The waypoint steps after the next one, stopping at the last waypoint
+    return np.minimum(num_waypoints - 1, np.add(next_index, steps))
+
+
+def identify_corner_batch(waypoints, closest_waypoints, future_step):
+    '''
+    identify_corner() of geometry.py for an (M, 2) array of
+    closest_waypoints pairs. future_step may be a single look-ahead, giving
+    (M,) arrays, or an array that broadcasts against the pairs, e.g. one
+    look-ahead per row of shape (S, 1), giving (S, M) arrays.
+    '''
+    waypoints = np.asarray(waypoints, dtype=float)
+    closest_waypoints = np.asarray(closest_waypoints, dtype=int)
+    point_prev = waypoints[closest_waypoints[:, 0]]
+    point_next = waypoints[closest_waypoints[:, 1]]
+    point_future = waypoints[future_index_batch(
+        len(waypoints), closest_waypoints[:, 1], future_step)]
+
+    diff_heading = angle_difference_batch(
+        heading_between_batch(
+            point_next[:, 0], point_next[:, 1],
+            point_prev[:, 0], point_prev[:, 1]),
+        heading_between_batch(
+            point_future[..., 0], point_future[..., 1],
+            point_prev[:, 0], point_prev[:, 1]))
+    dist_future = distance_batch(
+        point_next[:, 0], point_next[:, 1],
+        point_future[..., 0], point_future[..., 1])
+
+    return diff_heading, dist_future
+
+
+# END geometry_numpy.py
+
+
 def reward_function(params):
     '''
     Reward function for AWS DeepRacer
@@ -15,8 +122,6 @@ def reward_function(params):
     August 2020
     '''
 
-    import math
-
     # Read input parameters
     closest_waypoints = params['closest_waypoints']
     distance_from_center = params['distance_from_center']
@@ -50,45 +155,15 @@ def reward_function(params):
     else:
         reward = 1e-3 # likely crashed/ close to off track
 
-    # Steering penality threshold, based on action space
-    ABS_STEERING_THRESHOLD = 15
-
     # Penalize reward if the agent is steering too much
     if steering > ABS_STEERING_THRESHOLD:
         reward *= 0.8
 
     reward *= (progress/steps)*2
 
-    # Incentivising target heading using waypoint method
-    FUTURE_STEP = 5
-
-    # Identify next waypoint and further waypoint
-    point_prev = waypoints[closest_waypoints[0]]
-    point_next = waypoints[closest_waypoints[1]]
-    point_future = waypoints[min(len(waypoints) - 1, 
-                                 closest_waypoints[1] + FUTURE_STEP)]
-
-    # Calculate headings to waypoints
-    heading_current = math.degrees(math.atan2(point_prev[1] - point_next[1], 
-                                              point_prev[0] - point_next[0]))
-    heading_future = math.degrees(math.atan2(point_prev[1] - point_future[1], 
-                                             point_prev[0] - point_future[0]))
-
-    # Circular Heading Calculations
-    if heading_current > heading_future and 
-       heading_current - heading_future > 180:
-        heading_offset = 180-heading_current
-        heading_current = -180
-        heading_future += heading_offset
-
-    elif heading_future > heading_current and 
-         heading_future - heading_current > 180:
-        heading_offset = 180-heading_future
-        heading_future = -180
-        heading_current += heading_offset
-
-    # Calculate the difference between the headings
-    diff_heading = abs(heading_current - heading_future)
+    # Difference between the headings of the track now and further ahead
+    diff_heading, _ = identify_corner(waypoints, closest_waypoints,
+                                      FUTURE_STEP)
 
     if diff_heading < 10 and speed > 2.5:
         reward *= 1.5
@@ -97,3 +172,41 @@ def reward_function(params):
         reward *= 1.5
 
     return float(reward)
+
+
+def reward_function_batch(params):
+    '''
+    Vectorised reward_function. Takes a NumPy column per parameter, with
+    track_width and waypoints shared by all steps, and returns the rewards.
+    '''
+
+    # Read input parameters
+    closest_waypoints = np.asarray(params['closest_waypoints'], dtype=int)
+    distance_from_center = np.asarray(params['distance_from_center'],
+                                      dtype=float)
+    is_offtrack = np.asarray(params['is_offtrack'], dtype=bool)
+    progress = np.asarray(params['progress'], dtype=float)
+    speed = np.asarray(params['speed'], dtype=float)
+    steering = np.abs(np.asarray(params['steering_angle'], dtype=float))
+    steps = np.asarray(params['steps'])
+    track_width = params['track_width']
+    waypoints = np.asarray(params['waypoints'], dtype=float)
+
+    # Centre line markers
+    reward = np.select([distance_from_center <= 0.1 * track_width,
+                        distance_from_center <= 0.25 * track_width,
+                        distance_from_center <= 0.5 * track_width],
+                       [1.0, 0.5, 0.1], 1e-3)
+
+    reward = np.where(steering > ABS_STEERING_THRESHOLD, reward * 0.8, reward)
+    reward = reward * ((progress/steps)*2)
+
+    # Difference between the headings of the track now and further ahead
+    diff_heading, _ = identify_corner_batch(waypoints, closest_waypoints,
+                                            FUTURE_STEP)
+
+    reward = np.where((diff_heading < 10) & (speed > 2.5), reward * 1.5, reward)
+    reward = np.where((diff_heading > 10) & (speed < 2.5), reward * 1.5, reward)
+
+    # Strongly discourage going off track
+    return np.where(is_offtrack, 1e-3, reward)
@@ -1,3 +1,62 @@
+import math
+import numpy as np
+
+# Multipliers used in calculating the weighting of the two headings for
+# the weighted average target
+AB_MULTIPLIER = 0.7
+BC_MULTIPLIER = 0.3
+
+FUTURE_STEP = 5
+
+
+# BEGIN geometry.py
+# Copied from planning/geometry.py by tools/bundle_rewards.py: edit it
+# there and re-run the bundler.
+
+
+def heading_between(x0, y0, x1, y1):
+
+    # Direction from (x0, y0) to (x1, y1) in degrees, from -180 to 180
+    return math.degrees(math.atan2(y1 - y0, x1 - x0))
+
+
+def distance(x0, y0, x1, y1):
+
+    dx = x1 - x0
+    dy = y1 - y0
+    return math.sqrt(dx*dx + dy*dy)
+
+
+# END geometry.py
+
+
+# BEGIN geometry_numpy.py
+# Copied from planning/geometry_numpy.py by tools/bundle_rewards.py,
+# with _batch added to the names: edit it there and re-run the bundler.
+
+
+def heading_between_batch(x0, y0, x1, y1):
+
+    # Direction from (x0, y0) to (x1, y1) in degrees, from -180 to 180
+    return np.degrees(np.arctan2(np.subtract(y1, y0), np.subtract(x1, x0)))
+
+
+def distance_batch(x0, y0, x1, y1):
+
+    dx = np.subtract(x1, x0)
+    dy = np.subtract(y1, y0)
+    return np.sqrt(dx*dx + dy*dy)
+
+
+def future_index_batch(num_waypoints, next_index, steps):
+
+    # The waypoint steps after the next one, stopping at the last waypoint
+    return np.minimum(num_waypoints - 1, np.add(next_index, steps))
+
+
+# END geometry_numpy.py
+
+
 def reward_function(params):
     '''
     Reward function for AWS DeepRacer
@@ -16,16 +75,6 @@ def reward_function(params):
     Authors: Matthew Suntup, Georgia Markham, Ashan Abey
     August 2020
     '''
-    
-    import math
-    import numpy as np
-    
-    # Multipliers used in calculating the weighting of the two headings for
-    # the weighted average target
-    AB_MULTIPLIER = 0.7
-    BC_MULTIPLIER = 0.3
-
-    FUTURE_STEP = 5
 
     # Read input parameters
     all_wheels_on_track = params['all_wheels_on_track']
@@ -49,13 +98,13 @@ def reward_function(params):
                             closest_waypoints[1] + FUTURE_STEP)]
     
     # Calculate headings to waypoints
-    ab_heading = math.degrees(math.atan2(point_b[1] - y, point_b[0] - x))
-    bc_heading = math.degrees(math.atan2(point_c[1] - point_b[1], 
-                                         point_c[0] - point_b[0]))
+    ab_heading = heading_between(x, y, point_b[0], point_b[1])
+    bc_heading = heading_between(point_b[0], point_b[1],
+                                 point_c[0], point_c[1])
     
     # Calculate distance to waypoints
-    ab_dist = np.linalg.norm([x-point_b[0],y-point_b[1]])
-    ac_dist = np.linalg.norm([x-point_c[0],y-point_c[1]])
+    ab_dist = distance(x, y, point_b[0], point_b[1])
+    ac_dist = distance(x, y, point_c[0], point_c[1])
 
     # Weigh next waypoint proportionally with distance
     ab_weight = ab_dist * AB_MULTIPLIER
@@ -102,4 +151,69 @@ def reward_function(params):
     if reward <= 1e-3:
         reward = 1e-3
     
-    return float(reward)
\ No newline at end of file
+    return float(reward)
+
+
+def reward_function_batch(params):
+    '''
+    Vectorised reward_function. Takes a NumPy column per parameter, with
+    waypoints shared by all steps, and returns an array of rewards.
+    '''
+
+    # Read input parameters
+    all_wheels_on_track = np.asarray(params['all_wheels_on_track'], dtype=bool)
+    closest_waypoints = np.asarray(params['closest_waypoints'], dtype=int)
+    heading = np.asarray(params['heading'], dtype=float)
+    is_offtrack = np.asarray(params['is_offtrack'], dtype=bool)
+    speed = np.asarray(params['speed'], dtype=float)
+    waypoints = np.asarray(params['waypoints'], dtype=float)
+    x = np.asarray(params['x'], dtype=float)
+    y = np.asarray(params['y'], dtype=float)
+
+    # Identify next waypoint and further waypoint
+    point_b = waypoints[closest_waypoints[:, 1]]
+    point_c = waypoints[future_index_batch(len(waypoints),
+                                           closest_waypoints[:, 1],
+                                           FUTURE_STEP)]
+
+    # Calculate headings to waypoints
+    ab_heading = heading_between_batch(x, y, point_b[:, 0], point_b[:, 1])
+    bc_heading = heading_between_batch(point_b[:, 0], point_b[:, 1],
+                                       point_c[:, 0], point_c[:, 1])
+
+    # Calculate distance to waypoints
+    ab_dist = distance_batch(x, y, point_b[:, 0], point_b[:, 1])
+    ac_dist = distance_batch(x, y, point_c[:, 0], point_c[:, 1])
+
+    ab_weight = ab_dist * AB_MULTIPLIER
+    bc_weight = 1/ac_dist * BC_MULTIPLIER
+
+    # Circular Heading Calculations, shifting whichever heading wraps
+    ab_wraps = (ab_heading > bc_heading) & (ab_heading - bc_heading > 180)
+    bc_wraps = (bc_heading > ab_heading) & (bc_heading - ab_heading > 180)
+    heading_offset = np.where(ab_wraps, 180 - ab_heading, 180 - bc_heading)
+    wraps = ab_wraps | bc_wraps
+
+    ab_heading, bc_heading = (
+        np.where(ab_wraps, -180.0,
+                 np.where(bc_wraps, ab_heading + heading_offset, ab_heading)),
+        np.where(bc_wraps, -180.0,
+                 np.where(ab_wraps, bc_heading + heading_offset, bc_heading)))
+    shifted = heading + heading_offset
+    heading = np.where(wraps & (shifted > 180), 360 - shifted,
+                       np.where(wraps, shifted, heading))
+
+    # Calculate weighted average of headings
+    tot_weight = ab_weight + bc_weight
+    goal_heading = (ab_heading*ab_weight + bc_heading*bc_weight)/tot_weight
+
+    # Calculate heading error
+    err_heading = np.abs(goal_heading - heading)
+    err_heading = np.where(err_heading >= 180, 180 - err_heading, err_heading)
+
+    # Apply reward function to heading error, scaled by speed
+    reward = (-1/(180**2)*err_heading**2 + 1)*speed
+    reward = np.where(reward <= 1e-3, 1e-3, reward)
+
+    # Strongly discourage going off track
+    return np.where(~all_wheels_on_track | is_offtrack, 1e-3, reward)
@@ -1,3 +1,11 @@
+import numpy as np
+
+# Parameters for speed incentive
+STEERING_THRESHOLD = 10 # degrees
+SPEED_THRESHOLD = 2     # m/s
+SPEED_MAX = 4           # m/s (for normalisation)
+
+
 def reward_function(params):
     '''
     Reward function for AWS DeepRacer
@@ -10,11 +18,6 @@ def reward_function(params):
     Authors: Matthew Suntup, Georgia Markham, Ashan Abey
     August 2020
     '''
-    
-    # Parameters for speed incentive
-    STEERING_THRESHOLD = 10 # degrees
-    SPEED_THRESHOLD = 2     # m/s
-    SPEED_MAX = 4           # m/s (for normalisation)
 
     # Read input parameters
     all_wheels_on_track = params['all_wheels_on_track']
@@ -37,4 +40,30 @@ def reward_function(params):
     if abs(steering_angle) < STEERING_THRESHOLD and speed > SPEED_THRESHOLD:
         reward += speed/SPEED_MAX
       
-    return float(reward)
\ No newline at end of file
+    return float(reward)
+
+
+def reward_function_batch(params):
+    '''
+    Vectorised reward_function, taking a NumPy column per parameter (one
+    value per step) and returning an array of rewards.
+    '''
+
+    # Read input parameters
+    all_wheels_on_track = np.asarray(params['all_wheels_on_track'], dtype=bool)
+    distance_from_center = np.asarray(params['distance_from_center'],
+                                      dtype=float)
+    is_offtrack = np.asarray(params['is_offtrack'], dtype=bool)
+    speed = np.asarray(params['speed'], dtype=float)
+    steering_angle = np.asarray(params['steering_angle'], dtype=float)
+    track_width = params['track_width']
+
+    reward = 1 - distance_from_center/(track_width/2)
+
+    # Reward going faster when the car isn't turning
+    straight_fast = ((np.abs(steering_angle) < STEERING_THRESHOLD)
+                     & (speed > SPEED_THRESHOLD))
+    reward = np.where(straight_fast, reward + speed/SPEED_MAX, reward)
+
+    # Strongly discourage going off track
+    return np.where(~all_wheels_on_track | is_offtrack, 1e-3, reward)
@@ -1,91 +1,237 @@
-def reward_function(params):
-    '''
-    Reward function for AWS DeepRacer
-    Used in USYD 2020 Finals on the Barcelona track
-    Team: IndestruciRacer
-    Authors: Matthew Suntup, Georgia Markham, Ashan Abey
-    September 2020
-    '''
-    
-    import math
-    import numpy as np
-    
-    # Parameters for Speed Incentive
-    FUTURE_STEP = 6
-    TURN_THRESHOLD_SPEED = 6    # degrees
-    SPEED_THRESHOLD_SLOW = 1.8  # m/s
-    SPEED_THRESHOLD_FAST = 2    # m/s
+import math
+import numpy as np
+
+# Parameters for Speed Incentive
+FUTURE_STEP = 6
+TURN_THRESHOLD_SPEED = 6    # degrees
+SPEED_THRESHOLD_SLOW = 1.8  # m/s
+SPEED_THRESHOLD_FAST = 2    # m/s
+
+# Per-waypoint target speeds (m/s), e.g. from planning/speed_profile.py
+# --table. When set, the speed incentive scores the speed against the target
+# at the next waypoint instead of the go_fast thresholds
+SPEED_PROFILE = None
+SPEED_TOLERANCE = 1.0       # m/s, error at which the incentive reaches 0
+
+# Parameters for Straightness Incentive
+FUTURE_STEP_STRAIGHT = 8
+TURN_THRESHOLD_STRAIGHT = 25    # degrees
+STEERING_THRESHOLD = 11         # degrees
+
+# Parameters for Progress Incentive
+TOTAL_NUM_STEPS = 675 # (15 steps per second, therefore < 45 secs)
+
+# Per-waypoint steps a reference lap from the first waypoint takes to reach
+# each waypoint, e.g. from tools/pace_table.py --table. When set, the
+# progress incentive compares the steps with the reference at the car's
+# position on every step instead of with TOTAL_NUM_STEPS every 50 steps, on
+# any track with as many waypoints as the table
+PACE_TABLE = None
+PACE_SCALE = 0.01   # reward per step ahead of the reference
+PACE_WINDOW = 2     # % of a lap the progress can be from the previous
+                    # waypoint's, beyond which the lap didn't start at the
+                    # first waypoint and there is no reward
+
+# Corner lookup tables, built once per track (see corner_table)
+CORNER_TABLES = {}
+
+
+# BEGIN geometry.py
+# Copied from planning/geometry.py by tools/bundle_rewards.py: edit it
+# there and re-run the bundler.
+
+
+def distance(x0, y0, x1, y1):
+
+    dx = x1 - x0
+    dy = y1 - y0
+    return math.sqrt(dx*dx + dy*dy)
+
+
+def identify_corner(waypoints, closest_waypoints, future_step):
+
+    # Identify next waypoint and a further waypoint
+    point_prev = waypoints[closest_waypoints[0]]
+    point_next = waypoints[closest_waypoints[1]]
+    point_future = waypoints[min(len(waypoints) - 1,
+                                 closest_waypoints[1] + future_step)]
+
+    # Headings back to the previous waypoint from the next one and from the
+    # further one, and the angle between them. This runs on every step, so
+    # heading_between(), angle_difference() and distance() are written out
+    heading_current = math.degrees(math.atan2(point_prev[1] - point_next[1],
+                                              point_prev[0] - point_next[0]))
+    heading_future = math.degrees(math.atan2(point_prev[1] - point_future[1],
+                                             point_prev[0] - point_future[0]))
+    diff_heading = abs(heading_current - heading_future)
+    if diff_heading > 180:
+        diff_heading = 360 - diff_heading
+
+    # Distance to further waypoint
+    dx = point_future[0] - point_next[0]
+    dy = point_future[1] - point_next[1]
+    dist_future = math.sqrt(dx*dx + dy*dy)
+
+    return diff_heading, dist_future
+
+
+def arc_lengths(waypoints):
+
+    # Cumulative distance along the track to each waypoint
+    arc_length = [0.0]
+    for i in range(1, len(waypoints)):
+        arc_length.append(arc_length[-1] + distance(
+            waypoints[i - 1][0], waypoints[i - 1][1],
+            waypoints[i][0], waypoints[i][1]))
+
+    return arc_length
+
+
+def pace_rows(waypoints, pace):
+
+    # The progress (%) at each waypoint of a lap started at the first one,
+    # with the pace (reference steps) there and the steps per % of progress
+    # to the next waypoint, as the rewards look them up by
+    # closest_waypoints[0]
+    arc_length = arc_lengths(waypoints)
+    progress = [100 * a / arc_length[-1] for a in arc_length]
+
+    rows = []
+    for i in range(len(waypoints) - 1):
+        span = progress[i + 1] - progress[i]
+        rate = (pace[i + 1] - pace[i]) / span if span > 0 else 0.0
+        rows.append((progress[i], pace[i], rate))
+
+    # The last waypoint is the first one again, at the start of the lap
+    rows.append(rows[0])
+
+    return rows
+
+
+# END geometry.py
+
+
+def select_speed(waypoints, closest_waypoints, future_step):
+
+    # Identify if a corner is in the future
+    diff_heading, dist_future = identify_corner(waypoints,
+                                                closest_waypoints,
+                                                future_step)
 
-    # Parameters for Straightness Incentive
-    FUTURE_STEP_STRAIGHT = 8
-    TURN_THRESHOLD_STRAIGHT = 25    # degrees
-    STEERING_THRESHOLD = 11         # degrees
+    if diff_heading < TURN_THRESHOLD_SPEED:
+        # If there's no corner encourage going faster
+        go_fast = True
+    else:
+        # If there is a corner encourage slowing down
+        go_fast = False
 
-    # Parameters for Progress Incentive
-    TOTAL_NUM_STEPS = 675 # (15 steps per second, therefore < 45 secs)
+    return go_fast
 
 
-    def identify_corner(waypoints, closest_waypoints, future_step):
+def select_straight(waypoints, closest_waypoints, future_step):
 
-        # Identify next waypoint and a further waypoint
-        point_prev = waypoints[closest_waypoints[0]]
-        point_next = waypoints[closest_waypoints[1]]
-        point_future = waypoints[min(len(waypoints) - 1,
-                                     closest_waypoints[1] + future_step)]
+    # Identify if a corner is in the future
+    diff_heading, dist_future = identify_corner(waypoints,
+                                                closest_waypoints,
+                                                future_step)
 
-        # Calculate headings to waypoints
-        heading_current = math.degrees(math.atan2(point_prev[1]-point_next[1], 
-                                               point_prev[0] - point_next[0]))
-        heading_future = math.degrees(math.atan2(point_prev[1] - point_future[1], 
-                                               point_prev[0] - point_future[0]))
+    if diff_heading < TURN_THRESHOLD_STRAIGHT:
+        # If there's no corner encourage going straighter
+        go_straight = True
+    else:
+        # If there is a corner don't encourage going straighter
+        go_straight = False
 
-        # Calculate the difference between the headings
-        diff_heading = abs(heading_current - heading_future)
+    return go_straight
 
-        # Check we didn't choose the reflex angle
-        if diff_heading > 180:
-            diff_heading = 360 - diff_heading
 
-        # Calculate distance to further waypoint
-        dist_future = np.linalg.norm([point_next[0] - point_future[0],
-                                      point_next[1] - point_future[1]])  
+def track_fingerprint(waypoints):
 
-        return diff_heading, dist_future
+    # A cheap identity for the track: the number of waypoints and a sample of
+    # points spread around it, which is enough to tell the tracks apart
+    num_waypoints = len(waypoints)
+    samples = [waypoints[i] for i in (0, num_waypoints // 3,
+                                      2 * num_waypoints // 3, -1)]
 
+    return (num_waypoints,) + tuple((p[0], p[1]) for p in samples)
 
-    def select_speed(waypoints, closest_waypoints, future_step):
 
-        # Identify if a corner is in the future
-        diff_heading, dist_future = identify_corner(waypoints,
-                                                    closest_waypoints,
-                                                    future_step)
+def corner_table(waypoints):
 
-        if diff_heading < TURN_THRESHOLD_SPEED:
-            # If there's no corner encourage going faster
-            go_fast = True
-        else:
-            # If there is a corner encourage slowing down
-            go_fast = False
+    # Tables are built once per track and setting of the constants they
+    # depend on, and reused for every following step. The table keeps the
+    # pace table it was built from, so its id can't be reused while cached
+    key = (track_fingerprint(waypoints), FUTURE_STEP, FUTURE_STEP_STRAIGHT,
+           TURN_THRESHOLD_SPEED, TURN_THRESHOLD_STRAIGHT, id(PACE_TABLE))
+    table = CORNER_TABLES.get(key)
+    if table is not None:
+        return table
 
-        return go_fast
+    # Index i holds the result for closest_waypoints = [i-1, i], using the
+    # same functions as the per-step calculation so the results are identical
+    table = {'go_fast': [], 'go_straight': [], 'pace_table': PACE_TABLE}
+    for i in range(len(waypoints)):
+        table['go_fast'].append(
+            select_speed(waypoints, [i - 1, i], FUTURE_STEP))
+        table['go_straight'].append(
+            select_straight(waypoints, [i - 1, i], FUTURE_STEP_STRAIGHT))
 
+    # Pace rows only for a track with as many waypoints as the pace table
+    table['pace'] = None
+    if PACE_TABLE is not None and len(PACE_TABLE) == len(waypoints):
+        table['pace'] = pace_rows(waypoints, PACE_TABLE)
 
-    def select_straight(waypoints, closest_waypoints, future_step):
+    CORNER_TABLES[key] = table
+    return table
 
-        # Identify if a corner is in the future
-        diff_heading, dist_future = identify_corner(waypoints,
-                                                    closest_waypoints,
-                                                    future_step)
 
-        if diff_heading < TURN_THRESHOLD_STRAIGHT:
-            # If there's no corner encourage going straighter
-            go_straight = True
-        else:
-            # If there is a corner don't encourage going straighter
-            go_straight = False
+def select_incentives(waypoints, closest_waypoints):
 
-        return go_straight
+    prev_index, next_index = closest_waypoints[0], closest_waypoints[1]
 
+    # Consecutive waypoints (including the wrap from the last waypoint back to
+    # the first) are a single lookup into the track's table
+    if prev_index == next_index - 1 or (next_index == 0 and
+                                        prev_index == len(waypoints) - 1):
+        table = corner_table(waypoints)
+        return table['go_straight'][next_index], table['go_fast'][next_index]
+
+    # Anything else is calculated directly
+    go_straight = select_straight(waypoints, closest_waypoints,
+                                  FUTURE_STEP_STRAIGHT)
+    go_fast = select_speed(waypoints, closest_waypoints, FUTURE_STEP)
+
+    return go_straight, go_fast
+
+
+def select_incentives_batch(waypoints, closest_waypoints):
+
+    prev_index = closest_waypoints[:, 0]
+    next_index = closest_waypoints[:, 1]
+
+    # Consecutive waypoints are looked up in the track's table all at once
+    table = corner_table(waypoints)
+    go_straight = np.array(table['go_straight'])[next_index]
+    go_fast = np.array(table['go_fast'])[next_index]
+
+    # Any other pairs are calculated directly, one at a time
+    consecutive = (prev_index == next_index - 1) | (
+        (next_index == 0) & (prev_index == len(waypoints) - 1))
+    for i in np.flatnonzero(~consecutive):
+        go_straight[i], go_fast[i] = select_incentives(
+            waypoints, closest_waypoints[i].tolist())
+
+    return go_straight, go_fast
+
+
+def reward_function(params):
+    '''
+    Reward function for AWS DeepRacer
+    Used in USYD 2020 Finals on the Barcelona track
+    Team: IndestruciRacer
+    Authors: Matthew Suntup, Georgia Markham, Ashan Abey
+    September 2020
+    '''
 
     # Read input parameters
     all_wheels_on_track = params['all_wheels_on_track']
@@ -103,36 +249,119 @@ def reward_function(params):
     if is_offtrack:
         reward = 1e-3
         return float(reward)
-    
+
     # Give higher reward if the car is closer to centre line and vice versa
     # 0 if you're on edge of track, 1 if you're centre of track
-    reward = 1 - (distance_from_center/(track_width/2))**(1/4) 
+    reward = 1 - (distance_from_center/(track_width/2))**(1/4)
 
-    # Every 50 steps, if it's ahead of expected position, give reward relative
-    # to how far ahead it is
-    if (steps % 50) == 0 and progress/100 > (steps/TOTAL_NUM_STEPS):
-        # reward += 2.22 for each second faster than 45s projected
-        reward += progress - (steps/TOTAL_NUM_STEPS)*100
+    pace = None
+    if PACE_TABLE is not None:
+        pace = corner_table(waypoints)['pace']
+    if pace is None:
+        # Every 50 steps, if it's ahead of expected position, give reward
+        # relative to how far ahead it is
+        if (steps % 50) == 0 and progress/100 > (steps/TOTAL_NUM_STEPS):
+            # reward += 2.22 for each second faster than 45s projected
+            reward += progress - (steps/TOTAL_NUM_STEPS)*100
+    else:
+        # Reward every step ahead of the reference lap at the car's progress,
+        # from the pace row of its previous waypoint
+        progress_prev, steps_prev, rate = pace[closest_waypoints[0]]
+        offset = progress - progress_prev
+        ahead = steps_prev + offset*rate - steps
+        if abs(offset) < PACE_WINDOW and ahead > 0:
+            reward += PACE_SCALE * ahead
+
+    # Look up the straightness and speed incentives for this position
+    stay_straight, go_fast = select_incentives(waypoints, closest_waypoints)
 
     # Implement straightness incentive
-    stay_straight = select_straight(waypoints, closest_waypoints, 
-                                    FUTURE_STEP_STRAIGHT)
     if stay_straight and abs(steering_angle) < STEERING_THRESHOLD:
         reward += 0.3
 
     # Implement speed incentive
-    go_fast = select_speed(waypoints, closest_waypoints, FUTURE_STEP)
+    if SPEED_PROFILE is not None:
+        # Full speed incentive at the target speed, falling to nothing
+        # SPEED_TOLERANCE either side of it
+        target_speed = SPEED_PROFILE[closest_waypoints[1]]
+        reward += 2.0 * max(0.0, 1 - abs(speed - target_speed)/SPEED_TOLERANCE)
 
-    if go_fast and speed > SPEED_THRESHOLD_FAST 
-               and abs(steering_angle) < STEERING_THRESHOLD:
+    elif (go_fast and speed > SPEED_THRESHOLD_FAST
+                  and abs(steering_angle) < STEERING_THRESHOLD):
         reward += 2.0
 
     elif not go_fast and speed < SPEED_THRESHOLD_SLOW:
-        reward += 0.5    
+        reward += 0.5
 
     # Implement stay on track incentive
     if not all_wheels_on_track:
         reward -= 0.5
 
     reward = max(reward, 1e-3)
-    return float(reward)
\ No newline at end of file
+    return float(reward)
+
+
+def reward_function_batch(params):
+    '''
+    Vectorised version of reward_function for scoring logged steps offline.
+    Each entry of params is a NumPy column with one value per step, except
+    track_width and waypoints which are shared by all steps. Returns an array
+    of rewards matching reward_function on each step, up to the last-digit
+    rounding differences between NumPy's and Python's power functions.
+    '''
+
+    # Read input parameters
+    all_wheels_on_track = np.asarray(params['all_wheels_on_track'], dtype=bool)
+    closest_waypoints = np.asarray(params['closest_waypoints'], dtype=int)
+    distance_from_center = np.asarray(params['distance_from_center'],
+                                      dtype=float)
+    is_offtrack = np.asarray(params['is_offtrack'], dtype=bool)
+    progress = np.asarray(params['progress'], dtype=float)
+    speed = np.asarray(params['speed'], dtype=float)
+    steering_angle = np.asarray(params['steering_angle'], dtype=float)
+    steps = np.asarray(params['steps'])
+    track_width = params['track_width']
+    waypoints = params['waypoints']
+
+    # Centreline incentive
+    reward = 1 - (distance_from_center/(track_width/2))**(1/4)
+
+    # Progress incentive every 50 steps, or against the pace table
+    pace = corner_table(waypoints)['pace']
+    if pace is None:
+        ahead = ((steps % 50) == 0) & (progress/100 > (steps/TOTAL_NUM_STEPS))
+        reward = np.where(ahead,
+                          reward + (progress - (steps/TOTAL_NUM_STEPS)*100),
+                          reward)
+    else:
+        pace = np.array(pace)[closest_waypoints[:, 0]]
+        offset = progress - pace[:, 0]
+        ahead = pace[:, 1] + offset*pace[:, 2] - steps
+        reward = np.where((np.abs(offset) < PACE_WINDOW) & (ahead > 0),
+                          reward + PACE_SCALE*ahead, reward)
+
+    stay_straight, go_fast = select_incentives_batch(waypoints,
+                                                     closest_waypoints)
+    steering_small = np.abs(steering_angle) < STEERING_THRESHOLD
+
+    # Straightness incentive
+    reward = np.where(stay_straight & steering_small, reward + 0.3, reward)
+
+    # Speed incentive
+    if SPEED_PROFILE is None:
+        fast = go_fast & (speed > SPEED_THRESHOLD_FAST) & steering_small
+        slow = ~go_fast & (speed < SPEED_THRESHOLD_SLOW)
+        reward = np.where(fast, reward + 2.0,
+                          np.where(slow, reward + 0.5, reward))
+    else:
+        target_speed = np.asarray(SPEED_PROFILE)[closest_waypoints[:, 1]]
+        reward = reward + 2.0 * np.maximum(
+            0.0, 1 - np.abs(speed - target_speed)/SPEED_TOLERANCE)
+
+    # Stay on track incentive
+    reward = np.where(all_wheels_on_track, reward, reward - 0.5)
+
+    reward = np.maximum(reward, 1e-3)
+
+    # Strongly discourage going off track
+    return np.where(is_offtrack, 1e-3, reward)
@@ -1,80 +1,212 @@
-def reward_function(params):
-    '''
-    Reward function for AWS DeepRacer
-    Used in USYD 2020 Qualifier in the 2019 Championship track
-    Team: IndestruciRacer
-    Authors: Matthew Suntup, Georgia Markham, Ashan Abey
-    August 2020
-    '''
-    
-    import math
-    import numpy as np
-    
-    # Parameters
-    FUTURE_STEP = 7
-    MID_STEP = 4
-    TURN_THRESHOLD = 10     # degrees
-    DIST_THRESHOLD = 1.2    # metres
-    SPEED_THRESHOLD = 1.8   # m/s
+import bisect
+import math
+import numpy as np
+
+# Parameters
+FUTURE_STEP = 7
+MID_STEP = 4
+TURN_THRESHOLD = 10     # degrees
+DIST_THRESHOLD = 1.2    # metres
+SPEED_THRESHOLD = 1.8   # m/s
+
+# Look-ahead in metres along the track. When set, corners are checked once
+# at this distance instead of with FUTURE_STEP, MID_STEP and DIST_THRESHOLD,
+# which keeps the behaviour the same however densely a track is sampled
+FUTURE_DIST = None      # metres
+
+# Corner lookup tables, built once per track (see corner_table)
+CORNER_TABLES = {}
+
+
+# BEGIN geometry.py
+# Copied from planning/geometry.py by tools/bundle_rewards.py: edit it
+# there and re-run the bundler.
+
+
+def distance(x0, y0, x1, y1):
+
+    dx = x1 - x0
+    dy = y1 - y0
+    return math.sqrt(dx*dx + dy*dy)
+
+
+def identify_corner(waypoints, closest_waypoints, future_step):
+
+    # Identify next waypoint and a further waypoint
+    point_prev = waypoints[closest_waypoints[0]]
+    point_next = waypoints[closest_waypoints[1]]
+    point_future = waypoints[min(len(waypoints) - 1,
+                                 closest_waypoints[1] + future_step)]
 
+    # Headings back to the previous waypoint from the next one and from the
+    # further one, and the angle between them. This runs on every step, so
+    # heading_between(), angle_difference() and distance() are written out
+    heading_current = math.degrees(math.atan2(point_prev[1] - point_next[1],
+                                              point_prev[0] - point_next[0]))
+    heading_future = math.degrees(math.atan2(point_prev[1] - point_future[1],
+                                             point_prev[0] - point_future[0]))
+    diff_heading = abs(heading_current - heading_future)
+    if diff_heading > 180:
+        diff_heading = 360 - diff_heading
 
-    def identify_corner(waypoints, closest_waypoints, future_step):
+    # Distance to further waypoint
+    dx = point_future[0] - point_next[0]
+    dy = point_future[1] - point_next[1]
+    dist_future = math.sqrt(dx*dx + dy*dy)
 
-        # Identify next waypoint and a further waypoint
-        point_prev = waypoints[closest_waypoints[0]]
-        point_next = waypoints[closest_waypoints[1]]
-        point_future = waypoints[min(len(waypoints) - 1, 
-                                     closest_waypoints[1] + future_step)]
+    return diff_heading, dist_future
 
-        # Calculate headings to waypoints
-        heading_current = math.degrees(math.atan2(point_prev[1] - point_next[1], 
-                                                 point_prev[0] - point_next[0]))
-        heading_future = math.degrees(math.atan2(point_prev[1] - point_future[1], 
-                                                 point_prev[0]-point_future[0]))
 
-        # Calculate the difference between the headings
-        diff_heading = abs(heading_current - heading_future)
+def arc_lengths(waypoints):
 
-        # Check we didn't choose the reflex angle
-        if diff_heading > 180:
-            diff_heading = 360 - diff_heading
+    # Cumulative distance along the track to each waypoint
+    arc_length = [0.0]
+    for i in range(1, len(waypoints)):
+        arc_length.append(arc_length[-1] + distance(
+            waypoints[i - 1][0], waypoints[i - 1][1],
+            waypoints[i][0], waypoints[i][1]))
 
-        # Calculate distance to further waypoint
-        dist_future = np.linalg.norm([point_next[0] - point_future[0],
-                                      point_next[1] - point_future[1]])  
+    return arc_length
 
-        return diff_heading, dist_future
 
+def lookahead_steps(arc_length, future_dist):
 
-    def select_speed(waypoints, closest_waypoints, future_step, mid_step):
+    # For each waypoint, how many waypoints ahead the first one at least
+    # future_dist metres further along the cumulative arc_length is. The
+    # corner test stops at the last waypoint, so the search does too
+    last = len(arc_length) - 1
+    return [min(last, bisect.bisect_left(arc_length, arc_length[i]
+                                         + future_dist)) - i
+            for i in range(len(arc_length))]
 
-        # Identify if a corner is in the future
-        diff_heading, dist_future = identify_corner(waypoints, 
-                                                    closest_waypoints, 
-                                                    future_step)
 
-        if diff_heading < TURN_THRESHOLD:
-            # If there's no corner encourage going faster
-            go_fast = True
+# END geometry.py
+
+
+def select_speed(waypoints, closest_waypoints, future_step, mid_step):
+
+    # Identify if a corner is in the future
+    diff_heading, dist_future = identify_corner(waypoints,
+                                                closest_waypoints,
+                                                future_step)
+
+    if diff_heading < TURN_THRESHOLD:
+        # If there's no corner encourage going faster
+        go_fast = True
+    else:
+        if dist_future < DIST_THRESHOLD:
+            # If there is a corner and it's close encourage going slower
+            go_fast = False
         else:
-            if dist_future < DIST_THRESHOLD:
+            # If the corner is far away, re-assess closer points
+            diff_heading_mid, dist_mid = identify_corner(waypoints,
+                                                         closest_waypoints,
+                                                         mid_step)
+
+            if diff_heading_mid < TURN_THRESHOLD:
+                # If there's no corner encourage going faster
+                go_fast = True
+            else:
                 # If there is a corner and it's close encourage going slower
                 go_fast = False
-            else:
-                # If the corner is far away, re-assess closer points
-                diff_heading_mid, dist_mid = identify_corner(waypoints, 
-                                                             closest_waypoints, 
-                                                             mid_step)
 
-                if diff_heading_mid < TURN_THRESHOLD:
-                    # If there's no corner encourage going faster
-                    go_fast = True
-                else:
-                    # If there is a corner and it's close encourage going slower
-                    go_fast = False
+    return go_fast
+
+
+def select_speed_ahead(waypoints, closest_waypoints, future_step):
+
+    # Identify if a corner is in the future, at a look-ahead that has already
+    # been converted from metres to waypoints
+    diff_heading, dist_future = identify_corner(waypoints,
+                                                closest_waypoints,
+                                                future_step)
+
+    return diff_heading < TURN_THRESHOLD
+
+
+def track_fingerprint(waypoints):
+
+    # A cheap identity for the track: the number of waypoints and a sample of
+    # points spread around it, which is enough to tell the tracks apart
+    num_waypoints = len(waypoints)
+    samples = [waypoints[i] for i in (0, num_waypoints // 3,
+                                      2 * num_waypoints // 3, -1)]
+
+    return (num_waypoints,) + tuple((p[0], p[1]) for p in samples)
+
+
+def corner_table(waypoints):
+
+    # Tables are built once per track and setting of the constants they
+    # depend on, and reused for every following step
+    key = (track_fingerprint(waypoints), FUTURE_STEP, MID_STEP, TURN_THRESHOLD,
+           DIST_THRESHOLD, FUTURE_DIST)
+    table = CORNER_TABLES.get(key)
+    if table is not None:
+        return table
 
-        return go_fast
+    # Index i holds the result for closest_waypoints = [i-1, i], using the
+    # same functions as the per-step calculation so the results are identical
+    table = {'go_fast': []}
+    if FUTURE_DIST is None:
+        for i in range(len(waypoints)):
+            table['go_fast'].append(
+                select_speed(waypoints, [i - 1, i], FUTURE_STEP, MID_STEP))
+    else:
+        table['future_steps'] = lookahead_steps(arc_lengths(waypoints),
+                                                 FUTURE_DIST)
+        for i in range(len(waypoints)):
+            table['go_fast'].append(select_speed_ahead(
+                waypoints, [i - 1, i], table['future_steps'][i]))
 
+    CORNER_TABLES[key] = table
+    return table
+
+
+def select_incentive(waypoints, closest_waypoints):
+
+    prev_index, next_index = closest_waypoints[0], closest_waypoints[1]
+
+    # Consecutive waypoints (including the wrap from the last waypoint back to
+    # the first) are a single lookup into the track's table
+    if prev_index == next_index - 1 or (next_index == 0 and
+                                        prev_index == len(waypoints) - 1):
+        return corner_table(waypoints)['go_fast'][next_index]
+
+    # Anything else is calculated directly
+    if FUTURE_DIST is not None:
+        future_step = corner_table(waypoints)['future_steps'][next_index]
+        return select_speed_ahead(waypoints, closest_waypoints, future_step)
+
+    return select_speed(waypoints, closest_waypoints, FUTURE_STEP, MID_STEP)
+
+
+def select_incentive_batch(waypoints, closest_waypoints):
+
+    prev_index = closest_waypoints[:, 0]
+    next_index = closest_waypoints[:, 1]
+
+    # Consecutive waypoints are looked up in the track's table all at once
+    go_fast = np.array(corner_table(waypoints)['go_fast'])[next_index]
+
+    # Any other pairs are calculated directly, one at a time
+    consecutive = (prev_index == next_index - 1) | (
+        (next_index == 0) & (prev_index == len(waypoints) - 1))
+    for i in np.flatnonzero(~consecutive):
+        go_fast[i] = select_incentive(waypoints,
+                                      closest_waypoints[i].tolist())
+
+    return go_fast
+
+
+def reward_function(params):
+    '''
+    Reward function for AWS DeepRacer
+    Used in USYD 2020 Qualifier in the 2019 Championship track
+    Team: IndestruciRacer
+    Authors: Matthew Suntup, Georgia Markham, Ashan Abey
+    August 2020
+    '''
 
     # Read input parameters
     all_wheels_on_track = params['all_wheels_on_track']
@@ -91,19 +223,53 @@ def reward_function(params):
     if not all_wheels_on_track or is_offtrack:
         reward = 1e-3
         return float(reward)
-    
+
     # Give higher reward if the car is closer to centre line and vice versa
     # 0 if you're on edge of track, 1 if you're centre of track
-    reward = 1 - (distance_from_center/(track_width/2))**(1/4) 
-             + progress/steps
+    reward = (1 - (distance_from_center/(track_width/2))**(1/4)
+              + progress/steps)
 
-    go_fast = select_speed(waypoints, closest_waypoints, FUTURE_STEP, MID_STEP)
+    go_fast = select_incentive(waypoints, closest_waypoints)
 
     # Implement speed incentive
     if go_fast and speed > SPEED_THRESHOLD:
         reward += 0.5
 
     elif not go_fast and speed < SPEED_THRESHOLD:
-        reward += 0.5    
-      
-    return float(reward)
\ No newline at end of file
+        reward += 0.5
+
+    return float(reward)
+
+
+def reward_function_batch(params):
+    '''
+    Vectorised version of reward_function for scoring logged steps offline.
+    Each entry of params is a NumPy column with one value per step, except
+    track_width and waypoints which are shared by all steps. Steps must be
+    positive, as progress/steps is taken for every step.
+    '''
+
+    # Read input parameters
+    all_wheels_on_track = np.asarray(params['all_wheels_on_track'], dtype=bool)
+    closest_waypoints = np.asarray(params['closest_waypoints'], dtype=int)
+    distance_from_center = np.asarray(params['distance_from_center'],
+                                      dtype=float)
+    is_offtrack = np.asarray(params['is_offtrack'], dtype=bool)
+    progress = np.asarray(params['progress'], dtype=float)
+    speed = np.asarray(params['speed'], dtype=float)
+    steps = np.asarray(params['steps'])
+    track_width = params['track_width']
+    waypoints = params['waypoints']
+
+    # Centreline and progress incentives
+    reward = (1 - (distance_from_center/(track_width/2))**(1/4)
+              + progress/steps)
+
+    # Speed incentive
+    go_fast = select_incentive_batch(waypoints, closest_waypoints)
+    matched = ((go_fast & (speed > SPEED_THRESHOLD))
+               | (~go_fast & (speed < SPEED_THRESHOLD)))
+    reward = np.where(matched, reward + 0.5, reward)
+
+    # Strongly discourage going off track
+    return np.where(~all_wheels_on_track | is_offtrack, 1e-3, reward)
@@ -0,0 +1,262 @@
+'''
+Micro-benchmarks for the reward functions.
+
+The simulator calls reward_function 15 times a second per worker, so each
+reward in reward/ is timed per call on synthetic params built from the
+bundled tracks. For every reward and track this reports the mean ns/call,
+per-call percentiles and the peak memory Python allocates during a call
+(from tracemalloc; CPython has no allocation counter, and this is the
+closest stable measure).
+
+Timings are also stored relative to a fixed pure-Python calibration loop,
+which makes baselines comparable between runs on different machines.
+Every reward on every track is timed once per round, interleaved, right
+after a run of the calibration loop, and keeps the median of its ratios to
+it, so a slow spell of a busy machine slows both sides of a ratio alike.
+The mean and the percentiles come from the same timed calls, though the
+mean leaves out calls the operating system interrupted.
+--check compares against the stored baseline and exits non-zero if any
+reward has become slower than the tolerance allows. The calibration loop
+only follows the speed of a reward call to within about 20% on a busy
+machine, so the default tolerance of 0.5 is wide enough not to fail on an
+unchanged checkout; compare smaller changes run against run. Re-record the
+baseline with --save-baseline in any change to the rewards.
+
+Example:
+    python bench_rewards.py --save-baseline
+    python bench_rewards.py --check --tolerance 0.3
+'''
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from rewards import (REWARD_FILES, column_rows, load_reward, shared_params,
+                     synthetic_columns)
+from tracks import available_tracks, load_track
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'bench_baseline.json')
+
+# Calls taking this many times a round's median were interrupted by the
+# operating system, and are left out of its mean
+INTERRUPTED = 10
+
+
+def calibration_ns(rounds=20):
+
+    # Best time of a fixed pure-Python workload, as a measure of how fast
+    # this interpreter and machine are
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter_ns()
+        total = 0
+        for i in range(20000):
+            total += i * i % 7
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def timer_overhead_ns(samples=10000):
+
+    timer = time.perf_counter_ns
+    deltas = [-(timer() - timer()) for _ in range(samples)]
+
+    return float(np.median(deltas))
+
+
+def call_times(function, rows, overhead):
+
+    # ns of each call of function with a params dict of rows, less the
+    # overhead of the timer itself
+    timer = time.perf_counter_ns
+    per_call = np.empty(len(rows))
+    for i, params in enumerate(rows):
+        start = timer()
+        function(params)
+        per_call[i] = timer() - start
+
+    return per_call - overhead
+
+
+def peak_bytes(function, rows):
+
+    # Mean peak memory allocated while each call runs
+    tracemalloc.start()
+    peaks = np.empty(len(rows))
+    for i, params in enumerate(rows):
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        function(params)
+        peaks[i] = tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+
+    return float(peaks.mean())
+
+
+def round_mean(per_call):
+
+    # Mean ns/call of a round, without the interrupted calls
+    return per_call[per_call <= INTERRUPTED * np.median(per_call)].mean()
+
+
+def call_stats(times):
+    '''
+    The mean ns/call (median of rounds) and per-call percentiles (over
+    every round) of a list of call_times() of rounds.
+    '''
+    return {
+        'ns_per_call': float(np.median([round_mean(t) for t in times])),
+        'p50': float(np.percentile(times, 50)),
+        'p90': float(np.percentile(times, 90)),
+        'p99': float(np.percentile(times, 99)),
+    }
+
+
+def bench_function(function, rows, rounds):
+    '''
+    Time function over every params dict in rows. Returns the mean ns/call
+    (median of rounds), per-call percentiles and the mean peak bytes
+    allocated per call.
+    '''
+    overhead = timer_overhead_ns()
+
+    # Warm up, which also builds any per-track tables
+    call_times(function, rows, overhead)
+
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        times = [call_times(function, rows, overhead) for _ in range(rounds)]
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    return dict(call_stats(times),
+                peak_bytes=peak_bytes(function, rows))
+
+
+def run(reward_names, track_names, calls, rounds, seed=0):
+
+    overhead = timer_overhead_ns()
+    benches = []
+    for track_name in track_names:
+        track = load_track(track_name)
+        rng = np.random.default_rng(seed)
+        rows = column_rows(synthetic_columns(track, calls, rng),
+                           shared_params(track))
+        for name in reward_names:
+            function = load_reward(name).reward_function
+            call_times(function, rows, overhead)
+            benches.append(('%s/%s' % (name, track.name), function, rows))
+
+    # Rounds in which everything is timed once, interleaved, each right
+    # after the calibration loop it is judged against (the best of a few
+    # runs, in case one is interrupted), so that the ratios hold however
+    # fast the machine is from one moment to the next
+    calibrations = []
+    times = {key: [] for key, _, _ in benches}
+    ratios = {key: [] for key, _, _ in benches}
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            for key, function, rows in benches:
+                calibration = calibration_ns(3)
+                per_call = call_times(function, rows, overhead)
+                calibrations.append(calibration)
+                times[key].append(per_call)
+                ratios[key].append(round_mean(per_call) / calibration)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    results = {}
+    for key, function, rows in benches:
+        results[key] = dict(call_stats(times[key]),
+                            peak_bytes=peak_bytes(function, rows),
+                            relative=float(np.median(ratios[key])))
+
+    return float(np.median(calibrations)), results
+
+
+def compare(results, baseline, tolerance):
+
+    # Regressions are judged on timings relative to the calibration loop
+    regressions = {}
+    for key, result in results.items():
+        if key in baseline:
+            ratio = result['relative'] / baseline[key]['relative']
+            result['vs_baseline'] = ratio
+            if ratio > 1 + tolerance:
+                regressions[key] = ratio
+
+    return regressions
+
+
+def format_results(results):
+
+    lines = ["%-44s %9s %9s %9s %9s %10s %8s"
+             % ('reward/track', 'ns/call', 'p50', 'p90', 'p99', 'peak B',
+                'vs base')]
+    for key, r in results.items():
+        ratio = ('%7.2fx' % r['vs_baseline']) if 'vs_baseline' in r else ''
+        lines.append("%-44s %9.0f %9.0f %9.0f %9.0f %10.0f %8s"
+                     % (key, r['ns_per_call'], r['p50'], r['p90'], r['p99'],
+                        r['peak_bytes'], ratio))
+
+    return '\n'.join(lines)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rewards', nargs='+', default=list(REWARD_FILES),
+                        help="reward names or paths (default: all)")
+    parser.add_argument('--tracks', nargs='+', default=available_tracks())
+    parser.add_argument('--calls', type=int, default=2000,
+                        help="params per reward and track (default 2000)")
+    parser.add_argument('--rounds', type=int, default=20,
+                        help="timed rounds, keeping the median (default 20)")
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check', action='store_true',
+                        help="exit with an error if slower than the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help="allowed slowdown for --check (default 0.5)")
+    args = parser.parse_args()
+
+    calibration, results = run(args.rewards, args.tracks, args.calls,
+                               args.rounds)
+
+    regressions = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+
+    print("Calibration loop: %.0f us" % (calibration / 1000))
+    print(format_results(results))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'calibration_ns': calibration, 'results': results}, f,
+                      indent=2, sort_keys=True)
+        print("Saved baseline to %s" % args.baseline)
+
+    for key, ratio in regressions.items():
+        print("REGRESSION %s is %.2fx slower than the baseline" % (key, ratio))
+
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+'''
+Copy the geometry kernels into the reward files.
+
+A reward has to be pasted into the DeepRacer console as a single file, so
+instead of importing planning/geometry.py the rewards carry a copy of its
+functions between "# BEGIN geometry.py" and "# END geometry.py" lines, and
+a reward_function_batch those of planning/geometry_numpy.py between
+"# BEGIN geometry_numpy.py" and "# END geometry_numpy.py" lines, with
+_batch added to their names (identify_corner_batch and so on). This
+rewrites those blocks in each reward (by default every reward in
+rewards.REWARD_FILES that has one) from the current kernels, with only the
+functions the reward calls and those they call in turn, and keeps its
+imports to the ones those functions and the reward need. --check only
+lists the files that are out of date and exits non-zero if there are any.
+
+A new reward can instead be written with "from geometry import ..." (the
+tools put planning/ on the path, so it runs as it is), and --output turns
+it into a console file by replacing that import with the block of the
+scalar kernel.
+
+Example:
+    python bundle_rewards.py --check
+    python bundle_rewards.py my_reward.py --output my_reward_console.py
+'''
+import argparse
+import ast
+import os
+import re
+import sys
+import textwrap
+
+from rewards import PLANNING_DIR, REWARD_FILES, reward_path
+
+# The kernels, and what is added to the names of their functions in the
+# rewards so that both can be bundled into one file
+KERNELS = {
+    'geometry.py': '',
+    'geometry_numpy.py': '_batch',
+}
+
+HEADER = ("Copied from planning/%s by tools/bundle_rewards.py%s: edit it "
+          "there and re-run the bundler.")
+RENAMED = ", with %s added to the names"
+
+
+def block_pattern(file_name):
+
+    # The block of a kernel in a reward
+    return re.compile(r'^# BEGIN %s$.*?^# END %s$'
+                      % (re.escape(file_name), re.escape(file_name)),
+                      re.MULTILINE | re.DOTALL)
+
+
+def import_pattern(file_name):
+
+    # An import of a kernel, which a reward run by the tools can use
+    return re.compile(r'^from %s import (\([^)]*\)|.*)$'
+                      % re.escape(os.path.splitext(file_name)[0]),
+                      re.MULTILINE)
+
+
+def names_in(source):
+
+    # Every name a piece of code refers to
+    return {node.id for node in ast.walk(ast.parse(source))
+            if isinstance(node, ast.Name)}
+
+
+def kernel_source(file_name='geometry.py'):
+    '''
+    The imports of a kernel, as (statement, name bound) pairs, and the
+    source of each of its functions in the order they are defined, with
+    the kernel's suffix added to their names and to its calls of them.
+    '''
+    with open(os.path.join(PLANNING_DIR, file_name)) as f:
+        text = f.read()
+    suffix = KERNELS[file_name]
+
+    tree = ast.parse(text)
+    lines = text.splitlines(keepends=True)
+    imports = [(lines[node.lineno - 1].strip(), alias.asname or alias.name)
+               for node in tree.body if isinstance(node, ast.Import)
+               for alias in node.names]
+    defined = {node.name for node in tree.body
+               if isinstance(node, ast.FunctionDef)}
+
+    functions = {}
+    for node in tree.body:
+        if not isinstance(node, ast.FunctionDef):
+            continue
+
+        # Rename from the end so the earlier positions stay put
+        body = lines[node.lineno - 1:node.end_lineno]
+        calls = sorted(((name.lineno - node.lineno, name.col_offset,
+                         name.id) for name in ast.walk(node)
+                        if isinstance(name, ast.Name)
+                        and name.id in defined), reverse=True)
+        for row, column, name in calls:
+            position = column + len(name)
+            body[row] = body[row][:position] + suffix + body[row][position:]
+        body[0] = body[0].replace('def %s(' % node.name,
+                                  'def %s%s(' % (node.name, suffix), 1)
+        functions[node.name + suffix] = ''.join(body)
+
+    return imports, functions
+
+
+def bundle(text, kernels=None):
+    '''
+    A reward's source with its kernel blocks rewritten, or its import of the
+    scalar kernel replaced by the block. Returns None if it has neither.
+    '''
+    if kernels is None:
+        kernels = {name: kernel_source(name) for name in KERNELS}
+
+    # Where each kernel goes: its block, or for a kernel whose names are
+    # unchanged, an import of it
+    patterns = {}
+    for name in kernels:
+        if block_pattern(name).search(text):
+            patterns[name] = block_pattern(name)
+        elif not KERNELS[name] and import_pattern(name).search(text):
+            patterns[name] = import_pattern(name)
+    if not patterns:
+        return None
+
+    rest = text
+    for pattern in patterns.values():
+        rest = pattern.sub('', rest, count=1)
+    defined = {node.name for node in ast.parse(rest).body
+               if isinstance(node, ast.FunctionDef)}
+
+    needed = names_in(rest)
+    for name, pattern in patterns.items():
+        functions = kernels[name][1]
+
+        # The kernel functions the rest of the reward calls, unless it
+        # defines its own, and every kernel function those call in turn
+        wanted = (names_in(rest) & set(functions)) - defined
+        pending = list(wanted)
+        while pending:
+            for called in names_in(functions[pending.pop()]) & set(functions):
+                if called not in wanted:
+                    wanted.add(called)
+                    pending.append(called)
+        used = [source for function, source in functions.items()
+                if function in wanted]
+        needed = needed.union(*[names_in(source) for source in used])
+
+        header = textwrap.fill(
+            HEADER % (name, RENAMED % KERNELS[name] if KERNELS[name] else ''),
+            72, initial_indent='# ', subsequent_indent='# ')
+        block = '\n'.join(['# BEGIN %s' % name, header, '', '',
+                           '\n\n'.join(used).strip('\n'), '', '',
+                           '# END %s' % name])
+        text = pattern.sub(lambda match: block, text, count=1)
+
+    # Drop the kernels' imports that nothing uses any more, and import what
+    # the functions need ahead of the reward's own imports
+    imports = dict(pair for name in patterns for pair in kernels[name][0])
+    for statement, bound in imports.items():
+        if bound not in needed:
+            text = re.sub(r'^%s\n' % re.escape(statement), '', text,
+                          count=1, flags=re.MULTILINE)
+    missing = [statement for statement, bound in imports.items()
+               if bound in needed and not re.search(
+                   r'^%s$' % re.escape(statement), text, re.MULTILINE)]
+    if missing:
+        statements = ''.join(statement + '\n' for statement in missing)
+        first_import = re.search(r'^(import|from) ', text, re.MULTILINE)
+        if first_import:
+            position = first_import.start()
+        else:
+            position = 0
+            statements += '\n'
+        text = text[:position] + statements + text[position:]
+
+    return text
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('rewards', nargs='*',
+                        help="reward names or paths (default all)")
+    parser.add_argument('--check', action='store_true',
+                        help="only report the files that are out of date")
+    parser.add_argument('--output',
+                        help="write the bundled reward here instead of "
+                             "updating it in place (one reward only)")
+    args = parser.parse_args()
+
+    if args.output and len(args.rewards) != 1:
+        parser.error("--output takes exactly one reward")
+
+    kernels = {name: kernel_source(name) for name in KERNELS}
+    out_of_date = []
+    for name in args.rewards or list(REWARD_FILES):
+        path = reward_path(name)
+        with open(path) as f:
+            text = f.read()
+        bundled = bundle(text, kernels)
+
+        if bundled is None:
+            if args.rewards:
+                sys.exit("%s neither has a kernel block nor imports "
+                         "geometry" % path)
+            continue
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(bundled)
+            print(args.output)
+        elif bundled != text:
+            out_of_date.append(path)
+            if not args.check:
+                with open(path, 'w') as f:
+                    f.write(bundled)
+            print(("out of date: %s" if args.check else "updated %s")
+                  % path)
+
+    if args.check and out_of_date:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+'''
+Differential fuzzing of reward implementations against the originals.
+
+Generates randomized but valid params on the bundled tracks, in batches
+spread over a process pool, and scores every step with a reward's scalar
+reward_function and with each candidate implementation. Reports the largest
+absolute difference per reward and candidate and the inputs that differ by
+more than the tolerance.
+
+Differences within the tolerance (TOLERANCE by default, absolute or relative
+to the size of the reward) are rounding: vectorised arithmetic can round
+differently in the last bits. They are counted separately from mismatches,
+the differences over it, which come from a branch taken differently or a
+real change, and only mismatches fail the run.
+
+A candidate is "batch" (the reward's own reward_function_batch) or
+PATH[:FUNCTION], a function in another file (default reward_function).
+Functions whose name ends in _batch are given the whole batch as NumPy
+columns, others are called once per step.
+
+On top of realistic positions (see rewards.synthetic_columns), some of the
+steps are pushed onto the edges the rewards branch on: speeds and steering
+angles equal to the reward's own numeric constants, closest waypoints that
+wrap round the start line or are not consecutive, the centreline and the
+track edge, and checkpoint steps.
+
+Example:
+    python fuzz_rewards.py final qualifier --steps 2000000
+    python fuzz_rewards.py final --candidate faster_final.py
+'''
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from rewards import (REWARD_FILES, column_rows, load_reward, shared_params,
+                     synthetic_columns)
+from tracks import available_tracks, load_track
+
+# Steps generated and checked per job
+BATCH_SIZE = 20000
+
+# Range of the car's actions
+MAX_SPEED = 4.0         # m/s
+MAX_STEERING = 30       # degrees
+
+# Mismatching inputs kept per reward, candidate and job
+MAX_EXAMPLES = 5
+
+# Largest difference counted as rounding, absolute or relative to the reward
+TOLERANCE = 1e-9
+
+
+def load_candidate(reward, candidate):
+    '''
+    The function a candidate names, and whether it takes whole batches.
+    '''
+    if candidate == 'batch':
+        return load_reward(reward).reward_function_batch, True
+
+    path, _, name = candidate.partition(':')
+    function = getattr(load_reward(path), name or 'reward_function')
+
+    return function, function.__name__.endswith('_batch')
+
+
+def reward_constants(module):
+
+    # Numeric module constants, which the reward's branches compare against
+    return sorted({float(value) for name, value in vars(module).items()
+                   if name.isupper() and isinstance(value, (int, float))
+                   and not isinstance(value, bool)})
+
+
+def fuzz_columns(track, num_steps, rng, constants):
+    '''
+    Params columns for num_steps steps on a track, with some of the steps
+    moved onto the edge cases the rewards branch on.
+    '''
+    columns = synthetic_columns(track, num_steps, rng)
+    num_waypoints = len(track.centre)
+    half_width = float(np.median(track.width)) / 2
+
+    def some(fraction):
+        return rng.random(num_steps) < fraction
+
+    # Speeds and steering angles on the reward's thresholds, either side of
+    # zero for steering, as long as they are in the car's range
+    speeds = [c for c in constants if 0 < c <= MAX_SPEED]
+    if speeds:
+        columns['speed'] = np.where(some(0.1),
+                                    rng.choice(speeds, num_steps),
+                                    columns['speed'])
+    angles = [c for c in constants if c <= MAX_STEERING]
+    if angles:
+        columns['steering_angle'] = np.where(
+            some(0.1),
+            rng.choice(angles, num_steps) * rng.choice([-1, 1], num_steps),
+            columns['steering_angle'])
+
+    # Closest waypoints across the start line, and ones that are not
+    # consecutive
+    closest = columns['closest_waypoints']
+    wrap = some(0.03)
+    closest[wrap] = [num_waypoints - 1, 0]
+    scattered = some(0.03)
+    closest[scattered] = rng.integers(0, num_waypoints,
+                                      (scattered.sum(), 2))
+
+    # On the centreline and on the edge of the track
+    distance = columns['distance_from_center']
+    distance[some(0.03)] = 0.0
+    distance[some(0.03)] = half_width
+
+    # Checkpoint steps, and the start and end of a lap
+    steps = columns['steps']
+    checkpoint = some(0.1)
+    steps[checkpoint] = 50 * rng.integers(1, 30, checkpoint.sum())
+    progress = columns['progress']
+    progress[some(0.02)] = 0.0
+    progress[some(0.02)] = 100.0
+
+    # Wheels on and off the track, keeping the flags consistent
+    flip = some(0.05)
+    columns['all_wheels_on_track'] = columns['all_wheels_on_track'] ^ flip
+    columns['is_offtrack'] &= ~columns['all_wheels_on_track']
+    columns['heading'] = np.where(some(0.05),
+                                  rng.uniform(-180, 180, num_steps),
+                                  columns['heading'])
+
+    return columns
+
+
+def differences(reference, values):
+
+    # Absolute differences, with matching NaNs and infinities counted as
+    # equal
+    reference = np.asarray(reference, dtype=float)
+    values = np.asarray(values, dtype=float)
+    with np.errstate(invalid='ignore'):
+        diff = np.abs(reference - values)
+    same = (reference == values) | (np.isnan(reference) & np.isnan(values))
+
+    return np.where(same, 0.0, np.where(np.isnan(diff), np.inf, diff))
+
+
+def fuzz_job(job):
+    '''
+    Check one batch. Returns, per candidate, the largest difference, the
+    number of steps that differ within the tolerance and over it, and a few
+    of the steps over it.
+    '''
+    reward, candidates, track_name, num_steps, seed, tolerance = job
+    module = load_reward(reward)
+    track = load_track(track_name)
+    rng = np.random.default_rng(seed)
+
+    columns = fuzz_columns(track, num_steps, rng, reward_constants(module))
+    shared = shared_params(track)
+    rows = column_rows(columns, shared)
+    reference = [module.reward_function(params) for params in rows]
+
+    results = {}
+    for candidate in candidates:
+        function, batched = load_candidate(reward, candidate)
+        if batched:
+            values = function(dict(columns, **shared))
+        else:
+            values = [function(params) for params in rows]
+
+        diff = differences(reference, values)
+        limit = tolerance * np.maximum(1.0, np.abs(reference))
+        bad = np.flatnonzero(diff > limit)
+        worst = bad[np.argsort(diff[bad])[::-1][:MAX_EXAMPLES]]
+        results[candidate] = {
+            'steps': num_steps,
+            'max_diff': float(diff.max()) if len(diff) else 0.0,
+            'rounding': int(((diff > 0) & (diff <= limit)).sum()),
+            'mismatches': len(bad),
+            'examples': [{
+                'track': track.name,
+                'reference': float(reference[i]),
+                'candidate': float(np.asarray(values)[i]),
+                'diff': float(diff[i]),
+                'params': {k: v for k, v in rows[i].items()
+                           if k != 'waypoints'},
+            } for i in worst],
+        }
+
+    return reward, results
+
+
+def fuzz(rewards, candidates, track_names, num_steps, tolerance=TOLERANCE,
+         seed=0, workers=None):
+    '''
+    Fuzz every reward against each candidate with num_steps steps per reward
+    and track. Returns {reward: {candidate: summary}}.
+    '''
+    jobs = []
+    for reward in rewards:
+        for track_name in track_names:
+            for first in range(0, num_steps, BATCH_SIZE):
+                jobs.append((reward, candidates, track_name,
+                             min(BATCH_SIZE, num_steps - first),
+                             [seed, len(jobs)], tolerance))
+
+    if len(jobs) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(fuzz_job, jobs))
+    else:
+        parts = [fuzz_job(job) for job in jobs]
+
+    summary = {reward: {candidate: {'steps': 0, 'max_diff': 0.0,
+                                    'rounding': 0, 'mismatches': 0,
+                                    'examples': []}
+                        for candidate in candidates}
+               for reward in rewards}
+    for reward, results in parts:
+        for candidate, result in results.items():
+            total = summary[reward][candidate]
+            total['steps'] += result['steps']
+            total['max_diff'] = max(total['max_diff'], result['max_diff'])
+            total['rounding'] += result['rounding']
+            total['mismatches'] += result['mismatches']
+            total['examples'] = sorted(
+                total['examples'] + result['examples'],
+                key=lambda e: -e['diff'])[:MAX_EXAMPLES]
+
+    return summary
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('rewards', nargs='*', default=list(REWARD_FILES),
+                        help="reward names or paths (default: all)")
+    parser.add_argument('--candidate', action='append', dest='candidates',
+                        help="implementation to compare, 'batch' or "
+                             "PATH[:FUNCTION] (default batch, repeatable)")
+    parser.add_argument('--tracks', nargs='+', default=available_tracks())
+    parser.add_argument('--steps', type=int, default=200000,
+                        help="steps per reward and track (default 200000)")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help="largest difference counted as rounding, "
+                             "absolute or relative (default %g)" % TOLERANCE)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--report',
+                        help="write the full summary to this JSON file")
+    args = parser.parse_args()
+
+    candidates = args.candidates or ['batch']
+    summary = fuzz(args.rewards, candidates, args.tracks, args.steps,
+                   args.tolerance, args.seed, args.workers)
+
+    failed = False
+    print("%-20s %-24s %10s %12s %10s %10s"
+          % ('reward', 'candidate', 'steps', 'max diff', 'rounding',
+             'mismatches'))
+    for reward, results in summary.items():
+        for candidate, result in results.items():
+            print("%-20s %-24s %10d %12.3g %10d %10d"
+                  % (os.path.basename(reward), os.path.basename(candidate),
+                     result['steps'], result['max_diff'], result['rounding'],
+                     result['mismatches']))
+            failed |= result['mismatches'] > 0
+
+    for reward, results in summary.items():
+        for candidate, result in results.items():
+            for example in result['examples']:
+                print("\n%s vs %s on %s: %r != %r" % (
+                    os.path.basename(reward), os.path.basename(candidate),
+                    example['track'], example['reference'],
+                    example['candidate']))
+                print(json.dumps(example['params'], sort_keys=True))
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,389 @@
+'''
+Columnar store of parsed simtrace logs, appended to a training iteration at
+a time.
+
+Parsing the simtrace CSVs is the slowest part of looking at a training run,
+so this parses them once, with the streaming reader in simtrace.py, into a
+directory holding one raw binary file per field (<field>.bin) that later
+reads memory map. meta.json records the dtype of every column, the number
+of rows and episodes, the episode status names, and an index of iterations
+(one per simtrace file, or file in an archive) with their first row and
+episode. episode_start.bin holds the first row of every episode, so an
+episode or an iteration is a zero-copy slice of any column.
+
+New iterations are written to the end of the column files and meta.json is
+only replaced once they are complete, so existing data is never rewritten
+and an interrupted append leaves the store as it was. Files already in the
+store are skipped.
+
+The steps in a store can be re-scored offline with a reward function: the
+logged positions are located on the track to rebuild the params the
+simulator would have passed (see rewards.position_columns).
+
+Example:
+    python log_store.py append runs/spain logs/*.tar.gz
+    python log_store.py summary runs/spain
+    python log_store.py rescore runs/spain --reward final --track Spain
+'''
+import argparse
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from rewards import column_rows, load_reward, position_columns, shared_params
+from simtrace import (BLOCK_ROWS, Totals, episode_table, fold_stream,
+                      print_summary, text_streams)
+from tracks import load_track
+
+META_FILE = 'meta.json'
+EPISODE_START = 'episode_start'
+
+# Stored columns and their dtypes
+COLUMNS = {
+    'episode': 'i4',
+    'steps': 'i4',
+    'x': 'f8',
+    'y': 'f8',
+    'yaw': 'f8',
+    'steer': 'f8',
+    'throttle': 'f8',
+    'action': 'i2',
+    'reward': 'f8',
+    'done': '?',
+    'all_wheels_on_track': '?',
+    'progress': 'f8',
+    'closest_waypoint': 'i4',
+    'track_len': 'f8',
+    'tstamp': 'f8',
+    'episode_status': 'u1',
+}
+
+
+class LogStore:
+    '''
+    A store directory, created by the first append. Columns are read as
+    memory maps of the rows indexed when the store was opened or since
+    appended.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {
+                'columns': COLUMNS,
+                'rows': 0,
+                'episodes': 0,
+                'statuses': [''],
+                'iterations': [],
+            }
+
+    @property
+    def rows(self):
+        return self.meta['rows']
+
+    @property
+    def num_episodes(self):
+        return self.meta['episodes']
+
+    @property
+    def iterations(self):
+        return self.meta['iterations']
+
+    def column_path(self, name):
+        return os.path.join(self.path, name + '.bin')
+
+    def read(self, name, dtype, length):
+
+        # An empty file can't be memory mapped
+        if length == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self.column_path(name), dtype=dtype, mode='r',
+                         shape=(length,))
+
+    def column(self, name):
+        '''
+        Memory map of one column over all the rows.
+        '''
+        return self.read(name, self.meta['columns'][name], self.rows)
+
+    def columns(self, names=None, rows=slice(None)):
+        '''
+        Views of the named columns (default all) over a slice of the rows.
+        '''
+        return {name: self.column(name)[rows]
+                for name in (names or self.meta['columns'])}
+
+    def episode_bounds(self):
+        '''
+        First row of every episode, followed by the number of rows.
+        '''
+        starts = self.read(EPISODE_START, 'i8', self.num_episodes)
+        return np.append(starts, self.rows)
+
+    def episode(self, index, names=None):
+        '''
+        Views of the named columns over the rows of one episode, counting
+        episodes from the start of the store.
+        '''
+        bounds = self.episode_bounds()
+        return self.columns(names, slice(bounds[index], bounds[index + 1]))
+
+    def iteration_rows(self, index):
+
+        iteration = self.iterations[index]
+        return slice(iteration['first_row'],
+                     iteration['first_row'] + iteration['rows'])
+
+    def status_names(self, codes):
+
+        return np.asarray(self.meta['statuses'])[codes]
+
+    def append(self, path):
+        '''
+        Parse a simtrace file or archive and append every file in it that is
+        not in the store yet. Returns the sources appended.
+        '''
+        os.makedirs(self.path, exist_ok=True)
+        self.truncate()
+        known = {iteration['source'] for iteration in self.iterations}
+
+        appended = []
+        for source, stream in text_streams(path):
+            if source in known:
+                continue
+            writer = IterationWriter(self)
+            with writer:
+                fold_stream(writer, source, stream)
+            self.iterations.append({
+                'source': source,
+                'first_row': self.rows,
+                'rows': writer.rows,
+                'first_episode': self.num_episodes,
+                'episodes': writer.episodes,
+            })
+            self.meta['rows'] += writer.rows
+            self.meta['episodes'] += writer.episodes
+            self.write_meta()
+            appended.append(source)
+
+        return appended
+
+    def truncate(self):
+
+        # Drop anything an interrupted append wrote past the indexed rows
+        lengths = {name: self.rows * np.dtype(dtype).itemsize
+                   for name, dtype in self.meta['columns'].items()}
+        lengths[EPISODE_START] = self.num_episodes * 8
+        for name, length in lengths.items():
+            path = self.column_path(name)
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+            if os.path.getsize(path) != length:
+                os.truncate(path, length)
+
+    def write_meta(self):
+
+        # Replace the index in one step, once the data it covers is written
+        handle, staging = tempfile.mkstemp(dir=self.path, suffix='.json')
+        with os.fdopen(handle, 'w') as f:
+            json.dump(self.meta, f, indent=1)
+        os.replace(staging, os.path.join(self.path, META_FILE))
+
+
+class IterationWriter:
+    '''
+    Appends the blocks of one simtrace file to the column files of a store,
+    as simtrace.fold_stream hands them over.
+    '''
+
+    def __init__(self, store):
+        self.store = store
+        self.rows = 0
+        self.episodes = 0
+        self.seen = np.empty(0, dtype=np.int64)
+        self.files = {}
+
+    def __enter__(self):
+        for name in list(self.store.meta['columns']) + [EPISODE_START]:
+            self.files[name] = open(self.store.column_path(name), 'ab')
+        return self
+
+    def __exit__(self, *exc_info):
+        for f in self.files.values():
+            f.close()
+
+    def add_block(self, source, columns):
+
+        # Store the status names as codes into the list in meta.json
+        num_rows = len(columns['episode'])
+        statuses = self.store.meta['statuses']
+        if columns['episode_status'] is not None:
+            names, inverse = np.unique(columns['episode_status'],
+                                       return_inverse=True)
+            for name in names.tolist():
+                if name not in statuses:
+                    statuses.append(name)
+            columns['episode_status'] = np.array(
+                [statuses.index(name) for name in names.tolist()])[inverse]
+        else:
+            columns['episode_status'] = np.zeros(num_rows)
+
+        for name, dtype in self.store.meta['columns'].items():
+            values = columns[name]
+            if np.dtype(dtype).kind in 'iu':
+                values = np.nan_to_num(values, nan=-1)
+            np.asarray(values, dtype=dtype).tofile(self.files[name])
+
+        # Episodes start wherever the episode number changes, and each must
+        # be one run of rows to be sliced
+        episode = columns['episode'].astype(np.int64)
+        previous = self.seen[-1:] if self.rows else episode[:1] - 1
+        starts = np.flatnonzero(np.diff(episode, prepend=previous) != 0)
+        numbers = episode[starts]
+        if (len(np.unique(numbers)) < len(numbers)
+                or np.isin(numbers, self.seen).any()):
+            raise ValueError("Episodes in %s are not in contiguous rows"
+                             % source)
+        (self.store.rows + self.rows + starts).astype('i8').tofile(
+            self.files[EPISODE_START])
+
+        self.seen = np.append(self.seen, numbers)
+        self.rows += num_rows
+        self.episodes += len(starts)
+
+
+def store_totals(store, iterations=None):
+    '''
+    simtrace.Totals of the iterations of a store (default all), read from
+    the columns the analysis uses.
+    '''
+    names = ['episode', 'steps', 'reward', 'all_wheels_on_track', 'progress',
+             'tstamp', 'episode_status', 'closest_waypoint', 'throttle']
+    totals = Totals()
+    for index in (range(len(store.iterations)) if iterations is None
+                  else iterations):
+        rows = store.iteration_rows(index)
+        for first in range(rows.start, rows.stop, BLOCK_ROWS):
+            columns = store.columns(names,
+                                    slice(first, min(first + BLOCK_ROWS,
+                                                     rows.stop)))
+            columns['episode_status'] = store.status_names(
+                columns['episode_status'])
+            totals.add_block(store.iterations[index]['source'], columns)
+
+    return totals
+
+
+def rescore(store, reward, track, rows=slice(None), batch=False):
+    '''
+    Reward of every step in a slice of the rows, from the reward's
+    reward_function (or reward_function_batch if batch is set) given params
+    rebuilt from the logged positions on a track from the registry.
+    '''
+    module = load_reward(reward)
+    shared = shared_params(track)
+    names = ['x', 'y', 'yaw', 'steer', 'throttle', 'steps', 'progress',
+             'all_wheels_on_track']
+    first, last, _ = rows.indices(store.rows)
+
+    values = np.empty(max(last - first, 0))
+    for start in range(first, last, BLOCK_ROWS):
+        stop = min(start + BLOCK_ROWS, last)
+        logged = store.columns(names, slice(start, stop))
+        columns = position_columns(track, logged['x'], logged['y'],
+                                   heading=logged['yaw'],
+                                   speed=logged['throttle'],
+                                   steering_angle=logged['steer'],
+                                   steps=logged['steps'],
+                                   progress=logged['progress'])
+
+        # Trust the simulator on the wheels
+        wheels_on = np.array(logged['all_wheels_on_track'])
+        columns['all_wheels_on_track'] = wheels_on
+        columns['is_offtrack'] &= ~wheels_on
+
+        if batch:
+            result = module.reward_function_batch(dict(columns, **shared))
+        else:
+            result = [module.reward_function(params)
+                      for params in column_rows(columns, shared)]
+        values[start - first:stop - first] = result
+
+    return values
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    append = commands.add_parser('append', help="parse logs into a store")
+    append.add_argument('store')
+    append.add_argument('paths', nargs='+',
+                        help="simtrace CSV or log files, or tar archives")
+
+    summary = commands.add_parser('summary',
+                                  help="episode statistics of a store")
+    summary.add_argument('store')
+    summary.add_argument('--iterations', type=int, nargs='+')
+
+    rescoring = commands.add_parser('rescore',
+                                    help="score the steps with a reward")
+    rescoring.add_argument('store')
+    rescoring.add_argument('--reward', default='final')
+    rescoring.add_argument('--track', required=True)
+    rescoring.add_argument('--iteration', type=int,
+                           help="only this iteration (default all)")
+    rescoring.add_argument('--batch', action='store_true',
+                           help="use the reward's reward_function_batch")
+    rescoring.add_argument('--output',
+                           help="save the rewards to this .npy file")
+    args = parser.parse_args()
+
+    store = LogStore(args.store)
+
+    if args.command == 'append':
+        for path in args.paths:
+            for source in store.append(path):
+                print(source)
+        print("%s: %d iterations, %d episodes, %d rows"
+              % (args.store, len(store.iterations), store.num_episodes,
+                 store.rows))
+
+    elif args.command == 'summary':
+        totals = store_totals(store, args.iterations)
+        print_summary(totals, episode_table(totals))
+
+    elif args.command == 'rescore':
+        rows = (slice(None) if args.iteration is None
+                else store.iteration_rows(args.iteration))
+        values = rescore(store, args.reward, load_track(args.track), rows,
+                         args.batch)
+
+        # Compare the episode totals with the rewards logged in training
+        first, last, _ = rows.indices(store.rows)
+        if last <= first:
+            print("No steps to score")
+            return
+        bounds = store.episode_bounds()
+        starts = bounds[(bounds >= first) & (bounds < last)] - first
+        logged = np.add.reduceat(store.column('reward')[first:last], starts)
+        scored = np.add.reduceat(values, starts)
+        print("%d steps in %d episodes" % (len(values), len(starts)))
+        print("Mean reward per episode: logged %.2f, %s %.2f"
+              % (logged.mean(), args.reward, scored.mean()))
+        print("Correlation of episode totals: %.3f"
+              % np.corrcoef(logged, scored)[0, 1])
+
+        if args.output:
+            np.save(args.output, values)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+'''
+Per-waypoint pace table: the steps a reference lap takes to each waypoint.
+
+reward_final.py's progress incentive compares the progress every 50 steps
+with a lap at an even pace of TOTAL_NUM_STEPS steps, although slow corners
+and fast straights gain progress at very different rates. A pace table
+holds, for every waypoint, the steps a reference lap started at the first
+waypoint takes to get there, so a reward can compare the steps taken with
+the reference at the car's own position on every step, with one lookup
+(see PACE_TABLE in reward_final.py and the pace term of reward_compiler.py).
+
+The reference lap is either computed from the target speed profile along
+the centreline or the racing line (see planning/speed_profile.py), or
+recorded: the complete lap with the fewest steps in simtrace logs or log
+stores (see simtrace.py and log_store.py), located on the track with its
+spatial index, wherever it started. Tables computed from a profile are
+cached with the track, and --output saves any table as a .npy file, which
+can be given as the reference again.
+
+Example:
+    python pace_table.py --track Spain --reference racing --table
+    python pace_table.py --track Spain --reference logs/ --output pace.npy
+'''
+import argparse
+import os
+
+import numpy as np
+
+# log_store imports rewards, which puts planning/ on the path
+from log_store import META_FILE, LogStore
+import speed_profile
+from plotting import new_figure, plot_values, save_figures, show
+from simtrace import (BLOCK_ROWS, STEP_RATE, read_rows, text_streams,
+                      to_columns)
+from tracks import load_track, waypoint_table
+
+# Columns of the logs a recorded reference is read from
+LAP_COLUMNS = ('episode', 'steps', 'x', 'y', 'progress', 'episode_status')
+
+
+def profile_pace(speed, segment_lengths):
+    '''
+    Steps to each point of a line at the target speeds along it, taking
+    each segment at the mean of its end speeds.
+    '''
+    speed = np.asarray(speed, dtype=float)
+    seconds = (np.asarray(segment_lengths, dtype=float)[:-1]
+               / ((speed[:-1] + speed[1:]) / 2))
+
+    return np.concatenate([[0.0], np.cumsum(seconds)]) * STEP_RATE
+
+
+def pace_table(track, line='centre', params=None):
+    '''
+    Cached pace table of a track from the registry, from the target speed
+    profile along the centreline or the racing line.
+    '''
+    params = dict(speed_profile.PARAMETERS, **(params or {}))
+    key = 'pace_%s_%s' % (line, '_'.join(
+        '%g' % params[name] for name in sorted(speed_profile.PARAMETERS)))
+
+    def build(track):
+        _, segment_lengths = speed_profile.line_geometry(track, line)
+        return profile_pace(speed_profile.speed_profile(track, params, line),
+                            segment_lengths)
+
+    return track.cached_array(key, build)
+
+
+def source_columns(paths):
+    '''
+    (source, columns) of the LAP_COLUMNS for each simtrace file (or file in
+    an archive) and for each iteration of a log store in paths. Directories
+    that are not stores are searched for simtrace files.
+    '''
+    for path in paths:
+        if os.path.exists(os.path.join(path, META_FILE)):
+            store = LogStore(path)
+            for index, iteration in enumerate(store.iterations):
+                columns = store.columns(LAP_COLUMNS,
+                                        store.iteration_rows(index))
+                columns['episode_status'] = store.status_names(
+                    columns['episode_status'])
+                yield iteration['source'], columns
+            continue
+
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, name)
+                           for name in os.listdir(path))
+            yield from source_columns(
+                [name for name in files
+                 if name.endswith(('.csv', '.log', '.tar', '.gz'))])
+            continue
+
+        for source, stream in text_streams(path):
+            blocks = []
+            block = []
+            block_names = None
+            for names, row in read_rows(stream):
+                if (names != block_names and block) or (
+                        len(block) == BLOCK_ROWS):
+                    blocks.append(to_columns(block, block_names))
+                    block = []
+                block_names = names
+                block.append(row)
+            if block:
+                blocks.append(to_columns(block, block_names))
+            if not blocks:
+                continue
+
+            # Files without an episode_status column have None for it
+            columns = {}
+            for name in LAP_COLUMNS:
+                parts = [block[name] for block in blocks]
+                columns[name] = (None if any(part is None for part in parts)
+                                 else np.concatenate(parts))
+            yield source, columns
+
+
+def best_lap(paths):
+    '''
+    The source, x, y and steps of the complete lap with the fewest steps in
+    the logs, its rows in order of steps. Raises ValueError if there is no
+    complete lap.
+    '''
+    best = None
+    for source, columns in source_columns(paths):
+        episode = np.asarray(columns['episode'])
+        steps = np.asarray(columns['steps'], dtype=float)
+        complete = np.asarray(columns['progress']) >= 100
+        if columns['episode_status'] is not None:
+            complete |= np.asarray(columns['episode_status']) == 'lap_complete'
+        if not complete.any():
+            continue
+
+        finish = np.flatnonzero(complete)
+        finish = finish[np.argmin(steps[finish])]
+        if best is not None and steps[finish] >= best[3].max():
+            continue
+
+        rows = np.flatnonzero(episode == episode[finish])
+        rows = rows[np.argsort(steps[rows], kind='stable')]
+        rows = rows[steps[rows] <= steps[finish]]
+        best = (source, np.asarray(columns['x'])[rows],
+                np.asarray(columns['y'])[rows], steps[rows])
+
+    if best is None:
+        raise ValueError("no complete lap in %s" % ', '.join(paths))
+
+    return best
+
+
+def recorded_pace(track, x, y, steps):
+    '''
+    Pace table of a track from the registry from a recorded lap: the
+    positions and steps of its rows in order, wherever the lap started.
+    '''
+    points = np.stack([np.asarray(x, dtype=float),
+                       np.asarray(y, dtype=float)], axis=1)
+    segment, t, _ = track.spatial_index().query(points)
+    arc_length = np.asarray(track.arc_length)
+    arc = arc_length[segment] + t*np.asarray(track.segment_lengths)[segment]
+
+    # Distance since the start of the lap, across the start line and never
+    # going backwards
+    travelled = np.maximum.accumulate(np.unwrap(arc, period=track.length))
+    steps = np.asarray(steps, dtype=float)
+
+    # Steps when the lap passed each waypoint and the start line, at the
+    # first multiple of the track length from where it started
+    start = travelled[0]
+    laps = np.ceil((start - arc_length) / track.length)
+    at_waypoints = np.interp(arc_length + laps*track.length, travelled, steps)
+    at_line = np.interp(track.length * np.ceil(start / track.length),
+                        travelled, steps)
+    lap_steps = np.interp(start + track.length, travelled, steps) - steps[0]
+
+    pace = (at_waypoints - at_line) % lap_steps
+
+    # The last waypoint of a loop is the start line again, a lap later
+    if track.closed:
+        pace[-1] = lap_steps
+
+    return pace
+
+
+def load_reference(track, reference):
+    '''
+    Pace table of a track from the registry from a reference: a line of
+    speed_profile.LINES, a saved .npy table, or simtrace logs or log stores
+    (a path, or several separated by commas).
+    '''
+    if reference in speed_profile.LINES:
+        return np.asarray(pace_table(track, reference))
+
+    if reference.endswith('.npy'):
+        pace = np.load(reference)
+        if len(pace) != len(track):
+            raise ValueError("%s has %d waypoints, %s has %d"
+                             % (reference, len(pace), track.name,
+                                len(track)))
+        return pace
+
+    _, x, y, steps = best_lap(reference.split(','))
+    return recorded_pace(track, x, y, steps)
+
+
+def plot(waypoints, pace, headless=False):
+
+    fig, ax = new_figure(headless)
+    plot_values(ax, waypoints, pace, 'Reference steps from the start line',
+                cmap='magma')
+
+    return {'pace': fig}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--track', default=speed_profile.TRACK_FILE)
+    parser.add_argument('--reference', default='centre',
+                        help="%s, a saved .npy table, or simtrace logs or "
+                             "log stores separated by commas (default "
+                             "centre)" % ', '.join(speed_profile.LINES))
+    parser.add_argument('--table', action='store_true',
+                        help="print the table as a Python list")
+    parser.add_argument('--output', help="save the table as a .npy file")
+    parser.add_argument('--output-dir',
+                        help="save the map as a PNG file in this directory "
+                             "instead of showing it")
+    parser.add_argument('--no-plot', action='store_true')
+    args = parser.parse_args()
+
+    track = load_track(args.track)
+    try:
+        pace = load_reference(track, args.reference)
+    except ValueError as e:
+        parser.exit(1, "%s\n" % e)
+
+    print("%s: reference lap of %.0f steps (%.2f s) from %s"
+          % (track.name, pace[-1], pace[-1] / STEP_RATE, args.reference))
+
+    if args.output:
+        np.save(args.output, pace)
+        print(args.output)
+
+    if args.table:
+        print(waypoint_table(pace, 'PACE_TABLE', '%.1f'))
+
+    if args.no_plot:
+        return
+
+    headless = args.output_dir is not None
+    figures = plot(track.inner, pace, headless)
+
+    if headless:
+        for path in save_figures(figures, args.output_dir, track.name):
+            print(path)
+    else:
+        show()
+
+
+if __name__ == '__main__':
+    main()
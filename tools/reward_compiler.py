@@ -0,0 +1,726 @@
+'''
+Compile a declarative reward spec into a flat, self-contained reward file.
+
+A spec lists the sub-rewards (terms) of a reward with their weights and
+thresholds, e.g.
+
+    {"name": "final", "offtrack_reward": 0.001, "min_reward": 0.001,
+     "terms": [{"type": "centreline"},
+               {"type": "straight", "bonus": 0.3, "turn_threshold": 25},
+               {"type": "corner_speed", "fast_speed": 2.5}]}
+
+(see TERMS for the terms and their settings, whose defaults are those of
+reward_final.py). The compiler writes a reward_function with every constant
+folded into the code and the terms written out inline rather than called,
+the corner classification hoisted to module level with the geometry kernel,
+and the per-track corner tables and pace rows (see pace_table.py) of any
+--track embedded, so a known track needs no table building at all. A
+reward_function_batch is generated alongside it for the offline tools. The
+output is a single file that can be pasted into the console.
+
+--against checks the compiled reward against a hand-written one (fuzzing
+it for equal rewards) and times both per call on every bundled track. It
+exits non-zero if any reward differs by more than rounding (see
+fuzz_rewards.py) or the compiled one isn't faster.
+
+Example:
+    python reward_compiler.py final --track Spain --output final_spain.py \\
+        --against final
+    python reward_compiler.py my_spec.json --output my_reward.py
+'''
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+# rewards puts planning/ on the path for geometry and tracks
+from rewards import column_rows, load_reward, shared_params, synthetic_columns
+from bench_rewards import bench_function
+from bundle_rewards import bundle
+from fuzz_rewards import fuzz
+from geometry import pace_rows
+from pace_table import load_reference
+from tracks import available_tracks, load_track
+
+# Terms a spec can list, and the settings each takes with their defaults.
+# Every term also takes a weight, which multiplies what it adds.
+#   centreline:          1 at the centreline, falling to 0 at the edge
+#   progress_checkpoint: progress ahead of a lap of total_steps steps, every
+#                        so many steps
+#   progress_rate:       progress per step
+#   straight:            bonus for steering less than steering_threshold
+#                        while no corner is ahead
+#   corner_speed:        fast_bonus for going faster than fast_speed (and
+#                        steering less than steering_threshold, if set)
+#                        while no corner is ahead, slow_bonus for going
+#                        slower than slow_speed when there is one. With
+#                        mid_step and dist_threshold, a corner further away
+#                        than dist_threshold is checked again at mid_step,
+#                        as in reward_qualifier.py
+#   wheels_off:          penalty for any wheel off the track
+#   pace:                scale for every step ahead of the reference lap
+#                        (a reference of pace_table.py) at the car's
+#                        progress, within window % of the previous
+#                        waypoint's. Only on the tracks compiled in
+TERMS = {
+    'centreline': {},
+    'progress_checkpoint': {'every': 50, 'total_steps': 675},
+    'progress_rate': {},
+    'straight': {'bonus': 0.3, 'future_step': 8, 'turn_threshold': 25,
+                 'steering_threshold': 11},
+    'corner_speed': {'fast_bonus': 2.0, 'slow_bonus': 0.5, 'future_step': 6,
+                     'turn_threshold': 6, 'mid_step': None,
+                     'dist_threshold': None, 'fast_speed': 2,
+                     'slow_speed': 1.8, 'steering_threshold': 11},
+    'wheels_off': {'penalty': 0.5},
+    'pace': {'reference': 'centre', 'scale': 0.01, 'window': 2},
+}
+
+# Settings of the whole reward: the reward off the track (optionally also
+# with any wheel off it) and the least reward on it, if any
+DEFAULTS = {
+    'name': 'reward',
+    'offtrack_reward': 1e-3,
+    'wheels_off_is_offtrack': False,
+    'min_reward': 1e-3,
+    'terms': [],
+}
+
+# Params each term reads
+TERM_PARAMS = {
+    'centreline': ('distance_from_center', 'track_width'),
+    'progress_checkpoint': ('progress', 'steps'),
+    'progress_rate': ('progress', 'steps'),
+    'straight': ('steering_angle',),
+    'corner_speed': ('speed', 'steering_angle'),
+    'wheels_off': ('all_wheels_on_track',),
+    'pace': ('progress', 'steps'),
+}
+
+# How the batch function reads each param
+BATCH_PARAMS = {
+    'all_wheels_on_track': "np.asarray(params['all_wheels_on_track'], "
+                           "dtype=bool)",
+    'distance_from_center': "np.asarray(params['distance_from_center'], "
+                            "dtype=float)",
+    'progress': "np.asarray(params['progress'], dtype=float)",
+    'speed': "np.asarray(params['speed'], dtype=float)",
+    'steering_angle': "np.asarray(params['steering_angle'], dtype=float)",
+    'steps': "np.asarray(params['steps'])",
+    'track_width': "params['track_width']",
+}
+
+# The hand-written rewards as specs
+SPECS = {
+    'final': {
+        'name': 'final',
+        'terms': [
+            {'type': 'centreline'},
+            {'type': 'progress_checkpoint'},
+            {'type': 'straight'},
+            {'type': 'corner_speed'},
+            {'type': 'wheels_off'},
+        ],
+    },
+    'qualifier': {
+        'name': 'qualifier',
+        'wheels_off_is_offtrack': True,
+        'min_reward': None,
+        'terms': [
+            {'type': 'centreline'},
+            {'type': 'progress_rate'},
+            {'type': 'corner_speed', 'fast_bonus': 0.5, 'slow_bonus': 0.5,
+             'future_step': 7, 'mid_step': 4, 'turn_threshold': 10,
+             'dist_threshold': 1.2, 'fast_speed': 1.8, 'slow_speed': 1.8,
+             'steering_threshold': None},
+        ],
+    },
+}
+
+# Calls timed per track by --against
+BENCH_CALLS = 20000
+
+
+def load_spec(name):
+    '''
+    A spec by name (a key of SPECS) or from a JSON file.
+    '''
+    if name in SPECS:
+        return SPECS[name]
+
+    with open(name) as f:
+        return json.load(f)
+
+
+def resolve_spec(spec):
+    '''
+    The spec with every default filled in. Raises ValueError for unknown
+    settings or terms.
+    '''
+    unknown = set(spec) - set(DEFAULTS)
+    if unknown:
+        raise ValueError("unknown spec settings: %s"
+                         % ', '.join(sorted(unknown)))
+    resolved = dict(DEFAULTS, **spec)
+
+    terms = []
+    for term in resolved['terms']:
+        kind = term.get('type')
+        if kind not in TERMS:
+            raise ValueError("unknown term type %r" % kind)
+        settings = dict({'type': kind}, **TERMS[kind])
+        settings['weight'] = 1.0
+        unknown = set(term) - set(settings)
+        if unknown:
+            raise ValueError("unknown %s settings: %s"
+                             % (kind, ', '.join(sorted(unknown))))
+        settings.update(term)
+        terms.append(settings)
+    resolved['terms'] = terms
+
+    if sum(term['type'] == 'pace' for term in terms) > 1:
+        raise ValueError("a spec can only have one pace term")
+
+    return resolved
+
+
+def folded(value, weight=1.0):
+
+    # A constant with the weight folded in
+    return repr(value if weight == 1 else value * weight)
+
+
+def weighted(expression, weight):
+
+    return expression if weight == 1 else '%r * (%s)' % (weight, expression)
+
+
+def wrap_items(items, indent='    ', width=79):
+
+    # Comma separated items packed onto as few lines as fit
+    lines = []
+    line = indent
+    for item in items:
+        if line != indent and len(line) + len(item) + 1 > width:
+            lines.append(line.rstrip())
+            line = indent
+        line += item + ', '
+    lines.append(line.rstrip())
+
+    return lines
+
+
+def corner_classes(terms):
+    '''
+    The distinct corner tests the terms use, as (future_step,
+    turn_threshold, mid_step, dist_threshold), and the name of each term's
+    test in the generated code.
+    '''
+    tests = []
+    names = {}
+    for i, term in enumerate(terms):
+        if term['type'] not in ('straight', 'corner_speed'):
+            continue
+        test = (term['future_step'], term['turn_threshold'],
+                term.get('mid_step'), term.get('dist_threshold'))
+        if test not in tests:
+            tests.append(test)
+        names[i] = 'clear_%d' % tests.index(test)
+
+    return tests, names
+
+
+def steering_tests(terms):
+
+    # The name of each steering threshold the terms compare against
+    thresholds = []
+    names = {}
+    for i, term in enumerate(terms):
+        threshold = term.get('steering_threshold')
+        if term['type'] not in ('straight', 'corner_speed') or (
+                threshold is None):
+            continue
+        if threshold not in thresholds:
+            thresholds.append(threshold)
+        names[i] = 'steering_%d' % thresholds.index(threshold)
+
+    return thresholds, names
+
+
+def classes_code(tests):
+
+    # Module level function classifying the track ahead of a pair of
+    # closest waypoints with every corner test
+    lines = ['def corner_classes(waypoints, closest_waypoints):', '',
+             '    # Whether the track is clear of corners ahead, for each '
+             'corner test']
+    for k, (future_step, turn_threshold, mid_step, dist_threshold) in (
+            enumerate(tests)):
+        lines.append('    diff_heading, dist_future = identify_corner('
+                     'waypoints, closest_waypoints,')
+        lines.append('                                                '
+                     '%r)' % future_step)
+        if mid_step is None:
+            lines.append('    clear_%d = diff_heading < %r'
+                         % (k, turn_threshold))
+            continue
+
+        # A corner far enough away is checked again closer in
+        lines += [
+            '    clear_%d = diff_heading < %r' % (k, turn_threshold),
+            '    if not clear_%d and dist_future >= %r:'
+            % (k, dist_threshold),
+            '        clear_%d = identify_corner(waypoints, '
+            'closest_waypoints,' % k,
+            '                                  %r)[0] < %r'
+            % (mid_step, turn_threshold),
+        ]
+
+    names = ['clear_%d' % k for k in range(len(tests))]
+    lines += ['', '    return %s' % ('(%s,)' % names[0] if len(names) == 1
+                                      else ', '.join(names))]
+
+    return lines
+
+
+def tables_code(tables):
+
+    # Embedded table of each track, keyed by its fingerprint
+    lines = ['# Corner classes of each waypoint of the tracks compiled in, '
+             'index i for', '# closest_waypoints [i-1, i]',
+             'TRACK_TABLES = {}']
+    for name, (key, table, _) in tables.items():
+        lines += ['', '# %s' % name, 'TRACK_TABLES[(']
+        lines += wrap_items([repr(key[0])] + [repr(point)
+                                              for point in key[1:]])
+        lines.append(')] = (')
+        lines += wrap_items([repr(tuple(row)) for row in table])
+        lines.append(')')
+
+    return lines
+
+
+def pace_code(tables):
+
+    # Embedded pace rows of each track, keyed by its fingerprint
+    lines = ['# (progress, reference steps, steps per % of progress) at each '
+             'waypoint of the', '# tracks compiled in, from pace_table.py',
+             'PACE_TABLES = {}']
+    for name, (key, _, rows) in tables.items():
+        lines += ['', '# %s' % name, 'PACE_TABLES[(']
+        lines += wrap_items([repr(key[0])] + [repr(point)
+                                              for point in key[1:]])
+        lines.append(')] = (')
+        lines += wrap_items([repr(tuple(row)) for row in rows])
+        lines.append(')')
+
+    return lines
+
+
+def term_code(term, clear, steering):
+    '''
+    Lines adding one term to reward, in the scalar and batch functions.
+    '''
+    kind = term['type']
+    weight = term['weight']
+
+    if kind == 'centreline':
+        value = ('1 - (distance_from_center/(track_width/2))**0.25')
+        return (['reward += ' + weighted(value, weight)],
+                ['reward = reward + ' + weighted(value, weight)])
+
+    if kind == 'progress_checkpoint':
+        every = repr(term['every'])
+        total = repr(term['total_steps'])
+        ahead = 'progress - (steps/%s)*100' % total
+        return ([
+            'if steps %% %s == 0 and progress/100 > steps/%s:'
+            % (every, total),
+            '    reward += ' + weighted(ahead, weight),
+        ], [
+            'ahead = ((steps %% %s) == 0) & (progress/100 > (steps/%s))'
+            % (every, total),
+            'reward = np.where(ahead, reward + %s, reward)'
+            % weighted('(%s)' % ahead, weight),
+        ])
+
+    if kind == 'progress_rate':
+        return (['reward += ' + weighted('progress/steps', weight)],
+                ['reward = reward + ' + weighted('progress/steps', weight)])
+
+    if kind == 'straight':
+        bonus = folded(term['bonus'], weight)
+        if steering is None:
+            return (['if %s:' % clear, '    reward += ' + bonus],
+                    ['reward = np.where(%s, reward + %s, reward)'
+                     % (clear, bonus)])
+        return (['if %s and %s:' % (clear, steering),
+                 '    reward += ' + bonus],
+                ['reward = np.where(%s & %s, reward + %s, reward)'
+                 % (clear, steering, bonus)])
+
+    if kind == 'corner_speed':
+        fast = '%s and speed > %r' % (clear, term['fast_speed'])
+        fast_batch = '%s & (speed > %r)' % (clear, term['fast_speed'])
+        if steering is not None:
+            fast += ' and ' + steering
+            fast_batch += ' & ' + steering
+        return ([
+            'if %s:' % fast,
+            '    reward += ' + folded(term['fast_bonus'], weight),
+            'elif not %s and speed < %r:' % (clear, term['slow_speed']),
+            '    reward += ' + folded(term['slow_bonus'], weight),
+        ], [
+            'fast = ' + fast_batch,
+            'slow = ~%s & (speed < %r)' % (clear, term['slow_speed']),
+            'reward = np.where(fast, reward + %s,'
+            % folded(term['fast_bonus'], weight),
+            '                  np.where(slow, reward + %s, reward))'
+            % folded(term['slow_bonus'], weight),
+        ])
+
+    if kind == 'pace':
+        window = repr(term['window'])
+        scale = folded(term['scale'], weight)
+        return ([
+            'pace = LAST_TRACK[2]',
+            'if pace is not None:',
+            '    progress_prev, steps_prev, rate = pace[prev_index]',
+            '    offset = progress - progress_prev',
+            '    ahead = steps_prev + offset*rate - steps',
+            '    if abs(offset) < %s and ahead > 0:' % window,
+            '        reward += %s * ahead' % scale,
+        ], [
+            'if pace is not None:',
+            '    pace = np.array(pace)[prev_index]',
+            '    offset = progress - pace[:, 0]',
+            '    ahead = pace[:, 1] + offset*pace[:, 2] - steps',
+            '    reward = np.where((np.abs(offset) < %s) & (ahead > 0),'
+            % window,
+            '                      reward + %s*ahead, reward)' % scale,
+        ])
+
+    if kind == 'wheels_off':
+        penalty = folded(term['penalty'], weight)
+        return (['if not all_wheels_on_track:', '    reward -= ' + penalty],
+                ['reward = np.where(all_wheels_on_track, reward, '
+                 'reward - %s)' % penalty])
+
+
+def reward_code(spec, tests, names, thresholds, steering_names):
+
+    # The scalar and batch reward functions
+    terms = spec['terms']
+    used = sorted({param for term in terms
+                   for param in TERM_PARAMS[term['type']]})
+    if not thresholds:
+        used = [param for param in used if param != 'steering_angle']
+
+    offtrack = "params['is_offtrack']"
+    offtrack_batch = 'is_offtrack'
+    if spec['wheels_off_is_offtrack']:
+        offtrack = ("not params['all_wheels_on_track'] or "
+                    "params['is_offtrack']")
+        offtrack_batch = '~all_wheels_on_track | is_offtrack'
+        if 'all_wheels_on_track' not in used:
+            used = sorted(used + ['all_wheels_on_track'])
+
+    scalar = [
+        'def reward_function(params):',
+        "    '''",
+        '    Reward function for AWS DeepRacer, compiled from the %s spec.'
+        % spec['name'],
+        "    '''",
+        '',
+        '    # Strongly discourage going off track',
+        '    if %s:' % offtrack,
+        '        return %r' % float(spec['offtrack_reward']),
+        '',
+    ]
+    batch = [
+        'def reward_function_batch(params):',
+        "    '''",
+        '    Vectorised version of reward_function for scoring logged steps '
+        'offline.',
+        "    '''",
+        '',
+        "    is_offtrack = np.asarray(params['is_offtrack'], dtype=bool)",
+    ]
+
+    if tests or any(term['type'] == 'pace' for term in terms):
+        scalar += [
+            '    # Tables of the track, looked up again only when the '
+            'waypoints change',
+            "    waypoints = params['waypoints']",
+            '    if waypoints is not LAST_TRACK[0]:',
+            '        LAST_TRACK[:] = track_tables(waypoints)',
+            "    closest_waypoints = params['closest_waypoints']",
+            '    prev_index, next_index = closest_waypoints',
+            '',
+        ]
+        batch += [
+            "    waypoints = params['waypoints']",
+            "    closest_waypoints = np.asarray(params['closest_waypoints'], "
+            "dtype=int)",
+            '    prev_index = closest_waypoints[:, 0]',
+            '    next_index = closest_waypoints[:, 1]',
+            '    _, table, pace = track_tables(waypoints)',
+            '',
+        ]
+
+    if tests:
+        classes = ', '.join('clear_%d' % k for k in range(len(tests)))
+        if len(tests) == 1:
+            classes += ','
+        scalar += [
+            '    # Corner classes from the track table, unless the closest '
+            'waypoints',
+            '    # are not consecutive',
+            '    if prev_index == next_index - 1 or (',
+            '            next_index == 0 and '
+            'prev_index == len(waypoints) - 1):',
+            '        %s = LAST_TRACK[1][next_index]' % classes,
+            '    else:',
+            '        %s = corner_classes(waypoints, closest_waypoints)'
+            % classes,
+            '',
+        ]
+        batch += [
+            '    # Corner classes from the track table, and directly for any '
+            'pairs that',
+            '    # are not consecutive',
+            '    classes = np.array(table, dtype=bool)[next_index]',
+            '    consecutive = (prev_index == next_index - 1) | (',
+            '        (next_index == 0) & (prev_index == len(waypoints) - 1))',
+            '    for i in np.flatnonzero(~consecutive):',
+            '        classes[i] = corner_classes(waypoints,',
+            '                                    '
+            'closest_waypoints[i].tolist())',
+        ]
+        batch += ['    clear_%d = classes[:, %d]' % (k, k)
+                  for k in range(len(tests))]
+        batch.append('')
+
+    scalar += ["    %s = params['%s']" % (param, param) for param in used]
+    for param in used:
+        line = '    %s = %s' % (param, BATCH_PARAMS[param])
+        if len(line) > 79:
+            # Continue a long read under its opening bracket
+            first, rest = line.split(', ', 1)
+            line = first + ',\n' + ' ' * line.index('(', 4) + ' ' + rest
+        batch.append(line)
+    scalar += ['    steering_%d = abs(steering_angle) < %r' % (k, threshold)
+               for k, threshold in enumerate(thresholds)]
+    batch += ['    steering_%d = np.abs(steering_angle) < %r'
+              % (k, threshold) for k, threshold in enumerate(thresholds)]
+
+    # The first term that always adds starts the reward, rather than 0
+    scalar.append('')
+    batch.append('')
+    started = terms and terms[0]['type'] in ('centreline', 'progress_rate')
+    if not started:
+        scalar.append('    reward = 0.0')
+        batch.append('    reward = np.zeros(is_offtrack.shape)')
+
+    for i, term in enumerate(terms):
+        lines, batch_lines = term_code(term, names.get(i),
+                                       steering_names.get(i))
+        if i == 0 and started:
+            lines = [lines[0].replace('reward += ', 'reward = ', 1)]
+            batch_lines = [batch_lines[0].replace('reward = reward + ',
+                                                  'reward = ', 1)]
+        scalar += ['    ' + line for line in lines]
+        batch += ['    ' + line for line in batch_lines]
+
+    scalar.append('')
+    batch.append('')
+    if spec['min_reward'] is None:
+        scalar.append('    return reward')
+    else:
+        scalar.append('    return max(reward, %r)' % spec['min_reward'])
+        batch.append('    reward = np.maximum(reward, %r)'
+                     % spec['min_reward'])
+    batch.append('    return np.where(%s, %r, reward)'
+                 % (offtrack_batch, float(spec['offtrack_reward'])))
+
+    return scalar, batch
+
+
+def module_code(spec, tables):
+
+    # The whole reward file, with the geometry kernel still imported
+    tests, names = corner_classes(spec['terms'])
+    thresholds, steering_names = steering_tests(spec['terms'])
+    scalar, batch = reward_code(spec, tests, names, thresholds,
+                                steering_names)
+    spec_lines = json.dumps(spec, indent=4).split('\n')
+
+    lines = ["'''",
+             'Generated by tools/reward_compiler.py from the spec below. '
+             'Change the spec',
+             'and compile it again rather than editing this file.',
+             '']
+    lines += spec_lines + ["'''", 'import numpy as np', '']
+    if tests:
+        lines += ['from geometry import identify_corner', '', '']
+        lines += classes_code(tests) + ['', '']
+
+    paced = any(term['type'] == 'pace' for term in spec['terms'])
+    if tests or paced:
+        lines += [
+            'def track_fingerprint(waypoints):', '',
+            '    # The number of waypoints and a sample of points spread '
+            'around the track',
+            '    num_waypoints = len(waypoints)',
+            '    samples = [waypoints[i] for i in (0, num_waypoints // 3,',
+            '                                      2 * num_waypoints // 3, '
+            '-1)]',
+            '',
+            '    return (num_waypoints,) + tuple((p[0], p[1]) for p in '
+            'samples)',
+            '', '',
+            'def track_tables(waypoints):', '',
+            '    # The waypoints with their corner table and pace rows, '
+            'compiled in. Any',
+            '    # other track has its table built on first use, and no '
+            'pace rows',
+            '    key = track_fingerprint(waypoints)',
+        ]
+        if tests:
+            lines += [
+                '    table = TRACK_TABLES.get(key)',
+                '    if table is None:',
+                '        table = TRACK_TABLES[key] = tuple(',
+                '            corner_classes(waypoints, [i - 1, i])',
+                '            for i in range(len(waypoints)))',
+            ]
+        lines += ['', '    return waypoints, %s, %s'
+                  % ('table' if tests else 'None',
+                     'PACE_TABLES.get(key)' if paced else 'None'),
+                  '', '']
+        if tests:
+            lines += tables_code(tables) + ['']
+        if paced:
+            lines += pace_code(tables) + ['']
+        lines += ['# The waypoints of the last call and their tables, so a '
+                  'caller passing the',
+                  '# same list every step skips the fingerprint',
+                  'LAST_TRACK = [None, None, None]']
+    lines += ['', ''] + scalar + ['', ''] + batch
+
+    return '\n'.join(lines) + '\n'
+
+
+def console_source(source):
+
+    # Generated code only imports the kernel when it calls it
+    return bundle(source) if 'from geometry import' in source else source
+
+
+def compile_spec(spec, track_names=()):
+    '''
+    The source of the reward file for spec, with the corner tables and
+    pace rows of the tracks named embedded.
+    '''
+    spec = resolve_spec(spec)
+    pace = [term for term in spec['terms'] if term['type'] == 'pace']
+
+    # Build the tables with the generated code itself, so they match what
+    # it would build at run time
+    tables = {}
+    if track_names and (pace or corner_classes(spec['terms'])[0]):
+        namespace = {}
+        exec(console_source(module_code(spec, {})), namespace)
+        for name in track_names:
+            track = load_track(name)
+            waypoints = shared_params(track)['waypoints']
+            _, table, _ = namespace['track_tables'](waypoints)
+            rows = None
+            if pace:
+                rows = pace_rows(waypoints, load_reference(
+                    track, pace[0]['reference']).tolist())
+            tables[track.name] = (namespace['track_fingerprint'](waypoints),
+                                  table, rows)
+
+    return console_source(module_code(spec, tables))
+
+
+def compare(path, reference, track_names, num_steps, workers=None):
+    '''
+    Fuzz the compiled reward at path against the reference reward and time
+    both per call. Returns the fuzz summaries of the scalar and batch
+    functions and the ns/call of each on each track.
+    '''
+    scalar = fuzz([reference], [path], track_names, num_steps,
+                  workers=workers)[reference][path]
+    batch = path + ':reward_function_batch'
+    batch = fuzz([reference], [batch], track_names, num_steps,
+                 workers=workers)[reference][batch]
+
+    timings = {}
+    for name in track_names:
+        track = load_track(name)
+        rows = column_rows(synthetic_columns(track, BENCH_CALLS,
+                                             np.random.default_rng(0)),
+                           shared_params(track))
+        timings[track.name] = [
+            bench_function(load_reward(reward).reward_function, rows,
+                           5)['ns_per_call']
+            for reward in (reference, path)]
+
+    return scalar, batch, timings
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('spec', help="spec name (%s) or JSON file"
+                        % ', '.join(SPECS))
+    parser.add_argument('--output', required=True,
+                        help="write the compiled reward to this file")
+    parser.add_argument('--track', action='append', dest='tracks',
+                        default=[], help="embed the corner table and pace "
+                                         "rows of this track (repeatable)")
+    parser.add_argument('--against',
+                        help="check and time the compiled reward against "
+                             "this reward name or path")
+    parser.add_argument('--steps', type=int, default=100000,
+                        help="fuzzed steps per track for --against")
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    try:
+        source = compile_spec(load_spec(args.spec), args.tracks)
+    except ValueError as e:
+        sys.exit(str(e))
+    with open(args.output, 'w') as f:
+        f.write(source)
+    print(args.output)
+
+    if not args.against:
+        return
+
+    path = os.path.abspath(args.output)
+    scalar, batch, timings = compare(path, args.against, available_tracks(),
+                                     args.steps, args.workers)
+    for name, result in (('reward_function', scalar),
+                         ('reward_function_batch', batch)):
+        print("%s: %d of %d steps differ, %d more by rounding (largest "
+              "%.3g)" % (name, result['mismatches'], result['steps'],
+                         result['rounding'], result['max_diff']))
+    print("%-28s %12s %12s %8s" % ('track', args.against, 'compiled',
+                                   'speedup'))
+    slower = False
+    for name, (reference, compiled) in timings.items():
+        print("%-28s %9.0f ns %9.0f ns %7.2fx"
+              % (name, reference, compiled, reference / compiled))
+        slower |= compiled >= reference
+
+    if scalar['mismatches'] or batch['mismatches'] or slower:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+'''
+Reward landscape over a grid of positions, speeds and steering angles.
+
+Evaluates a reward's reward_function_batch at every combination of a
+waypoint, a lateral offset from the centreline (a fraction of the half
+width, beyond +-1 off the track), a speed and a steering angle. The car is
+placed halfway along the segment leaving each waypoint, pointing along the
+track, and located with the track's spatial index as rewards.position_columns
+does; steps are those of a lap at LAP_STEPS steps.
+
+The grid is evaluated in chunks of CHUNK_POINTS points, spread over a
+process pool, straight into a memory mapped .npy file of shape (waypoints,
+offsets, speeds, steering angles), so its size is bounded by the disk rather
+than RAM. Mean rewards per waypoint against each of the other axes are
+accumulated on the way and saved with the axis values to <output>_summary.npz,
+and shown as heatmaps.
+
+Example:
+    python reward_landscape.py final --track Spain --output spain.npy \\
+        --speeds 36 --steering 61 --output-dir maps
+'''
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# rewards puts planning/ on the path for plotting and tracks
+from rewards import load_reward, position_columns, shared_params
+from plotting import new_figure, plot_heatmap, save_figures, show
+from tracks import load_track
+
+# Default grid: lateral offset as a fraction of the half width, speed (m/s)
+# and steering angle (degrees), as (first, last, number of values)
+OFFSETS = (-1.2, 1.2, 49)
+SPEEDS = (0.5, 4.0, 36)
+STEERING = (-30.0, 30.0, 61)
+
+# Steps for a lap, which set steps from progress
+LAP_STEPS = 675
+
+# Points evaluated at once, and per job
+CHUNK_POINTS = 2**18
+JOB_POINTS = 2**22
+
+# Axes of the grid, and the summary maps of waypoint against each other axis
+AXES = ('waypoint', 'offset', 'speed', 'steering')
+SUMMARIES = ('offset', 'speed', 'steering')
+LABELS = {
+    'waypoint': 'Waypoint',
+    'offset': 'Offset (fraction of half width, left positive)',
+    'speed': 'Speed (m/s)',
+    'steering': 'Steering angle (degrees)',
+}
+
+
+def grid_axes(track, offsets=OFFSETS, speeds=SPEEDS, steering=STEERING,
+              waypoint_step=1):
+
+    # Waypoints whose following segment has a length
+    lengths = np.asarray(track.segment_lengths)[:-1]
+    waypoints = np.flatnonzero(lengths > 0)[::waypoint_step]
+
+    return {
+        'waypoint': waypoints,
+        'offset': np.linspace(*offsets[:2], int(offsets[2])),
+        'speed': np.linspace(*speeds[:2], int(speeds[2])),
+        'steering': np.linspace(*steering[:2], int(steering[2])),
+    }
+
+
+def position_params(track, axes):
+    '''
+    Params columns for every waypoint and offset of the grid, in that
+    order, without the speed and steering angle.
+    '''
+    centre = np.asarray(track.centre)
+    width = np.asarray(track.width)
+    waypoint = axes['waypoint']
+
+    # Halfway along each segment, offset along its left normal
+    segment = centre[waypoint + 1] - centre[waypoint]
+    normal = np.stack([-segment[:, 1], segment[:, 0]], axis=1)
+    normal /= np.hypot(*normal.T)[:, np.newaxis]
+    half_width = (width[waypoint] + width[waypoint + 1]) / 4
+    middle = (centre[waypoint] + centre[waypoint + 1]) / 2
+    offset = half_width[:, np.newaxis] * axes['offset']
+    position = (middle[:, np.newaxis] + offset[..., np.newaxis]
+                * normal[:, np.newaxis]).reshape(-1, 2)
+
+    heading = np.degrees(np.arctan2(segment[:, 1], segment[:, 0]))
+    columns = position_columns(track, position[:, 0], position[:, 1],
+                               heading=np.repeat(heading, len(offset[0])))
+    columns['steps'] = np.maximum(
+        1, np.round(columns['progress'] / 100 * LAP_STEPS)).astype(int)
+    del columns['speed'], columns['steering_angle']
+
+    return columns
+
+
+def landscape_job(job):
+    '''
+    Evaluate the flat range [first, last) of the grid into the output file.
+    Returns the sums of the rewards for each summary map.
+    '''
+    reward, track_name, path, axes, first, last = job
+    module = load_reward(reward)
+    track = load_track(track_name)
+    shared = shared_params(track)
+    positions = position_params(track, axes)
+
+    output = np.load(path, mmap_mode='r+')
+    flat = output.reshape(-1)
+    num_waypoints, num_offsets, num_speeds, num_steering = output.shape
+
+    sums = {name: np.zeros((num_waypoints, len(axes[name])))
+            for name in SUMMARIES}
+    for start in range(first, last, CHUNK_POINTS):
+        stop = min(start + CHUNK_POINTS, last)
+        position, speed, steering = np.unravel_index(
+            np.arange(start, stop),
+            (num_waypoints * num_offsets, num_speeds, num_steering))
+
+        columns = {key: value[position] for key, value in positions.items()}
+        columns['speed'] = axes['speed'][speed]
+        columns['steering_angle'] = axes['steering'][steering]
+        values = module.reward_function_batch(dict(columns, **shared))
+        flat[start:stop] = values
+
+        # Sums per waypoint and value of each other axis
+        waypoint = position // num_offsets
+        for name, index, size in (('offset', position, num_offsets),
+                                  ('speed', speed, num_speeds),
+                                  ('steering', steering, num_steering)):
+            if name != 'offset':
+                index = waypoint * size + index
+            sums[name] += np.bincount(
+                index, weights=values,
+                minlength=num_waypoints * size).reshape(num_waypoints, size)
+
+    output.flush()
+    return sums
+
+
+def landscape(reward, track_name, path, axes, dtype=np.float32,
+              workers=None):
+    '''
+    Evaluate the reward over the grid of axes (see grid_axes) into a .npy
+    file at path. Returns the mean reward per waypoint against each of the
+    offset, speed and steering axes.
+    '''
+    shape = tuple(len(axes[name]) for name in AXES)
+    output = np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                       shape=shape)
+    del output
+
+    size = int(np.prod(shape))
+    jobs = [(reward, track_name, path, axes, first,
+             min(first + JOB_POINTS, size))
+            for first in range(0, size, JOB_POINTS)]
+
+    if len(jobs) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(landscape_job, jobs))
+    else:
+        parts = [landscape_job(job) for job in jobs]
+
+    # Each map sums over the two axes it doesn't show
+    means = {}
+    for name in SUMMARIES:
+        count = size / (shape[0] * len(axes[name]))
+        means[name] = sum(part[name] for part in parts) / count
+
+    return means
+
+
+def summary_path(path):
+
+    return os.path.splitext(path)[0] + '_summary.npz'
+
+
+def plot(axes, means, headless=False):
+
+    figures = {}
+    for name in SUMMARIES:
+        fig, ax = new_figure(headless)
+        plot_heatmap(ax, means[name], axes[name], axes['waypoint'],
+                     LABELS[name], LABELS['waypoint'], 'Mean reward')
+        figures['landscape_' + name] = fig
+
+    return figures
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('reward', nargs='?', default='final',
+                        help="reward name or path (default final)")
+    parser.add_argument('--track', default='Spain')
+    parser.add_argument('--output', required=True,
+                        help="write the grid of rewards to this .npy file")
+    parser.add_argument('--offsets', type=int, default=OFFSETS[2],
+                        help="number of lateral offsets")
+    parser.add_argument('--speeds', type=int, default=SPEEDS[2],
+                        help="number of speeds")
+    parser.add_argument('--steering', type=int, default=STEERING[2],
+                        help="number of steering angles")
+    parser.add_argument('--waypoint-step', type=int, default=1,
+                        help="use every nth waypoint")
+    parser.add_argument('--float64', action='store_true',
+                        help="store double rather than single precision")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output-dir',
+                        help="save the heatmaps as PNG files in this "
+                             "directory instead of showing them")
+    parser.add_argument('--no-plot', action='store_true')
+    args = parser.parse_args()
+
+    track = load_track(args.track)
+    axes = grid_axes(track, OFFSETS[:2] + (args.offsets,),
+                     SPEEDS[:2] + (args.speeds,),
+                     STEERING[:2] + (args.steering,), args.waypoint_step)
+    size = int(np.prod([len(axes[name]) for name in AXES]))
+
+    start = time.perf_counter()
+    means = landscape(args.reward, track.name, args.output, axes,
+                      np.float64 if args.float64 else np.float32,
+                      args.workers)
+    seconds = time.perf_counter() - start
+    np.savez(summary_path(args.output), **axes,
+             **{'mean_' + name: means[name] for name in SUMMARIES})
+
+    rewards = np.load(args.output, mmap_mode='r')
+    print("%s: %d points %s in %.1f s (%.0f points/s)"
+          % (track.name, size, 'x'.join(map(str, rewards.shape)), seconds,
+             size / seconds))
+    for name in SUMMARIES:
+        best = np.argmax(means[name], axis=1)
+        print("Best mean %s per waypoint: %.2f to %.2f"
+              % (name, axes[name][best].min(), axes[name][best].max()))
+
+    if args.no_plot:
+        return
+
+    headless = args.output_dir is not None
+    figures = plot(axes, means, headless)
+
+    if headless:
+        for path in save_figures(figures, args.output_dir, track.name):
+            print(path)
+    else:
+        show()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,451 @@
+'''
+Opt-in profiler for the parts of a reward function.
+
+The rewards in reward/ add up separate parts (centreline, progress bonus,
+straightness and speed incentives, wheels-off penalty), each a statement of
+reward_function that changes reward under a comment saying what it is.
+RewardProfiler swaps every function of a loaded reward module for a probe
+that records, into counters allocated up front, how many times it was
+called, the time spent in it (including any functions it calls), how often
+it fired (returned a non-zero or true value) and a histogram of the values
+it returned. reward_function itself is swapped for a copy compiled from its
+source with each of those statements timed the same way, as a part named
+by its line and comment, which fires when it changes the reward and whose
+value is the change. Disabling the profiler puts the original functions
+back, so the rewards stay as they are and it costs nothing when it is not
+in use.
+
+The counters are written to a small .npz file every dump_every calls to
+reward_function and when the profiler is disabled, so a whole training run
+can be profiled without printing anything. Files from several workers can
+be summed with --show.
+
+Example:
+    python reward_profiler.py final --tracks Spain --calls 100000 \\
+        --output final.npz
+    python reward_profiler.py --show final.npz
+'''
+import argparse
+import ast
+import atexit
+import inspect
+import os
+import tempfile
+import textwrap
+import time
+
+import numpy as np
+
+from rewards import column_rows, load_reward, shared_params, synthetic_columns
+from tracks import load_track
+
+# Histogram of returned values, with an extra bin each side for values
+# outside the range
+HIST_RANGE = (-1.0, 5.0)
+HIST_BINS = 60
+
+# Write the counters after this many calls to reward_function
+DUMP_EVERY = 100000
+
+# The variable the parts of reward_function add up
+REWARD_VARIABLE = 'reward'
+
+
+def default_probes(module):
+
+    # Every function the module defines, apart from the batch versions which
+    # are not called per step
+    return [name for name, value in vars(module).items()
+            if callable(value)
+            and getattr(value, '__module__', None) == module.__name__
+            and not name.endswith('_batch')]
+
+
+def part_statements(function, variable=REWARD_VARIABLE):
+    '''
+    The syntax tree of a function's definition and the statements of its
+    body that assign to variable, with a name for each from its line and
+    the comment above it (or else the first one in it, or else its first
+    line). No parts if the source isn't available.
+    '''
+    try:
+        lines, first = inspect.getsourcelines(function)
+    except (OSError, TypeError):
+        return None, []
+
+    tree = ast.parse(textwrap.dedent(''.join(lines)))
+    ast.increment_lineno(tree, first - 1)
+
+    def comment(line):
+        text = lines[line - first].strip()
+        return text[1:].strip() if text.startswith('#') else None
+
+    parts = []
+    for statement in tree.body[0].body:
+        if not any(isinstance(node, ast.Name) and node.id == variable
+                   and isinstance(node.ctx, ast.Store)
+                   for node in ast.walk(statement)):
+            continue
+
+        # The first line of the comment block right above the statement
+        line = statement.lineno - 1
+        while line >= first and comment(line) is not None:
+            line -= 1
+        label = comment(line + 1) if line + 1 < statement.lineno else None
+        for inner in range(statement.lineno, statement.end_lineno + 1):
+            label = label or comment(inner)
+        label = label or lines[statement.lineno - first].strip()
+        parts.append((statement, "line %d %s" % (statement.lineno, label)))
+
+    return tree, parts
+
+
+def instrument(function, tree, parts, record, first_index,
+               variable=REWARD_VARIABLE):
+    '''
+    A copy of function compiled from its syntax tree, with each of the part
+    statements wrapped to call record(index, elapsed_ns, change), numbering
+    the parts from first_index. It runs in the function's module, so it
+    sees the same globals, including any probes.
+    '''
+    definition = tree.body[0]
+    definition.decorator_list = []
+    indices = {id(statement): first_index + i
+               for i, (statement, _) in enumerate(parts)}
+
+    # The reward is read around each part but outside its timing, and
+    # counts as 0.0 where the function hasn't assigned it yet, so the copy
+    # runs no statements of its own before the first part
+    body = []
+    for statement in definition.body:
+        if id(statement) not in indices:
+            body.append(statement)
+            continue
+        wrapped = ast.parse(
+            'try:\n'
+            '    _part_before = {0}\n'
+            'except NameError:\n'
+            '    _part_before = 0.0\n'
+            '_part_start = _timer()\n'
+            'try:\n'
+            '    pass\n'
+            'finally:\n'
+            '    _part_ns = _timer() - _part_start\n'
+            '    try:\n'
+            '        _part_change = {0} - _part_before\n'
+            '    except NameError:\n'
+            '        _part_change = 0.0\n'
+            '    _record({1}, _part_ns, _part_change)\n'
+            .format(variable, indices[id(statement)])).body
+        wrapped[-1].body = [statement]
+        body += wrapped
+    definition.body = body
+
+    # Bind the timer and the recorder as closure variables of the copy
+    factory = ast.parse('def _factory(_timer, _record):\n'
+                        '    return %s' % definition.name).body[0]
+    factory.body.insert(0, definition)
+    module = ast.fix_missing_locations(ast.Module(body=[factory],
+                                                  type_ignores=[]))
+    namespace = {}
+    exec(compile(module, inspect.getsourcefile(function), 'exec'),
+         function.__globals__, namespace)
+
+    return namespace['_factory'](time.perf_counter_ns, record)
+
+
+class RewardProfiler:
+    '''
+    Instruments the functions of a reward module loaded with
+    rewards.load_reward(), and the parts of its reward_function unless parts
+    is false. Call enable() (or use it as a context manager) and then call
+    module.reward_function as usual.
+
+    The counters are plain lists preallocated for every probe, one entry
+    per probe and bins + 2 histogram entries per probe, which is cheaper to
+    update from Python than NumPy arrays.
+    '''
+
+    def __init__(self, module, probes=None, path=None, dump_every=DUMP_EVERY,
+                 bins=HIST_BINS, value_range=HIST_RANGE, parts=True):
+        self.module = module
+        self.functions = list(probes if probes is not None
+                              else default_probes(module))
+        self.parts = parts and 'reward_function' in self.functions
+        self.names = list(self.functions)
+        if self.parts:
+            self.names += [name for _, name in
+                           part_statements(module.reward_function)[1]]
+        self.path = path
+        self.dump_every = dump_every
+        self.bins = bins
+        self.edges = np.linspace(value_range[0], value_range[1], bins + 1)
+        self.originals = {}
+
+        size = len(self.names)
+        self.calls = [0] * size
+        self.total_ns = [0] * size
+        self.fired = [0] * size
+        self.value_sum = [0.0] * size
+        self.hist = [0] * (size * (bins + 2))
+        self.elapsed_ns = 0
+        self.started = None
+        self.count = self.counter()
+
+    def counter(self):
+
+        # Bind everything the counter needs to locals of the closure
+        calls = self.calls
+        total_ns = self.total_ns
+        fired = self.fired
+        value_sum = self.value_sum
+        hist = self.hist
+        low, high = float(self.edges[0]), float(self.edges[-1])
+        scale = self.bins / (high - low)
+        stride = self.bins + 2
+
+        def count(index, elapsed_ns, result):
+            total_ns[index] += elapsed_ns
+            calls[index] += 1
+
+            if result.__class__ is tuple:
+                if any(result):
+                    fired[index] += 1
+            elif result:
+                fired[index] += 1
+
+            # Histogram numbers, including bools, with NaN in the lower bin
+            if isinstance(result, (int, float)):
+                value_sum[index] += result
+                first_bin = index * stride
+                if result >= low:
+                    if result < high:
+                        hist[first_bin + 1 + int((result - low)*scale)] += 1
+                    else:
+                        hist[first_bin + stride - 1] += 1
+                else:
+                    hist[first_bin] += 1
+
+        return count
+
+    def probe(self, index, function):
+
+        # Bind everything the probe needs to locals of the closure
+        calls = self.calls
+        count = self.count
+        timer = time.perf_counter_ns
+        dumps = (self.path is not None and self.dump_every
+                 and function.__name__ == 'reward_function')
+        dump_every = self.dump_every
+        dump = self.dump
+
+        def probed(*args, **kwargs):
+            start = timer()
+            result = function(*args, **kwargs)
+            count(index, timer() - start, result)
+
+            if dumps and calls[index] % dump_every == 0:
+                dump()
+
+            return result
+
+        probed.__name__ = function.__name__
+        probed.__doc__ = function.__doc__
+        probed.__wrapped__ = function
+        return probed
+
+    def enable(self):
+
+        if self.originals:
+            return self
+
+        for index, name in enumerate(self.functions):
+            function = getattr(self.module, name)
+            self.originals[name] = function
+            if name == 'reward_function' and self.parts:
+                tree, parts = part_statements(function)
+                function = instrument(function, tree, parts, self.count,
+                                      len(self.functions))
+            setattr(self.module, name, self.probe(index, function))
+        self.started = time.perf_counter_ns()
+
+        return self
+
+    def disable(self):
+
+        if not self.originals:
+            return
+
+        for name, function in self.originals.items():
+            setattr(self.module, name, function)
+        self.originals = {}
+        self.elapsed_ns += time.perf_counter_ns() - self.started
+        self.started = None
+
+        if self.path is not None:
+            self.dump()
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *exc_info):
+        self.disable()
+
+    def counters(self):
+        '''
+        The counters as a dict of NumPy arrays, in the layout written by
+        dump().
+        '''
+        elapsed_ns = self.elapsed_ns
+        if self.started is not None:
+            elapsed_ns += time.perf_counter_ns() - self.started
+
+        return {
+            'names': np.array(self.names),
+            'calls': np.array(self.calls, dtype=np.int64),
+            'total_ns': np.array(self.total_ns, dtype=np.int64),
+            'fired': np.array(self.fired, dtype=np.int64),
+            'value_sum': np.array(self.value_sum),
+            'hist': np.array(self.hist, dtype=np.int64).reshape(
+                len(self.names), self.bins + 2),
+            'edges': self.edges,
+            'elapsed_ns': np.int64(elapsed_ns),
+        }
+
+    def dump(self, path=None):
+
+        # Write to a temporary file and move it into place, so a reader never
+        # sees a partial file
+        path = os.path.abspath(path or self.path)
+        handle, staging = tempfile.mkstemp(dir=os.path.dirname(path),
+                                           suffix='.npz')
+        with os.fdopen(handle, 'wb') as f:
+            np.savez_compressed(f, **self.counters())
+        os.replace(staging, path)
+
+        return path
+
+
+def profile(module, path, **kwargs):
+    '''
+    Enable a profiler on module for the rest of the process, writing its
+    counters to path periodically and at exit. Meant for a local training
+    worker that loads the reward module itself; give each worker its own
+    path.
+    '''
+    profiler = RewardProfiler(module, path=path, **kwargs).enable()
+    atexit.register(profiler.disable)
+
+    return profiler
+
+
+def load_profiles(paths):
+    '''
+    Load dumped counters and sum them, e.g. over the workers of a training
+    run. All files must have the same probes and histogram edges.
+    '''
+    total = None
+    for path in paths:
+        with np.load(path) as data:
+            counters = {key: data[key] for key in data.files}
+
+        if total is None:
+            total = counters
+            continue
+
+        if (list(counters['names']) != list(total['names'])
+                or not np.array_equal(counters['edges'], total['edges'])):
+            raise ValueError("%s was not written by the same probes" % path)
+        for key in ('calls', 'total_ns', 'fired', 'value_sum', 'hist',
+                    'elapsed_ns'):
+            total[key] = total[key] + counters[key]
+
+    return total
+
+
+def format_profile(counters, histograms=False):
+
+    names = [str(name) for name in counters['names']]
+    calls = counters['calls']
+    total_ns = counters['total_ns']
+
+    # Share of the time is relative to reward_function, which includes the
+    # time of every other probe
+    if 'reward_function' in names:
+        reference = total_ns[names.index('reward_function')]
+    else:
+        reference = total_ns.sum()
+
+    # Parts of reward_function are named by their comments, so shorten them
+    # to keep the table narrow
+    width = 40
+    lines = ["%-*s %10s %9s %7s %7s %10s"
+             % (width, 'function', 'calls', 'ns/call', 'time %', 'fired %',
+                'mean')]
+    for i, name in enumerate(names):
+        if not calls[i]:
+            continue
+        lines.append("%-*s %10d %9.0f %7.1f %7.1f %10.4g"
+                     % (width, name[:width], calls[i], total_ns[i] / calls[i],
+                        100 * total_ns[i] / max(reference, 1),
+                        100 * counters['fired'][i] / calls[i],
+                        counters['value_sum'][i] / calls[i]))
+
+    if histograms:
+        edges = counters['edges']
+        labels = (['< %g' % edges[0]]
+                  + ['%g..%g' % (a, b) for a, b in zip(edges[:-1], edges[1:])]
+                  + ['>= %g' % edges[-1]])
+        for i, name in enumerate(names):
+            counts = counters['hist'][i]
+            if not counts.sum():
+                continue
+            lines.append('')
+            lines.append(name)
+            for b in np.flatnonzero(counts):
+                lines.append("    %-14s %10d" % (labels[b], counts[b]))
+
+    return '\n'.join(lines)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('reward', nargs='?', default='final',
+                        help="reward name or path to profile (default final)")
+    parser.add_argument('--tracks', nargs='+', default=['Spain'])
+    parser.add_argument('--calls', type=int, default=100000,
+                        help="params per track (default 100000)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output',
+                        help="write the counters to this .npz file")
+    parser.add_argument('--show', nargs='+', metavar='FILE',
+                        help="print the sum of dumped counters instead of "
+                             "profiling")
+    parser.add_argument('--histograms', action='store_true',
+                        help="also print the value histograms")
+    args = parser.parse_args()
+
+    if args.show:
+        print(format_profile(load_profiles(args.show), args.histograms))
+        return
+
+    module = load_reward(args.reward, fresh=True)
+    profiler = RewardProfiler(module, path=args.output)
+
+    with profiler:
+        for track_name in args.tracks:
+            track = load_track(track_name)
+            rng = np.random.default_rng(args.seed)
+            rows = column_rows(synthetic_columns(track, args.calls, rng),
+                               shared_params(track))
+            for params in rows:
+                module.reward_function(params)
+
+    print(format_profile(profiler.counters(), args.histograms))
+    if args.output:
+        print("Saved counters to %s" % args.output)
+
+
+if __name__ == '__main__':
+    main()
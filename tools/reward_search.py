@@ -0,0 +1,400 @@
+'''
+Search for reward constants in closed loop in the local simulator.
+
+Samples candidate settings of a reward spec (see reward_compiler.py): the
+thresholds and bonuses of its terms and the total_steps of its progress
+checkpoints (TOTAL_NUM_STEPS in reward_final.py). Each candidate is scored
+by how well its reward ranks the episodes of a mix of scripted drivers,
+pure pursuit at a spread of speeds, look-aheads and steering noise, so that
+some drive fast clean laps, some slow ones and some leave the track. An
+episode that completes a lap ranks by its steps, above every episode that
+left the track, which ranks by its progress. The score is the rank
+correlation (Spearman) between the discounted return the reward gives each
+episode and that ranking, averaged over the tracks: 1 for a reward that
+prefers every faster lap to a slower one and every lap to a crash.
+
+Candidates are weeded out by successive halving: all of them are scored
+with a few cars per track, the best 1/eta of them again with eta times as
+many cars, and so on until one is left or the cars would exceed --max-cars.
+Every candidate on every track is a job for a process pool. The drivers
+don't depend on the reward, so a worker drives a round's cars on a track
+once and scores every candidate it is given on the same episodes, with
+reward_function_batch over all of their steps at once.
+
+The spec as given is always candidate 0, to compare against. If it is
+weeded out, it is scored again in the last round, so that the scores of
+the two are on the same drivers.
+
+Example:
+    python reward_search.py final --candidates 27 --output best.json
+    python reward_compiler.py best.json --track Spain --output reward.py
+'''
+import argparse
+import copy
+import json
+import math
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# rewards puts planning/ on the path for tracks
+from rewards import shared_params
+from reward_compiler import compile_spec, load_spec, resolve_spec
+from simulator import STEP_RATE, Simulator, pure_pursuit
+from tracks import available_tracks, load_track
+
+# Settings searched, as type.setting of a term of the spec: (lowest,
+# highest), integers if both are
+SPACE = {
+    'progress_checkpoint.total_steps': (400, 900),
+    'straight.bonus': (0.0, 1.0),
+    'straight.turn_threshold': (10, 40),
+    'straight.steering_threshold': (5, 20),
+    'corner_speed.fast_bonus': (0.5, 4.0),
+    'corner_speed.slow_bonus': (0.0, 1.0),
+    'corner_speed.turn_threshold': (3, 15),
+    'corner_speed.fast_speed': (1.5, 3.0),
+    'corner_speed.slow_speed': (1.0, 2.5),
+}
+
+# Drivers, one per car: pure pursuit target speed (m/s), look-ahead
+# (metres) and steering noise (degrees), each uniform over its range
+DRIVER_SPEED = (1.0, 4.0)
+DRIVER_LOOKAHEAD = (0.4, 1.0)
+DRIVER_NOISE = (0.0, 15.0)
+
+# Steps simulated, as a multiple of a lap at the slowest driver's speed
+LAP_MARGIN = 1.25
+
+# Discount factor of the returns, DeepRacer's default
+DISCOUNT = 0.999
+
+# Successive halving: cars per track in the first round, and the fraction
+# of candidates kept after each round (1/ETA) and growth of the cars
+MIN_CARS = 32
+MAX_CARS = 1000
+ETA = 3
+
+# Rollouts kept by each worker process, the most recent first
+ROLLOUT_CACHE = 2
+ROLLOUTS = []
+
+
+def sample_candidates(spec, space, num_candidates, rng):
+    '''
+    The spec and num_candidates - 1 copies with the settings of space drawn
+    at random. Raises ValueError for settings of terms the spec doesn't
+    have, or that its terms don't take.
+    '''
+    types = {term['type'] for term in spec['terms']}
+    for name in space:
+        kind, _, setting = name.partition('.')
+        if kind not in types:
+            raise ValueError("the spec has no %s term for %s" % (kind, name))
+
+    candidates = [spec]
+    for _ in range(num_candidates - 1):
+        candidate = copy.deepcopy(spec)
+        for name, (low, high) in space.items():
+            kind, _, setting = name.partition('.')
+            if isinstance(low, int) and isinstance(high, int):
+                value = int(rng.integers(low, high + 1))
+            else:
+                value = round(float(rng.uniform(low, high)), 2)
+            for term in candidate['terms']:
+                if term['type'] == kind:
+                    term[setting] = value
+        resolve_spec(candidate)
+        candidates.append(candidate)
+
+    return candidates
+
+
+def candidate_settings(spec, space):
+
+    # The searched settings of a candidate, with the defaults of any the
+    # spec leaves out
+    terms = resolve_spec(spec)['terms']
+    settings = {}
+    for name in space:
+        kind, _, setting = name.partition('.')
+        settings[name] = next(term[setting] for term in terms
+                              if term['type'] == kind)
+
+    return settings
+
+
+def drivers(num_cars, seed):
+    '''
+    Controller for a mix of num_cars drivers, pure pursuit with a target
+    speed, look-ahead and steering noise of its own for each car.
+    '''
+    rng = np.random.default_rng(seed)
+    speed = rng.uniform(*DRIVER_SPEED, num_cars)
+    lookahead = rng.uniform(*DRIVER_LOOKAHEAD, num_cars)
+    noise = rng.uniform(*DRIVER_NOISE, num_cars)
+    pursuit = pure_pursuit(lookahead, speed)
+
+    def controller(sim):
+        steering, target = pursuit(sim)
+        return (steering + noise*sim.rng.standard_normal(sim.num_cars),
+                target)
+
+    return controller
+
+
+def rollout(track_name, num_cars, seed):
+    '''
+    The steps of num_cars drivers going round a track from the start line,
+    as params columns of every step of every episode that ended, with the
+    episode of each step, the discount of its reward, and the rank of each
+    episode's driving (see the module docstring) as a number.
+    '''
+    track = load_track(track_name)
+    sim = Simulator(track, num_cars, seed=seed, random_start=False)
+    controller = drivers(num_cars, seed)
+    num_steps = int(LAP_MARGIN * track.length / DRIVER_SPEED[0]
+                    * STEP_RATE)
+
+    steps = []
+    episodes = []
+    ended = []
+    quality = []
+    episode = np.arange(num_cars)
+    next_episode = num_cars
+    for _ in range(num_steps):
+        columns, done = sim.step(*controller(sim))
+        steps.append(columns)
+        episodes.append(episode)
+
+        # Laps rank above any progress, fewer steps higher
+        progress = columns['progress'][done]
+        ended.append(episode[done])
+        quality.append(np.where(
+            progress >= 100, 200 - 100*columns['steps'][done]/num_steps,
+            progress))
+
+        # Cars whose episode ended start a new one on the next step
+        episode = episode.copy()
+        episode[done] = next_episode + np.arange(done.sum())
+        next_episode += int(done.sum())
+
+    # Number the episodes that ended in order, and drop the steps of those
+    # cut off at the end
+    number = np.full(next_episode, -1)
+    ended = np.concatenate(ended)
+    number[ended] = np.arange(len(ended))
+    episode = number[np.concatenate(episodes)]
+    kept = episode >= 0
+
+    columns = {key: np.concatenate([s[key] for s in steps])[kept]
+               for key in steps[0]}
+
+    return {
+        'columns': columns,
+        'episode': episode[kept],
+        'discount': DISCOUNT ** (columns['steps'] - 1),
+        'quality': np.concatenate(quality),
+    }
+
+
+def cached_rollout(track_name, num_cars, seed):
+
+    # The rollout from this worker's cache, as every candidate of a round
+    # is scored on the same one
+    key = (track_name, num_cars, seed)
+    for cached_key, data in ROLLOUTS:
+        if cached_key == key:
+            return data
+
+    data = rollout(track_name, num_cars, seed)
+    ROLLOUTS.insert(0, (key, data))
+    del ROLLOUTS[ROLLOUT_CACHE:]
+
+    return data
+
+
+def ranks(values):
+
+    # Ranks from 0, tied values sharing the mean of their ranks
+    order = np.argsort(values, kind='stable')
+    ordered = values[order]
+    first = np.concatenate([[True], ordered[1:] != ordered[:-1]])
+    starts = np.flatnonzero(first)
+    ends = np.concatenate([starts[1:], [len(values)]])
+    result = np.empty(len(values))
+    result[order] = ((starts + ends - 1) / 2)[np.cumsum(first) - 1]
+
+    return result
+
+
+def rank_correlation(a, b):
+    '''
+    Spearman's rank correlation of a and b, 0 if either is constant.
+    '''
+    a = ranks(np.asarray(a))
+    b = ranks(np.asarray(b))
+    a -= a.mean()
+    b -= b.mean()
+    scale = math.sqrt(np.dot(a, a) * np.dot(b, b))
+
+    return float(np.dot(a, b) / scale) if scale > 0 else 0.0
+
+
+def score(reward_function_batch, data, shared):
+    '''
+    Rank correlation between the discounted returns reward_function_batch
+    gives the episodes of a rollout and the quality of their driving.
+    '''
+    rewards = reward_function_batch(dict(data['columns'], **shared))
+    returns = np.bincount(data['episode'], weights=rewards*data['discount'],
+                          minlength=len(data['quality']))
+
+    return rank_correlation(returns, data['quality'])
+
+
+def search_job(job):
+    '''
+    Score one candidate spec on one track. Returns the candidate's index
+    and its score.
+    '''
+    index, spec, track_name, num_cars, seed = job
+    namespace = {}
+    exec(compile_spec(spec), namespace)
+    data = cached_rollout(track_name, num_cars, seed)
+
+    return index, score(namespace['reward_function_batch'], data,
+                        shared_params(load_track(track_name)))
+
+
+def score_round(candidates, indices, track_names, num_cars, seed,
+                workers=None):
+
+    # Mean score over the tracks of each of the candidates indices, on the
+    # same drivers, grouped by track so the workers reuse their rollouts
+    jobs = [(index, candidates[index], name, num_cars, seed)
+            for name in track_names for index in indices]
+    if len(jobs) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(search_job, jobs))
+    else:
+        results = [search_job(job) for job in jobs]
+
+    scores = {index: 0.0 for index in indices}
+    for index, value in results:
+        scores[index] += value / len(track_names)
+
+    return scores
+
+
+def successive_halving(candidates, track_names, min_cars=MIN_CARS,
+                       max_cars=MAX_CARS, eta=ETA, seed=0, workers=None,
+                       report=None, reference=0):
+    '''
+    Weed out candidate specs by successive halving. Returns the index of
+    the best candidate and, for each round, the cars per track and the mean
+    score of each candidate still in it, by index. The last round also
+    scores the reference candidate if it was weeded out before, so that it
+    compares with the best on the same drivers. report, if given, is called
+    with each round as it finishes. Raises ValueError unless there are at
+    least two candidates, 1 <= min_cars <= max_cars and eta is at least 2.
+    '''
+    if len(candidates) < 2 or not 1 <= min_cars <= max_cars or eta < 2:
+        raise ValueError("successive halving needs at least two candidates, "
+                         "1 <= min_cars <= max_cars and eta >= 2")
+
+    alive = list(range(len(candidates)))
+    rounds = []
+    num_cars = min_cars
+    while len(alive) > 1 and num_cars <= max_cars:
+
+        # Every candidate on the same drivers, new ones each round
+        scores = score_round(candidates, alive, track_names, num_cars,
+                             seed + len(rounds), workers)
+        rounds.append((num_cars, scores))
+        if report:
+            report(num_cars, scores)
+
+        alive = sorted(alive, key=lambda index: -scores[index])
+        alive = alive[:max(1, math.ceil(len(alive) / eta))]
+        num_cars *= eta
+
+    last_cars, last_scores = rounds[-1]
+    if reference is not None and reference not in last_scores:
+        last_scores.update(score_round(candidates, [reference], track_names,
+                                       last_cars, seed + len(rounds) - 1,
+                                       workers))
+
+    return alive[0], rounds
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('spec', nargs='?', default='final',
+                        help="spec name or JSON file for reward_compiler.py "
+                             "(default final)")
+    parser.add_argument('--space',
+                        help="JSON file of the settings to search, as "
+                             "SPACE")
+    parser.add_argument('--candidates', type=int, default=27)
+    parser.add_argument('--tracks', nargs='+', default=available_tracks())
+    parser.add_argument('--min-cars', type=int, default=MIN_CARS,
+                        help="cars per track in the first round")
+    parser.add_argument('--max-cars', type=int, default=MAX_CARS,
+                        help="most cars per track in any round")
+    parser.add_argument('--eta', type=int, default=ETA,
+                        help="keep the best 1/eta candidates each round")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', help="save the best spec as JSON")
+    args = parser.parse_args()
+    if args.candidates < 2:
+        parser.error("--candidates must be at least 2")
+    if not 1 <= args.min_cars <= args.max_cars:
+        parser.error("--min-cars must be from 1 to --max-cars")
+    if args.eta < 2:
+        parser.error("--eta must be at least 2")
+
+    space = SPACE
+    if args.space:
+        with open(args.space) as f:
+            space = {name: tuple(bounds)
+                     for name, bounds in json.load(f).items()}
+
+    spec = load_spec(args.spec)
+    try:
+        candidates = sample_candidates(spec, space, args.candidates,
+                                       np.random.default_rng(args.seed))
+    except ValueError as e:
+        sys.exit(str(e))
+
+    def report(num_cars, scores):
+        print("%d candidates with %d cars per track:"
+              % (len(scores), num_cars))
+        for index in sorted(scores, key=lambda index: -scores[index])[:5]:
+            print("  %3d  %.4f" % (index, scores[index]))
+
+    best, rounds = successive_halving(candidates, args.tracks,
+                                      args.min_cars, args.max_cars,
+                                      args.eta, args.seed, args.workers,
+                                      report)
+
+    # The best and the spec as given, on the drivers of the last round
+    num_cars, scores = rounds[-1]
+    print("Best: candidate %d (%.4f), the spec as given %.4f, with %d cars "
+          "per track" % (best, scores[best], scores[0], num_cars))
+    given = candidate_settings(spec, space)
+    for name, value in candidate_settings(candidates[best], space).items():
+        print("  %-32s %8s  (%s)" % (name, value, given[name]))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(candidates[best], f, indent=4)
+            f.write('\n')
+        print(args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+'''
+Shared helpers for the offline tools: loading the reward functions in
+reward/ and building realistic params for them from the bundled tracks.
+
+The reward files are standalone scripts (so they can be pasted into the
+DeepRacer console) and the planning modules are plain scripts rather than a
+package, so both are loaded from their directories here.
+'''
+import importlib.util
+import os
+import sys
+
+import numpy as np
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir)
+REWARD_DIR = os.path.join(ROOT_DIR, 'reward')
+PLANNING_DIR = os.path.join(ROOT_DIR, 'planning')
+
+# Make the planning modules (tracks, corners, ...) importable from the tools
+if PLANNING_DIR not in sys.path:
+    sys.path.insert(0, PLANNING_DIR)
+
+REWARD_FILES = {
+    'final': os.path.join(REWARD_DIR, 'reward_final.py'),
+    'qualifier': os.path.join(REWARD_DIR, 'reward_qualifier.py'),
+    'simple': os.path.join(REWARD_DIR, 'dev', 'reward_simple.py'),
+    'extended': os.path.join(REWARD_DIR, 'dev', 'reward_extended.py'),
+    'combined_examples': os.path.join(REWARD_DIR, 'dev',
+                                      'reward_combined_examples.py'),
+    'ce_straight': os.path.join(REWARD_DIR, 'dev', 'reward_ce_straight.py'),
+}
+
+# Car dimensions used to decide whether wheels are off the track
+CAR_HALF_WIDTH = 0.1    # metres
+
+# Reward modules already loaded, keyed by path
+LOADED_REWARDS = {}
+
+
+def reward_path(name):
+
+    return os.path.abspath(REWARD_FILES.get(name, name))
+
+
+def load_reward(name, fresh=False):
+    '''
+    Load a reward module by name (a key of REWARD_FILES) or by path. Modules
+    are loaded once per process unless fresh is set.
+    '''
+    path = reward_path(name)
+    if path in LOADED_REWARDS and not fresh:
+        return LOADED_REWARDS[path]
+
+    module_name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    if not fresh:
+        LOADED_REWARDS[path] = module
+    return module
+
+
+def synthetic_columns(track, num_steps, rng):
+    '''
+    Random but realistic params for num_steps steps on a track from the
+    registry, as a dict of NumPy columns (see reward_function_batch). The
+    car is placed between its closest waypoints at a lateral offset around
+    the centreline, pointing roughly along the track, with progress and
+    steps consistent with a lap started at the first waypoint.
+    '''
+    centre = np.asarray(track.centre)
+    num_waypoints = len(centre)
+
+    # Position between consecutive waypoints
+    next_index = rng.integers(1, num_waypoints, num_steps)
+    prev_index = next_index - 1
+    along = rng.random(num_steps)
+    segment = centre[next_index] - centre[prev_index]
+    length = np.hypot(segment[:, 0], segment[:, 1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tangent = np.where(length[:, np.newaxis] > 0,
+                           segment / length[:, np.newaxis], [1.0, 0.0])
+    normal = np.stack([-tangent[:, 1], tangent[:, 0]], axis=1)
+
+    # Mostly on the track, occasionally over the edge
+    half_width = np.asarray(track.width)[prev_index] / 2
+    offset = rng.normal(0, 0.4, num_steps) * half_width
+    position = (centre[prev_index] + along[:, np.newaxis] * segment
+                + offset[:, np.newaxis] * normal)
+    distance = np.abs(offset)
+
+    heading = (np.asarray(track.headings)[prev_index]
+               + rng.normal(0, 10, num_steps))
+    heading = (heading + 180) % 360 - 180
+
+    # Progress from a start at the first waypoint, at a pace around the
+    # 45 second lap targeted by reward_final.py
+    arc = (np.asarray(track.arc_length)[prev_index] + along * length)
+    progress = np.clip(arc / track.length * 100, 0, 100)
+    steps = np.maximum(1, np.round(progress / 100 * 675
+                                   * rng.uniform(0.8, 1.4, num_steps)))
+    on_checkpoint = rng.random(num_steps) < 0.2
+    steps = np.where(on_checkpoint, np.maximum(50, np.round(steps/50)*50),
+                     steps).astype(int)
+
+    return {
+        'all_wheels_on_track': distance + CAR_HALF_WIDTH <= half_width,
+        'closest_waypoints': np.stack([prev_index, next_index], axis=1),
+        'distance_from_center': distance,
+        'heading': heading,
+        'is_left_of_center': offset > 0,
+        'is_offtrack': distance > half_width + CAR_HALF_WIDTH,
+        'is_reversed': np.zeros(num_steps, dtype=bool),
+        'progress': progress,
+        'speed': rng.uniform(1.0, 4.0, num_steps),
+        'steering_angle': rng.uniform(-30, 30, num_steps),
+        'steps': steps,
+        'x': position[:, 0],
+        'y': position[:, 1],
+    }
+
+
+def position_columns(track, x, y, heading=None, speed=0.0,
+                     steering_angle=0.0, steps=None, progress=None,
+                     start_index=0):
+    '''
+    Params columns for cars at positions x, y on a track from the registry,
+    located with the track's spatial index. heading (degrees) defaults to
+    the direction of the track. Unless given, the positions are taken as
+    consecutive steps of a lap started at waypoint start_index, which sets
+    steps and progress.
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    num_steps = len(x)
+    segment, t, offset = track.spatial_index().query(np.stack([x, y],
+                                                              axis=1))
+
+    width = np.asarray(track.width)
+    half_width = ((1 - t)*width[segment] + t*width[segment + 1]) / 2
+    distance = np.abs(offset)
+
+    if heading is None:
+        heading = np.asarray(track.headings)[segment]
+    if steps is None:
+        steps = np.arange(1, num_steps + 1)
+    if progress is None:
+        arc_length = np.asarray(track.arc_length)
+        arc = (arc_length[segment]
+               + t*np.asarray(track.segment_lengths)[segment]
+               - arc_length[start_index])
+        progress = np.clip(arc % track.length / track.length * 100, 0, 100)
+
+    def column(value, dtype=float):
+        return np.broadcast_to(np.asarray(value, dtype=dtype),
+                               (num_steps,)).copy()
+
+    return {
+        'all_wheels_on_track': distance + CAR_HALF_WIDTH <= half_width,
+        'closest_waypoints': np.stack([segment, segment + 1], axis=1),
+        'distance_from_center': distance,
+        'heading': column(heading),
+        'is_left_of_center': offset > 0,
+        'is_offtrack': distance > half_width + CAR_HALF_WIDTH,
+        'is_reversed': np.zeros(num_steps, dtype=bool),
+        'progress': column(progress),
+        'speed': column(speed),
+        'steering_angle': column(steering_angle),
+        'steps': column(steps, int),
+        'x': x,
+        'y': y,
+    }
+
+
+def shared_params(track):
+
+    # Params that are the same for every step on a track
+    return {
+        'track_length': track.length,
+        'track_width': float(np.median(track.width)),
+        'waypoints': np.asarray(track.centre).tolist(),
+    }
+
+
+def column_rows(columns, shared):
+    '''
+    Split columns into one params dict per step, with plain Python values as
+    the simulator would pass them to reward_function.
+    '''
+    keys = list(columns)
+    values = [columns[k].tolist() for k in keys]
+
+    return [dict(zip(keys, row), **shared) for row in zip(*values)]
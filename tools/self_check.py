@@ -0,0 +1,242 @@
+'''
+Self-checks of the invariants the rewards, planners and tools rely on.
+
+There is no test suite, so this checks on the bundled tracks what the
+pieces promise each other, and exits non-zero if anything is broken:
+
+    batch      every reward_function_batch matches its reward_function to
+               within rounding (see fuzz_rewards.py)
+    index      SpatialIndex.query() gives the same segments, positions and
+               offsets as the brute-force scan, on and off the track
+    compiled   the final spec compiled by reward_compiler.py scores every
+               step as reward_final.py does
+    pace       recorded_pace() of a lap at constant speed is linear in the
+               arc length
+    sweep      the summaries of sweep.py match each planner's classify() for
+               every configuration of a small grid
+
+Run it after changing the kernel, the rewards or the planners, along with
+bundle_rewards.py --check and bench_rewards.py --check.
+
+Example:
+    python self_check.py
+    python self_check.py pace sweep --steps 100000
+'''
+import argparse
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+# rewards puts planning/ on the path for the planners and tracks
+from rewards import REWARD_FILES, load_reward
+from fuzz_rewards import fuzz
+from pace_table import recorded_pace
+from reward_compiler import compile_spec, load_spec
+import final_planner
+import qualifier_planner
+import sweep
+from tracks import available_tracks, load_track
+
+# Random points per track for the spatial index, and how far past the
+# track's bounding box they reach (metres)
+INDEX_POINTS = 20000
+INDEX_MARGIN = 4.0
+
+# Steps of the constant-speed lap, and the largest error allowed in its
+# pace table (steps)
+PACE_LAP_STEPS = 1000
+PACE_TOLERANCE = 1e-6
+
+# Grid of each planner's parameters checked against classify()
+SWEEP_GRIDS = {
+    'final': {
+        'FUTURE_STEP_SPEED': [3, 6, 9],
+        'TURN_THRESHOLD_SPEED': [4, 6, 10],
+        'FUTURE_STEP_STRAIGHT': [5, 8],
+        'TURN_THRESHOLD_STRAIGHT': [15, 25],
+    },
+    'qualifier': {
+        'FUTURE_STEP': [5, 7],
+        'MID_STEP': [2, 4],
+        'TURN_THRESHOLD': [6, 10],
+        'DIST_THRESHOLD': [1.0, 1.2],
+        'FUTURE_DIST': [np.nan, 1.0, 2.5],
+    },
+}
+
+
+def mismatches(summary):
+
+    # Failures of a fuzz_rewards.fuzz() summary
+    return ["%s against %s: %d of %d steps differ (largest %.3g)"
+            % (reward, candidate, result['mismatches'], result['steps'],
+               result['max_diff'])
+            for reward, results in summary.items()
+            for candidate, result in results.items()
+            if result['mismatches']]
+
+
+def check_batch(track_names, num_steps, workers=None):
+
+    rewards = [name for name in REWARD_FILES
+               if hasattr(load_reward(name), 'reward_function_batch')]
+    return mismatches(fuzz(rewards, ['batch'], track_names, num_steps,
+                           workers=workers))
+
+
+def check_index(track_names, num_steps, workers=None):
+
+    rng = np.random.default_rng(0)
+    failures = []
+    for name in track_names:
+        track = load_track(name)
+        centre = np.asarray(track.centre)
+
+        # Anywhere around the track, and close to the centreline
+        points = np.concatenate([
+            rng.uniform(centre.min(axis=0) - INDEX_MARGIN,
+                        centre.max(axis=0) + INDEX_MARGIN,
+                        (INDEX_POINTS // 2, 2)),
+            centre[rng.integers(0, len(centre), INDEX_POINTS // 2)]
+            + rng.normal(0, 0.5, (INDEX_POINTS // 2, 2)),
+            centre])
+
+        index = track.spatial_index()
+        for first in range(0, len(points), 2000):
+            chunk = points[first:first + 2000]
+            fast = index.query(chunk)
+            slow = index.query_brute_force(chunk)
+            wrong = ~np.all([a == b for a, b in zip(fast, slow)], axis=0)
+            if wrong.any():
+                failures.append("%s: query() differs from the full scan at "
+                                "%s" % (track.name,
+                                        chunk[np.argmax(wrong)].tolist()))
+                break
+
+    return failures
+
+
+def check_compiled(track_names, num_steps, workers=None):
+
+    source = compile_spec(load_spec('final'), track_names)
+    handle, path = tempfile.mkstemp(suffix='.py', prefix='compiled_final_')
+    try:
+        with os.fdopen(handle, 'w') as f:
+            f.write(source)
+        return mismatches(fuzz(['final'],
+                               [path, path + ':reward_function_batch'],
+                               track_names, num_steps, workers=workers))
+    finally:
+        os.remove(path)
+
+
+def check_pace(track_names, num_steps, workers=None):
+
+    failures = []
+    for name in track_names:
+        track = load_track(name)
+        arc_length = np.asarray(track.arc_length)
+        centre = np.asarray(track.centre)
+
+        # A little over a lap along the centreline at constant speed, from
+        # partway round
+        steps = np.arange(int(PACE_LAP_STEPS * 1.05))
+        arc = (0.37*track.length + steps*track.length/PACE_LAP_STEPS
+               ) % track.length
+        x = np.interp(arc, arc_length, centre[:, 0])
+        y = np.interp(arc, arc_length, centre[:, 1])
+
+        pace = recorded_pace(track, x, y, steps)
+        expected = arc_length / track.length * PACE_LAP_STEPS
+        error = np.abs(pace - expected).max()
+        if error > PACE_TOLERANCE:
+            failures.append("%s: the pace of a constant-speed lap is off "
+                            "linear by up to %.3g steps" % (track.name, error))
+
+    return failures
+
+
+def check_sweep(track_names, num_steps, workers=None):
+
+    planners = {'final': final_planner, 'qualifier': qualifier_planner}
+    failures = []
+    for mode, grid in SWEEP_GRIDS.items():
+        planner = planners[mode]
+        waypoints = planner.load_waypoints(planner.TRACK_FILE)
+        results = sweep.sweep(mode, waypoints, grid, workers=workers)
+
+        for i in range(len(results['fast'])):
+            params = {name: results[name][i] for name in grid}
+            for name, value in params.items():
+                if 'STEP' in name:
+                    params[name] = int(value)
+                elif np.isnan(value):
+                    params[name] = None
+
+            # The same summaries from the planner's own classes
+            classes = planner.classify(waypoints, params)
+            if mode == 'final':
+                speed, straight = classes
+                expected = {'straight': np.mean(
+                    straight == final_planner.STRAIGHT)}
+                fast = speed == final_planner.FAST
+            else:
+                expected = {'bonus_fast': np.mean(
+                    classes == qualifier_planner.BONUS_FAST)}
+                fast = classes != qualifier_planner.SLOW
+            expected.update(
+                fast=np.mean(fast), slow=1 - np.mean(fast),
+                switches=np.count_nonzero(fast != np.roll(fast, 1)),
+                longest_fast=sweep.circular_longest_run(fast[np.newaxis])[0])
+
+            wrong = [key for key, value in expected.items()
+                     if not np.isclose(results[key][i], value)]
+            if wrong:
+                failures.append("%s sweep differs from classify() for %s in "
+                                "%s" % (mode, params, ', '.join(wrong)))
+                break
+
+    return failures
+
+
+CHECKS = {
+    'batch': check_batch,
+    'index': check_index,
+    'compiled': check_compiled,
+    'pace': check_pace,
+    'sweep': check_sweep,
+}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('checks', nargs='*',
+                        help="checks to run, of %s (default all)"
+                             % ', '.join(CHECKS))
+    parser.add_argument('--steps', type=int, default=20000,
+                        help="fuzzed steps per reward and track for the "
+                             "batch and compiled checks (default 20000)")
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    unknown = [name for name in args.checks if name not in CHECKS]
+    if unknown:
+        parser.error("unknown checks: %s" % ', '.join(unknown))
+
+    track_names = available_tracks()
+    failed = False
+    for name in args.checks or list(CHECKS):
+        failures = CHECKS[name](track_names, args.steps, args.workers)
+        print("%-10s %s" % (name, 'ok' if not failures else 'FAILED'))
+        for failure in failures:
+            print("    " + failure)
+        failed |= bool(failures)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
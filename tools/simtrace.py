@@ -0,0 +1,355 @@
+'''
+Streaming analytics for DeepRacer simtrace training logs.
+
+Reads the simtrace files downloaded from a training run: the per-iteration
+CSV files (training-simtrace/*-iteration.csv), RoboMaker logs whose
+SIM_TRACE_LOG lines hold the same fields, and .tar/.tar.gz archives of
+either. Files are read in blocks of rows that are converted to NumPy
+columns and folded into running totals, so memory stays constant however
+large the logs are, and separate files are processed in parallel.
+
+For every episode this reports the steps, the progress reached, how it
+ended, the share of steps with wheels off the track, the total reward and,
+for completed laps, the lap time. Speeds are also collected per closest
+waypoint as a histogram.
+
+Example:
+    python simtrace.py logs/*.tar.gz --episodes episodes.csv
+'''
+import argparse
+import codecs
+import csv
+import itertools
+import os
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Fields of a SIM_TRACE_LOG line and of the CSV header
+FIELDS = ('episode', 'steps', 'x', 'y', 'yaw', 'steer', 'throttle',
+          'action', 'reward', 'done', 'all_wheels_on_track', 'progress',
+          'closest_waypoint', 'track_len', 'tstamp', 'episode_status')
+LOG_PREFIX = 'SIM_TRACE_LOG:'
+
+# Rows converted and folded at a time
+BLOCK_ROWS = 50000
+
+# Speed histogram bins per waypoint
+SPEED_BINS = np.linspace(0, 4, 41)  # m/s
+
+# Simulator rate, for lap times when there are no timestamps
+STEP_RATE = 15          # Hz
+
+
+class EpisodeTotals:
+    '''
+    Running totals of one episode.
+    '''
+
+    def __init__(self):
+        self.steps = 0
+        self.last_step = 0
+        self.reward = 0.0
+        self.progress = 0.0
+        self.offtrack_steps = 0
+        self.start_time = np.inf
+        self.end_time = -np.inf
+        self.status = ''
+
+    def as_row(self):
+
+        complete = self.progress >= 100 or self.status == 'lap_complete'
+        if np.isfinite(self.start_time) and self.end_time > self.start_time:
+            seconds = self.end_time - self.start_time
+        else:
+            seconds = self.last_step / STEP_RATE
+
+        return {
+            'steps': self.last_step,
+            'progress': self.progress,
+            'status': self.status,
+            'offtrack_rate': self.offtrack_steps / max(self.steps, 1),
+            'reward': self.reward,
+            'lap_time': seconds if complete else None,
+        }
+
+
+class Totals:
+    '''
+    Totals of a file, or of several merged: the episodes keyed by their
+    source and episode number, and the speed histogram per waypoint.
+    '''
+
+    def __init__(self):
+        self.episodes = {}
+        self.speeds = np.zeros((0, len(SPEED_BINS) - 1), dtype=np.int64)
+        self.rows = 0
+
+    def add_block(self, source, columns):
+
+        self.rows += len(columns['episode'])
+        episode = columns['episode'].astype(np.int64)
+        numbers, inverse = np.unique(episode, return_inverse=True)
+
+        # Reduce the block per episode, then fold into the running totals
+        count = np.bincount(inverse)
+        reward = np.bincount(inverse, weights=columns['reward'])
+        offtrack = np.bincount(inverse,
+                               weights=~columns['all_wheels_on_track'])
+        last_step = np.zeros(len(numbers))
+        np.maximum.at(last_step, inverse, columns['steps'])
+        progress = np.zeros(len(numbers))
+        np.maximum.at(progress, inverse, columns['progress'])
+        start = np.full(len(numbers), np.inf)
+        np.minimum.at(start, inverse, columns['tstamp'])
+        end = np.full(len(numbers), -np.inf)
+        np.maximum.at(end, inverse, columns['tstamp'])
+
+        # The status of an episode is that of its last row
+        status = columns['episode_status']
+        last_row = np.zeros(len(numbers), dtype=np.int64)
+        np.maximum.at(last_row, inverse, np.arange(len(episode)))
+
+        for i, number in enumerate(numbers.tolist()):
+            totals = self.episodes.setdefault((source, number),
+                                              EpisodeTotals())
+            totals.steps += int(count[i])
+            totals.last_step = max(totals.last_step, int(last_step[i]))
+            totals.reward += float(reward[i])
+            totals.progress = max(totals.progress, float(progress[i]))
+            totals.offtrack_steps += int(offtrack[i])
+            totals.start_time = min(totals.start_time, float(start[i]))
+            totals.end_time = max(totals.end_time, float(end[i]))
+            if status is not None:
+                totals.status = status[last_row[i]]
+
+        # Speed histogram per closest waypoint, grown as waypoints appear
+        waypoint = columns['closest_waypoint'].astype(np.int64)
+        if len(waypoint) and waypoint.max() >= len(self.speeds):
+            grown = np.zeros((waypoint.max() + 1, self.speeds.shape[1]),
+                             dtype=np.int64)
+            grown[:len(self.speeds)] = self.speeds
+            self.speeds = grown
+        speed_bin = np.clip(np.searchsorted(SPEED_BINS, columns['throttle'],
+                                            side='right') - 1,
+                            0, len(SPEED_BINS) - 2)
+        np.add.at(self.speeds, (waypoint, speed_bin), 1)
+
+    def merge(self, other):
+
+        self.episodes.update(other.episodes)
+        if len(other.speeds) > len(self.speeds):
+            self.speeds, other_speeds = other.speeds.copy(), self.speeds
+        else:
+            other_speeds = other.speeds
+        self.speeds[:len(other_speeds)] += other_speeds
+        self.rows += other.rows
+
+        return self
+
+
+def parse_bool(values):
+
+    return np.char.lower(np.asarray(values, dtype=str)) == 'true'
+
+
+def to_columns(rows, names):
+
+    # Convert a block of rows of strings into NumPy columns
+    columns = dict(zip(names, zip(*rows))) if rows else {}
+    result = {}
+    for name in ('episode', 'steps', 'x', 'y', 'yaw', 'steer', 'throttle',
+                 'action', 'reward', 'progress', 'closest_waypoint',
+                 'track_len', 'tstamp'):
+        if name in columns:
+            result[name] = np.asarray(columns[name], dtype=float)
+        else:
+            result[name] = np.full(len(rows), np.nan)
+    result['all_wheels_on_track'] = (parse_bool(columns['all_wheels_on_track'])
+                                     if 'all_wheels_on_track' in columns
+                                     else np.ones(len(rows), dtype=bool))
+    result['done'] = (parse_bool(columns['done']) if 'done' in columns
+                      else np.zeros(len(rows), dtype=bool))
+    result['episode_status'] = (np.asarray(columns['episode_status'])
+                                if 'episode_status' in columns else None)
+
+    return result
+
+
+def read_rows(stream):
+    '''
+    Rows of a simtrace text stream as (field names, row) pairs, from a CSV
+    file with a header or from log lines starting with SIM_TRACE_LOG.
+    '''
+    first = next(stream, '')
+    if first.strip().lower().startswith('episode'):
+        names = tuple(name.strip().lower()
+                      for name in next(csv.reader([first])))
+        for row in csv.reader(stream):
+            if row:
+                yield names, row
+        return
+
+    lines = (line[len(LOG_PREFIX):] for line in itertools.chain([first],
+                                                                stream)
+             if line.startswith(LOG_PREFIX))
+    for row in csv.reader(lines):
+        yield FIELDS[:len(row)], row
+
+
+def fold_stream(totals, source, stream):
+
+    # Fold the rows of a stream into totals a block at a time
+    block = []
+    block_names = None
+    for names, row in read_rows(stream):
+        if names != block_names and block:
+            totals.add_block(source, to_columns(block, block_names))
+            block = []
+        block_names = names
+        block.append(row)
+        if len(block) == BLOCK_ROWS:
+            totals.add_block(source, to_columns(block, block_names))
+            block = []
+
+    if block:
+        totals.add_block(source, to_columns(block, block_names))
+
+
+def text_streams(path):
+    '''
+    (name, text stream) for a simtrace file, or for each file in an archive,
+    read lazily.
+    '''
+    if tarfile.is_tarfile(path):
+        with tarfile.open(path, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile() and member.name.endswith(('.csv',
+                                                             '.log')):
+                    # Members of a streamed archive can't seek, which
+                    # io.TextIOWrapper needs
+                    raw = archive.extractfile(member)
+                    yield (os.path.join(path, member.name),
+                           codecs.getreader('utf-8')(raw, errors='replace'))
+    else:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            yield path, f
+
+
+def analyse_file(path):
+
+    totals = Totals()
+    for source, stream in text_streams(path):
+        fold_stream(totals, source, stream)
+
+    return totals
+
+
+def analyse(paths, workers=None):
+    '''
+    Totals of all the simtrace files and archives in paths, each read in
+    its own process.
+    '''
+    if len(paths) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(analyse_file, paths))
+    else:
+        parts = [analyse_file(path) for path in paths]
+
+    totals = Totals()
+    for part in parts:
+        totals.merge(part)
+
+    return totals
+
+
+def episode_table(totals):
+
+    rows = []
+    for (source, number), episode in sorted(totals.episodes.items()):
+        rows.append(dict(source=source, episode=number, **episode.as_row()))
+
+    return rows
+
+
+def summarise(rows):
+
+    progress = np.array([r['progress'] for r in rows])
+    laps = np.array([r['lap_time'] for r in rows
+                     if r['lap_time'] is not None])
+    offtrack = np.array([r['status'] == 'off_track' for r in rows])
+
+    return {
+        'episodes': len(rows),
+        'mean_progress': float(progress.mean()) if len(rows) else 0.0,
+        'completion_rate': len(laps) / max(len(rows), 1),
+        'offtrack_rate': float(offtrack.mean()) if len(rows) else 0.0,
+        'mean_reward': (float(np.mean([r['reward'] for r in rows]))
+                        if rows else 0.0),
+        'best_lap_time': float(laps.min()) if len(laps) else None,
+        'mean_lap_time': float(laps.mean()) if len(laps) else None,
+    }
+
+
+def waypoint_speeds(speeds):
+
+    # Mean speed and step count at each waypoint from the histograms
+    centres = (SPEED_BINS[:-1] + SPEED_BINS[1:]) / 2
+    counts = speeds.sum(axis=1)
+    with np.errstate(invalid='ignore'):
+        mean = (speeds @ centres) / counts
+
+    return mean, counts
+
+
+def print_summary(totals, rows):
+
+    summary = summarise(rows)
+    print("Rows: %d" % totals.rows)
+    print("Episodes: %d" % summary['episodes'])
+    print("Mean progress: %.1f%%" % summary['mean_progress'])
+    print("Completed laps: %.1f%%" % (100 * summary['completion_rate']))
+    print("Ended off track: %.1f%%" % (100 * summary['offtrack_rate']))
+    print("Mean reward per episode: %.2f" % summary['mean_reward'])
+    if summary['best_lap_time'] is not None:
+        print("Lap time: best %.2f s, mean %.2f s"
+              % (summary['best_lap_time'], summary['mean_lap_time']))
+
+    mean, counts = waypoint_speeds(totals.speeds)
+    if counts.any():
+        slowest = np.argsort(np.where(counts > 0, mean, np.inf))[:5]
+        print("Slowest waypoints: %s" % ', '.join(
+            '%d (%.2f m/s)' % (w, mean[w]) for w in slowest if counts[w]))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('paths', nargs='+',
+                        help="simtrace CSV or log files, or tar archives")
+    parser.add_argument('--episodes',
+                        help="write the per-episode table to this CSV file")
+    parser.add_argument('--speeds',
+                        help="save the per-waypoint speed histograms to "
+                             "this .npy file")
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    totals = analyse(args.paths, args.workers)
+    rows = episode_table(totals)
+    print_summary(totals, rows)
+
+    if args.episodes:
+        with open(args.episodes, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows
+                                    else ['source', 'episode'])
+            writer.writeheader()
+            writer.writerows(rows)
+
+    if args.speeds:
+        np.save(args.speeds, totals.speeds)
+
+
+if __name__ == '__main__':
+    main()
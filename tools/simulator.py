@@ -0,0 +1,317 @@
+'''
+Local kinematic simulator for running the reward functions in closed loop.
+
+Steps many cars at once at the DeepRacer rate of 15 Hz on any track in the
+registry, using a kinematic bicycle model. After every step it returns the
+params the DeepRacer simulator passes to reward_function, as NumPy columns
+with one value per car (see reward_function_batch), so a reward can be
+driven for hundreds of thousands of steps a second on a CPU.
+
+Cars that leave the track or complete a lap start a new episode on the
+following step, from a random waypoint or the start line.
+
+Example:
+    python simulator.py final --track Spain --cars 1000 --steps 2000
+'''
+import argparse
+import time
+
+import numpy as np
+
+from rewards import CAR_HALF_WIDTH, load_reward, shared_params
+from tracks import load_track
+
+# Simulator rate used by DeepRacer
+STEP_RATE = 15          # Hz
+
+# Car model
+WHEELBASE = 0.16        # metres, roughly that of a DeepRacer car
+MAX_STEERING = 30       # degrees
+MAX_ACCELERATION = 4.0  # m/s^2, limits changes of speed between steps
+
+
+class Simulator:
+    '''
+    num_cars cars on a track from the registry. The state is held in
+    arrays with one entry per car: position x, y (metres), heading (radians)
+    and speed (m/s), plus the centreline segment each car is on, its arc
+    length along the centreline, the distance it has covered this episode
+    and its step count.
+    '''
+
+    def __init__(self, track, num_cars, seed=0, random_start=True,
+                 wheelbase=WHEELBASE, max_acceleration=MAX_ACCELERATION):
+        self.track = track if hasattr(track, 'centre') else load_track(track)
+        self.num_cars = num_cars
+        self.rng = np.random.default_rng(seed)
+        self.random_start = random_start
+        self.wheelbase = wheelbase
+        self.max_acceleration = max_acceleration
+        self.dt = 1 / STEP_RATE
+
+        # Segments of the centreline, from each waypoint to the next
+        centre = np.asarray(self.track.centre, dtype=float)
+        self.centre = centre
+        self.start = centre[:-1]
+        self.delta = centre[1:] - centre[:-1]
+        self.segment_lengths = np.hypot(self.delta[:, 0], self.delta[:, 1])
+        self.arc_length = np.asarray(self.track.arc_length, dtype=float)
+        self.width = np.asarray(self.track.width, dtype=float)
+        self.length = self.track.length
+        self.closed = self.track.closed
+        self.index = self.track.spatial_index()
+
+        self.x = np.zeros(num_cars)
+        self.y = np.zeros(num_cars)
+        self.heading = np.zeros(num_cars)
+        self.speed = np.zeros(num_cars)
+        self.steering_angle = np.zeros(num_cars)
+        self.segment = np.zeros(num_cars, dtype=int)
+        self.arc = np.zeros(num_cars)
+        self.travelled = np.zeros(num_cars)
+        self.steps = np.zeros(num_cars, dtype=int)
+        self.done = np.zeros(num_cars, dtype=bool)
+
+        # Statistics of finished episodes
+        self.episodes = 0
+        self.offtrack_episodes = 0
+        self.lap_steps = []
+
+        self.reset()
+
+    def reset(self, mask=None):
+        '''
+        Start new episodes for the cars in mask (default all), on the
+        centreline at a waypoint pointing along the track.
+        '''
+        index = (np.arange(self.num_cars) if mask is None
+                 else np.flatnonzero(mask))
+        if self.random_start:
+            segment = self.rng.integers(0, len(self.start), len(index))
+        else:
+            segment = np.zeros(len(index), dtype=int)
+
+        self.x[index] = self.start[segment, 0]
+        self.y[index] = self.start[segment, 1]
+        self.heading[index] = np.radians(
+            np.asarray(self.track.headings)[segment])
+        self.speed[index] = 0
+        self.steering_angle[index] = 0
+        self.segment[index] = segment
+        self.arc[index] = self.arc_length[segment]
+        self.travelled[index] = 0
+        self.steps[index] = 0
+        self.done[index] = False
+
+    def locate(self):
+
+        # Nearest centreline segment of each car, from the track's index
+        return self.index.query(np.stack([self.x, self.y], axis=1))
+
+    def observe(self, offset, t):
+        '''
+        Params for the current state, as a dict of columns.
+        '''
+        half_width = ((1 - t)*self.width[self.segment]
+                      + t*self.width[self.segment + 1]) / 2
+        distance = np.abs(offset)
+        heading = np.degrees(self.heading)
+        heading = (heading + 180) % 360 - 180
+
+        return {
+            'all_wheels_on_track': distance + CAR_HALF_WIDTH <= half_width,
+            'closest_waypoints': np.stack([self.segment, self.segment + 1],
+                                          axis=1),
+            'distance_from_center': distance,
+            'heading': heading,
+            'is_left_of_center': offset > 0,
+            'is_offtrack': distance > half_width + CAR_HALF_WIDTH,
+            'is_reversed': np.zeros(self.num_cars, dtype=bool),
+            'progress': np.clip(self.travelled / self.length * 100, 0, 100),
+            'speed': self.speed.copy(),
+            'steering_angle': self.steering_angle.copy(),
+            'steps': self.steps.copy(),
+            'x': self.x.copy(),
+            'y': self.y.copy(),
+        }
+
+    def step(self, steering_angle, speed):
+        '''
+        Apply an action to every car, steering_angle in degrees (positive
+        to the left) and target speed in m/s, each a scalar or one value per
+        car. Returns the params after the step and a mask of the cars whose
+        episode ended on it.
+        '''
+        # Cars whose episode ended on the last step start again
+        if self.done.any():
+            self.reset(self.done)
+
+        steering_angle = np.clip(np.broadcast_to(steering_angle,
+                                                 self.num_cars),
+                                 -MAX_STEERING, MAX_STEERING)
+        target = np.broadcast_to(np.asarray(speed, dtype=float),
+                                 self.num_cars)
+        if self.max_acceleration is None:
+            self.speed = target.copy()
+        else:
+            change = self.max_acceleration * self.dt
+            self.speed = np.clip(target, self.speed - change,
+                                 self.speed + change)
+        self.steering_angle = steering_angle.astype(float)
+
+        # Kinematic bicycle model about the rear axle
+        distance = self.speed * self.dt
+        self.x += distance * np.cos(self.heading)
+        self.y += distance * np.sin(self.heading)
+        self.heading += (distance / self.wheelbase
+                         * np.tan(np.radians(self.steering_angle)))
+        self.heading = (self.heading + np.pi) % (2*np.pi) - np.pi
+        self.steps += 1
+
+        # Distance covered along the centreline, going either way round
+        self.segment, t, offset = self.locate()
+        arc = self.arc_length[self.segment] + t*self.segment_lengths[
+            self.segment]
+        moved = arc - self.arc
+        if self.closed:
+            moved = (moved + self.length/2) % self.length - self.length/2
+        self.travelled += moved
+        self.arc = arc
+
+        params = self.observe(offset, t)
+
+        # Episodes end when a car leaves the track or completes a lap
+        finished = params['progress'] >= 100
+        offtrack = params['is_offtrack']
+        self.done = finished | offtrack
+        self.episodes += int(self.done.sum())
+        self.offtrack_episodes += int((offtrack & ~finished).sum())
+        self.lap_steps.extend(self.steps[finished].tolist())
+
+        return params, self.done.copy()
+
+    def point_ahead(self, distance):
+
+        # Point on the centreline distance metres ahead of each car
+        target = self.arc + distance
+        if self.closed:
+            target %= self.length
+        target = np.clip(target, 0, self.length)
+        segment = np.clip(np.searchsorted(self.arc_length, target,
+                                          side='right') - 1,
+                          0, len(self.start) - 1)
+        with np.errstate(invalid='ignore'):
+            t = np.nan_to_num((target - self.arc_length[segment])
+                              / self.segment_lengths[segment])
+
+        return self.start[segment] + t[:, np.newaxis]*self.delta[segment]
+
+
+def pure_pursuit(lookahead=0.6, speed=2.0, steering_noise=0.0):
+    '''
+    Controller that steers each car towards the centreline point lookahead
+    metres ahead of it at a constant target speed. steering_noise adds
+    Gaussian noise (degrees) to spread the cars across the track.
+    '''
+    def controller(sim):
+        point = sim.point_ahead(lookahead)
+        alpha = (np.arctan2(point[:, 1] - sim.y, point[:, 0] - sim.x)
+                 - sim.heading)
+        steering = np.degrees(np.arctan2(2*sim.wheelbase*np.sin(alpha),
+                                         lookahead))
+        if steering_noise:
+            steering += sim.rng.normal(0, steering_noise, sim.num_cars)
+
+        return steering, speed
+
+    return controller
+
+
+def run(track, reward, num_cars=1000, num_steps=1000, controller=None,
+        seed=0, random_start=True):
+    '''
+    Drive num_cars cars for num_steps steps with controller (default
+    pure_pursuit()), scoring every step with reward (a name or path for
+    rewards.load_reward). Uses reward_function_batch when the reward has
+    one. Returns a dict of statistics.
+    '''
+    sim = Simulator(track, num_cars, seed=seed, random_start=random_start)
+    module = load_reward(reward)
+    controller = controller or pure_pursuit()
+    shared = shared_params(sim.track)
+    batch = getattr(module, 'reward_function_batch', None)
+
+    total_reward = 0.0
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        columns, done = sim.step(*controller(sim))
+        params = dict(columns, **shared)
+        if batch is not None:
+            rewards = batch(params)
+        else:
+            keys = list(columns)
+            values = [columns[k].tolist() for k in keys]
+            rewards = [module.reward_function(dict(zip(keys, row), **shared))
+                       for row in zip(*values)]
+        total_reward += float(np.sum(rewards))
+    elapsed = time.perf_counter() - start
+
+    lap_steps = np.array(sim.lap_steps)
+    target_steps = getattr(module, 'TOTAL_NUM_STEPS', None)
+
+    return {
+        'steps': num_cars * num_steps,
+        'steps_per_second': num_cars * num_steps / elapsed,
+        'mean_reward': total_reward / (num_cars * num_steps),
+        'episodes': sim.episodes,
+        'offtrack_episodes': sim.offtrack_episodes,
+        'laps': len(lap_steps),
+        'mean_lap_steps': float(lap_steps.mean()) if len(lap_steps) else None,
+        'best_lap_steps': int(lap_steps.min()) if len(lap_steps) else None,
+        'target_steps': target_steps,
+        'laps_under_target': (int((lap_steps < target_steps).sum())
+                              if target_steps else None),
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('reward', nargs='?', default='final',
+                        help="reward name or path (default final)")
+    parser.add_argument('--track', default='Spain')
+    parser.add_argument('--cars', type=int, default=1000)
+    parser.add_argument('--steps', type=int, default=1000,
+                        help="steps per car (default 1000)")
+    parser.add_argument('--speed', type=float, default=2.0,
+                        help="target speed of the controller in m/s")
+    parser.add_argument('--lookahead', type=float, default=0.6,
+                        help="pure pursuit look-ahead in metres")
+    parser.add_argument('--steering-noise', type=float, default=0.0,
+                        help="steering noise in degrees")
+    parser.add_argument('--start-line', action='store_true',
+                        help="start every episode from the first waypoint")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    stats = run(args.track, args.reward, args.cars, args.steps,
+                pure_pursuit(args.lookahead, args.speed, args.steering_noise),
+                seed=args.seed, random_start=not args.start_line)
+
+    print("Simulated %d steps at %.0f steps/s"
+          % (stats['steps'], stats['steps_per_second']))
+    print("Mean reward per step: %.4f" % stats['mean_reward'])
+    print("Episodes: %d (%d off track)"
+          % (stats['episodes'], stats['offtrack_episodes']))
+    if stats['laps']:
+        print("Laps: %d, mean %.1f steps (%.2f s), best %d steps (%.2f s)"
+              % (stats['laps'], stats['mean_lap_steps'],
+                 stats['mean_lap_steps'] / STEP_RATE, stats['best_lap_steps'],
+                 stats['best_lap_steps'] / STEP_RATE))
+        if stats['target_steps']:
+            print("Laps under %d steps: %d"
+                  % (stats['target_steps'], stats['laps_under_target']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+'''
+Planner, speed profile and reward report for a whole library of tracks.
+
+Takes directories (or files) of track .npy files and runs every track
+through the same pipeline in its own worker process: the geometry from the
+track registry, the corner classification of a planner (final or
+qualifier, with any of its PARAMETERS overridden), the target speed
+profile, the planner maps and speed profile rendered to PNG files, and the
+reward driven round the track in the local simulator. The results are
+written to report.json and report.md in the output directory, one row per
+track.
+
+The configuration can also be given as a JSON file of the same options
+(e.g. {"reward": "my_reward.py", "planner": "qualifier", "set":
+["DIST_THRESHOLD=1.4"]}), which the command line overrides.
+
+Example:
+    python track_pipeline.py tracks/ --reward final --planner final \\
+        --set TURN_THRESHOLD_SPEED=8 --output-dir report
+'''
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# rewards puts planning/ on the path for the planner modules
+from rewards import reward_path
+import final_planner
+import qualifier_planner
+import speed_profile
+from interactive_planner import class_styles
+from plotting import save_figures
+from simulator import pure_pursuit, run
+from sweep import check_steps
+from tracks import TRACK_DIR, available_tracks, load_track
+
+PLANNERS = {
+    'final': final_planner,
+    'qualifier': qualifier_planner,
+}
+
+# Options a configuration file can set
+DEFAULTS = {
+    'reward': 'final',
+    'planner': 'final',
+    'set': [],
+    'line': 'centre',
+    'cars': 500,
+    'steps': 1000,
+    'speed': 2.0,
+    'maps': True,
+}
+
+
+def track_files(paths):
+
+    # Every track file in the directories given, and any files given
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [os.path.join(path, name + '.npy')
+                      for name in available_tracks(path)]
+        else:
+            files.append(path)
+
+    return files
+
+
+def parse_settings(settings, parameters):
+    '''
+    The values of NAME=VALUE settings of a planner's parameters. Raises
+    ValueError for a name that isn't one of them, or for a look-ahead in
+    steps that isn't a whole number from 1.
+    '''
+    params = {}
+    for setting in settings:
+        name, value = setting.split('=', 1)
+        name = name.upper()
+        if name not in parameters:
+            raise ValueError("%s is not a parameter of the planner (%s)"
+                             % (name, ', '.join(parameters)))
+        params[name] = float(value)
+        check_steps(name, [params[name]])
+        if 'STEP' in name:
+            params[name] = int(params[name])
+
+    return params
+
+
+def track_job(job):
+    '''
+    Run one track through the pipeline. Returns its row of the report.
+    '''
+    path, config, output_dir = job
+    track = load_track(path)
+    planner = PLANNERS[config['planner']]
+    params = dict(planner.PARAMETERS,
+                  **parse_settings(config['set'], planner.PARAMETERS))
+    row = {'track': track.name, 'path': path}
+
+    # Geometry
+    width = np.asarray(track.width)
+    row.update(waypoints=len(track), length=track.length,
+               min_width=float(width.min()), mean_width=float(width.mean()),
+               max_curvature=float(np.abs(track.curvature).max()))
+
+    # Share of the waypoints in each class of each planner map
+    waypoints = planner.load_waypoints(path)
+    classes = planner.classify(waypoints, params)
+    if not isinstance(classes, tuple):
+        classes = (classes,)
+    for values, (_, labels) in zip(classes, class_styles(config['planner'])
+                                   .values()):
+        for k, label in labels.items():
+            row[label] = float(np.mean(np.asarray(values) == k))
+
+    # Target speeds along the chosen line
+    profile = np.asarray(speed_profile.speed_profile(track,
+                                                     line=config['line']))
+    _, segment_lengths = speed_profile.line_geometry(track, config['line'])
+    row.update(min_target_speed=float(profile.min()),
+               max_target_speed=float(profile.max()),
+               profile_lap_time=speed_profile.lap_time(profile,
+                                                       segment_lengths))
+
+    # The reward in closed loop
+    if config['cars'] and config['steps']:
+        stats = run(track, config['reward'], config['cars'], config['steps'],
+                    pure_pursuit(speed=config['speed']))
+        row.update(mean_reward=stats['mean_reward'],
+                   laps=stats['laps'],
+                   best_lap_steps=stats['best_lap_steps'],
+                   offtrack_rate=(stats['offtrack_episodes']
+                                  / max(stats['episodes'], 1)))
+
+    if config['maps']:
+        figures = planner.render(waypoints, params, headless=True)
+        figures.update(speed_profile.plot(waypoints, profile, headless=True))
+        row['maps'] = save_figures(figures, output_dir, track.name)
+
+    return row
+
+
+def pipeline(paths, config, output_dir, workers=None):
+    '''
+    Run every track file in paths through the pipeline with config (see
+    DEFAULTS). Returns the rows of the report.
+    '''
+    config = dict(DEFAULTS, **config)
+    jobs = [(path, config, output_dir) for path in track_files(paths)]
+
+    if len(jobs) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(track_job, jobs))
+
+    return [track_job(job) for job in jobs]
+
+
+def format_report(rows):
+
+    # Markdown table of every column but the paths
+    columns = [c for c in rows[0] if c not in ('path', 'maps')]
+    lines = ['| ' + ' | '.join(columns) + ' |',
+             '|' + '---|' * len(columns)]
+    for row in rows:
+        cells = []
+        for c in columns:
+            value = row.get(c)
+            if isinstance(value, float):
+                cells.append('%.3f' % value)
+            else:
+                cells.append('' if value is None else str(value))
+        lines.append('| ' + ' | '.join(cells) + ' |')
+
+    return '\n'.join(lines)
+
+
+def main():
+
+    # Read a configuration file first, so it sets the defaults of the rest
+    config_parser = argparse.ArgumentParser(add_help=False)
+    config_parser.add_argument('--config',
+                               help="JSON file of options, overridden by "
+                                    "the command line")
+    config_args, remaining = config_parser.parse_known_args()
+    defaults = dict(DEFAULTS)
+    if config_args.config:
+        with open(config_args.config) as f:
+            defaults.update(json.load(f))
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+                                     parents=[config_parser])
+    parser.add_argument('paths', nargs='*', default=[TRACK_DIR],
+                        help="directories of track files, or track files "
+                             "(default the bundled tracks)")
+    parser.add_argument('--reward', help="reward name or path")
+    parser.add_argument('--planner', choices=sorted(PLANNERS))
+    parser.add_argument('--set', action='append', metavar='NAME=VALUE',
+                        help="planner parameter value (repeatable)")
+    parser.add_argument('--line', choices=speed_profile.LINES)
+    parser.add_argument('--cars', type=int,
+                        help="cars to simulate per track, 0 to skip")
+    parser.add_argument('--steps', type=int, help="steps per car")
+    parser.add_argument('--speed', type=float,
+                        help="target speed of the simulated driver in m/s")
+    parser.add_argument('--no-maps', dest='maps', action='store_false')
+    parser.add_argument('--output-dir', default='report')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.set_defaults(**defaults)
+    args = parser.parse_args(remaining)
+
+    config = {key: getattr(args, key) for key in DEFAULTS}
+    config['reward'] = reward_path(config['reward'])
+
+    # Check the settings before starting any workers
+    try:
+        parse_settings(config['set'],
+                       PLANNERS[config['planner']].PARAMETERS)
+    except ValueError as e:
+        parser.error(str(e))
+    rows = pipeline(args.paths, config, args.output_dir, args.workers)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    table = format_report(rows)
+    with open(os.path.join(args.output_dir, 'report.json'), 'w') as f:
+        json.dump({'config': config, 'tracks': rows}, f, indent=2)
+    with open(os.path.join(args.output_dir, 'report.md'), 'w') as f:
+        f.write(table + '\n')
+
+    print(table)
+
+
+if __name__ == '__main__':
+    main()
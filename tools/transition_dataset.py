@@ -0,0 +1,311 @@
+'''
+Synthetic (state, action, reward) transitions for pre-training offline.
+
+Places cars at random poses around the centreline of a track: anywhere
+along it, at a lateral offset of OFFSET_SCALE half widths (normally
+distributed) and a heading HEADING_SCALE degrees off the direction of the
+track. Each car takes an action of an action space (see
+planning/action_space.py) drawn uniformly, which a reward's
+reward_function_batch scores with the params of the pose (see
+rewards.position_columns) and the action's steering angle and speed. Steps
+are those of a lap from the first waypoint at LAP_STEPS steps, give or take
+PACE.
+
+The dataset is a directory with one .npy file per column of COLUMNS,
+created at its full size up front. The rows are split into jobs for a
+process pool, and each worker memory maps the files and writes its rows in
+place, so nothing but the job bounds and a few totals is pickled. meta.json
+records the track, reward, action space and number of rows, and is only
+written once every row is, so a directory without it is incomplete.
+
+read_batches() streams batches back from the memory maps, optionally
+shuffled a block of rows at a time, without loading the dataset:
+
+    for batch in read_batches('spain_final', 4096, shuffle=True):
+        train(batch['x'], batch['y'], batch['heading'], batch['action'],
+              batch['reward'])
+
+Example:
+    python transition_dataset.py final --track Spain --rows 10000000 \\
+        --action-space finals --output spain_final
+'''
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# rewards puts planning/ on the path for action_space and tracks
+from rewards import column_rows, load_reward, position_columns, shared_params
+from action_space import ACTION_SPACE, load_action_space
+from tracks import load_track
+
+META_FILE = 'meta.json'
+
+# Stored columns and their dtypes: the state, the action and its reward
+COLUMNS = {
+    'x': 'f4',
+    'y': 'f4',
+    'heading': 'f4',
+    'closest_waypoint': 'i4',
+    'distance_from_center': 'f4',
+    'is_left_of_center': '?',
+    'progress': 'f4',
+    'steps': 'i4',
+    'action': 'i2',
+    'steering_angle': 'f4',
+    'speed': 'f4',
+    'reward': 'f4',
+    'all_wheels_on_track': '?',
+    'is_offtrack': '?',
+}
+
+# Perturbation of the poses: standard deviation of the lateral offset (as a
+# fraction of the half width) and of the heading (degrees)
+OFFSET_SCALE = 0.5
+HEADING_SCALE = 15.0
+
+# Steps for a lap, as in reward_final.py, times a pace drawn from PACE
+LAP_STEPS = 675
+PACE = (0.8, 1.4)
+
+# Rows generated at once, and per job
+CHUNK_ROWS = 2**16
+JOB_ROWS = 2**20
+
+
+def column_path(path, name):
+
+    return os.path.join(path, name + '.npy')
+
+
+def random_poses(track, num_rows, rng):
+    '''
+    x, y and heading (degrees) of num_rows poses around the centreline of a
+    track from the registry.
+    '''
+    centre = np.asarray(track.centre)
+    arc_length = np.asarray(track.arc_length)
+    segment_lengths = np.asarray(track.segment_lengths)
+
+    # A point anywhere along the centreline, which is never on a segment
+    # without a length
+    arc = rng.uniform(0, track.length, num_rows)
+    segment = np.clip(np.searchsorted(arc_length, arc, side='right') - 1,
+                      0, len(centre) - 2)
+    t = np.clip((arc - arc_length[segment]) / segment_lengths[segment], 0, 1)
+    delta = centre[segment + 1] - centre[segment]
+    tangent = delta / segment_lengths[segment][:, np.newaxis]
+    normal = np.stack([-tangent[:, 1], tangent[:, 0]], axis=1)
+
+    # Pushed sideways and turned away from the direction of the track
+    width = np.asarray(track.width)
+    half_width = ((1 - t)*width[segment] + t*width[segment + 1]) / 2
+    offset = rng.normal(0, OFFSET_SCALE, num_rows) * half_width
+    position = (centre[segment] + t[:, np.newaxis]*delta
+                + offset[:, np.newaxis]*normal)
+    heading = (np.asarray(track.headings)[segment]
+               + rng.normal(0, HEADING_SCALE, num_rows))
+
+    return position[:, 0], position[:, 1], (heading + 180) % 360 - 180
+
+
+def transitions(track, module, actions, num_rows, rng):
+    '''
+    num_rows transitions on a track from the registry with an (A, 2) action
+    space, scored by a reward module, as a dict of the COLUMNS.
+    '''
+    x, y, heading = random_poses(track, num_rows, rng)
+    action = rng.integers(0, len(actions), num_rows)
+    columns = position_columns(track, x, y, heading,
+                               speed=actions[action, 1],
+                               steering_angle=actions[action, 0])
+    columns['steps'] = np.maximum(1, np.round(
+        columns['progress'] / 100 * LAP_STEPS
+        * rng.uniform(*PACE, num_rows))).astype(int)
+
+    params = dict(columns, **shared_params(track))
+    if hasattr(module, 'reward_function_batch'):
+        reward = module.reward_function_batch(params)
+    else:
+        reward = [module.reward_function(row)
+                  for row in column_rows(columns, shared_params(track))]
+
+    columns['closest_waypoint'] = columns['closest_waypoints'][:, 1]
+    columns['action'] = action
+    columns['reward'] = np.asarray(reward, dtype=float)
+
+    return columns
+
+
+def dataset_job(job):
+    '''
+    Generate the rows [first, last) of a dataset into its files. Returns
+    the sum of their rewards and the number of them off the track.
+    '''
+    path, reward, track_name, actions, first, last, seed = job
+    module = load_reward(reward)
+    track = load_track(track_name)
+    rng = np.random.default_rng([seed, first])
+    outputs = {name: np.load(column_path(path, name), mmap_mode='r+')
+               for name in COLUMNS}
+
+    total_reward = 0.0
+    offtrack = 0
+    for start in range(first, last, CHUNK_ROWS):
+        stop = min(start + CHUNK_ROWS, last)
+        columns = transitions(track, module, actions, stop - start, rng)
+        for name, output in outputs.items():
+            output[start:stop] = columns[name]
+        total_reward += float(columns['reward'].sum())
+        offtrack += int(columns['is_offtrack'].sum())
+
+    for output in outputs.values():
+        output.flush()
+
+    return total_reward, offtrack
+
+
+def generate(path, reward, track_name, num_rows, action_space=ACTION_SPACE,
+             seed=0, workers=None):
+    '''
+    Generate a dataset of num_rows transitions into the directory path.
+    Returns its meta data, with the mean reward and the share of rows off
+    the track.
+    '''
+    track = load_track(track_name)
+    actions = load_action_space(action_space)
+
+    # Any earlier dataset in the directory is incomplete from here on
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(os.path.join(path, META_FILE)):
+        os.remove(os.path.join(path, META_FILE))
+    for name, dtype in COLUMNS.items():
+        output = np.lib.format.open_memmap(column_path(path, name),
+                                           mode='w+', dtype=dtype,
+                                           shape=(num_rows,))
+        del output
+
+    jobs = [(path, reward, track.name, actions, first,
+             min(first + JOB_ROWS, num_rows), seed)
+            for first in range(0, num_rows, JOB_ROWS)]
+
+    if len(jobs) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(dataset_job, jobs))
+    else:
+        parts = [dataset_job(job) for job in jobs]
+
+    meta = {
+        'columns': COLUMNS,
+        'rows': num_rows,
+        'track': track.name,
+        'reward': reward,
+        'action_space': actions.tolist(),
+        'seed': seed,
+    }
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    return dict(meta,
+                mean_reward=sum(part[0] for part in parts) / num_rows,
+                offtrack=sum(part[1] for part in parts) / num_rows)
+
+
+def open_dataset(path):
+    '''
+    The meta data of a complete dataset and read-only memory maps of its
+    columns. Raises ValueError if it is incomplete.
+    '''
+    meta_path = os.path.join(path, META_FILE)
+    if not os.path.exists(meta_path):
+        raise ValueError("%s is not a complete dataset" % path)
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    return meta, {name: np.load(column_path(path, name), mmap_mode='r')
+                  for name in meta['columns']}
+
+
+def read_batches(path, batch_size, names=None, shuffle=False,
+                 block_rows=CHUNK_ROWS, seed=0):
+    '''
+    Batches of the named columns (default all) of a dataset, as dicts of
+    arrays of batch_size rows (fewer in the last one). With shuffle, the
+    blocks of block_rows rows are read in a random order and their rows
+    shuffled, so reads stay sequential while batches mix the whole
+    dataset.
+    '''
+    meta, columns = open_dataset(path)
+    columns = {name: columns[name] for name in (names or columns)}
+    rows = meta['rows']
+    rng = np.random.default_rng(seed)
+
+    starts = np.arange(0, rows, block_rows)
+    if shuffle:
+        rng.shuffle(starts)
+
+    # Rows left over from the last block carry into the next batch
+    pending = []
+    pending_rows = 0
+    for start in starts:
+        stop = min(start + block_rows, rows)
+        block = {name: np.asarray(column[start:stop])
+                 for name, column in columns.items()}
+        if shuffle:
+            order = rng.permutation(stop - start)
+            block = {name: values[order] for name, values in block.items()}
+        pending.append(block)
+        pending_rows += stop - start
+
+        if pending_rows < batch_size:
+            continue
+        merged = {name: np.concatenate([part[name] for part in pending])
+                  for name in columns}
+        full = pending_rows - pending_rows % batch_size
+        for first in range(0, full, batch_size):
+            yield {name: values[first:first + batch_size]
+                   for name, values in merged.items()}
+        pending = [{name: values[full:] for name, values in merged.items()}]
+        pending_rows -= full
+
+    if pending_rows:
+        yield {name: np.concatenate([part[name] for part in pending])
+               for name in columns}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('reward', nargs='?', default='final',
+                        help="reward name or path (default final)")
+    parser.add_argument('--track', default='Spain')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--action-space', default=ACTION_SPACE,
+                        help="action space name or path (default %s)"
+                             % ACTION_SPACE)
+    parser.add_argument('--output', required=True,
+                        help="write the dataset to this directory")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    if args.rows < 1:
+        parser.error("--rows must be at least 1")
+
+    start = time.perf_counter()
+    meta = generate(args.output, args.reward, args.track, args.rows,
+                    args.action_space, args.seed, args.workers)
+    seconds = time.perf_counter() - start
+
+    print("%s: %d transitions with %d actions in %.1f s (%.0f rows/s)"
+          % (meta['track'], meta['rows'], len(meta['action_space']),
+             seconds, meta['rows'] / seconds))
+    print("Mean reward %.4f, %.1f%% off track"
+          % (meta['mean_reward'], 100 * meta['offtrack']))
+    print(args.output)
+
+
+if __name__ == '__main__':
+    main()